@@ -8,28 +8,16 @@ import pandas as pd
 
 from joblib import dump, load
 
-from sklearn.model_selection import train_test_split
-from sklearn import metrics
-from sklearn.model_selection import ParameterGrid
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import precision_score
-from sklearn.metrics import recall_score
-from sklearn.metrics import f1_score
-
-from sklearn.linear_model import LogisticRegression, SGDClassifier
-from sklearn.svm import SVC
-
-import lightgbm as lgbm
-
-import tensorflow as tf
-
-from tensorflow.keras.optimizers import *
-from keras.regularizers import *
-from keras.models import Sequential, save_model, load_model
-from keras.layers import Dense, Dropout
-from keras.callbacks import *
+from scipy.special import expit
 
 from service.App import App
+from common.numpy_models import MlpModel, LinearModel, standard_parameters, export_nn, load_nn, export_gb, load_gb
+
+"""
+Training and prediction of GB (LightGBM), NN (Keras) and LC (scikit-learn) models.
+Frameworks are imported only by functions which train, save or load models of their type
+so that importing this module (e.g., by the server) does not load them.
+"""
 
 
 #
@@ -49,6 +37,9 @@ def train_gb(df_X, df_y, params: dict):
     """
     Train model with the specified hyper-parameters and return this model (and scaler if any).
     """
+    import lightgbm as lgbm
+    from sklearn.preprocessing import StandardScaler
+
     is_scale = params.get("is_scale", False)
 
     #
@@ -138,7 +129,8 @@ def predict_gb(models: tuple, df_X_test):
     df_X_test_nonans = df_X_test.dropna()  # Drop nans, create gaps in index
     nonans_index = df_X_test_nonans.index
 
-    y_test_hat_nonans = models[0].predict(df_X_test_nonans.values)
+    model = models[0]  # LightGBM booster or flat trees (converted once when loaded if App.config["gb_engine"] is "numpy")
+    y_test_hat_nonans = model.predict(df_X_test_nonans.values)
     y_test_hat_nonans = pd.Series(data=y_test_hat_nonans, index=nonans_index)  # Attach indexes with gaps
 
     df_ret = pd.DataFrame(index=input_index)  # Create empty dataframe with original index
@@ -165,6 +157,13 @@ def train_nn(df_X, df_y, params: dict):
     """
     Train model with the specified hyper-parameters and return this model (and scaler if any).
     """
+    import tensorflow as tf
+    from keras.models import Sequential
+    from keras.layers import Dense
+    from keras.optimizers import Adam
+    from keras.callbacks import EarlyStopping
+    from sklearn.preprocessing import StandardScaler
+
     is_scale = params.get("is_scale", True)
 
     #
@@ -295,6 +294,9 @@ def train_lc(df_X, df_y, params: dict):
     """
     Train model with the specified hyper-parameters and return this model (and scaler if any).
     """
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.preprocessing import StandardScaler
+
     is_scale = params.get("is_scale", True)
 
     #
@@ -372,6 +374,9 @@ def train_svc(df_X, df_y, params: dict):
     """
     Train model with the specified hyper-parameters and return this model (and scaler if any).
     """
+    from sklearn.svm import SVC
+    from sklearn.preprocessing import StandardScaler
+
     is_scale = params.get("is_scale", True)
 
     #
@@ -432,6 +437,129 @@ def predict_svc(models: tuple, df_X_test):
     return sr_ret
 
 
+#
+# Ensemble
+#
+
+class ModelEnsemble:
+    """
+    All model pairs (as returned by load_models()) applied to the same feature matrix.
+    The scores are the same as those of predict_gb(), predict_nn() and predict_lc() for each model but
+    nan rows are found once, equal scalers transform the matrix once, all LC models are one matrix product
+    and GB and NN models are called once for each scaler (NN models of one scaler are combined in one network).
+    NN models can be keras models or exported MLP models (see numpy_models).
+    """
+
+    def __init__(self, models: dict):
+        """
+        :param models: Dict with score column names as keys (ending with the algorithm like "_gb") and model pairs as values
+        """
+        self.names = list(models.keys())
+        self.scalers = {}  # Key -> scaler
+        self.gb = {}  # Scaler key -> list of (column id, model)
+        self.nn = {}  # Scaler key -> (column ids, combined model)
+
+        lc_ids, weights, intercepts = [], [], []
+        nn_models = {}
+        for i, (name, (model, scaler)) in enumerate(models.items()):
+            key = _scaler_key(scaler)
+            if name.endswith("_gb"):
+                self.scalers[key] = scaler
+                self.gb.setdefault(key, []).append((i, model))
+            elif name.endswith("_nn"):
+                self.scalers[key] = scaler
+                nn_models.setdefault(key, []).append((i, model))
+            elif name.endswith("_lc"):
+                w, b = _linear_weights(model, scaler)
+                lc_ids.append(i)
+                weights.append(w)
+                intercepts.append(b)
+            else:
+                raise ValueError(f"Unknown column name algorithm suffix {name[-3:]}. Currently only '_gb', '_nn', '_lc' are supported.")
+
+        self.lc_ids = np.array(lc_ids, dtype=int)
+        self.lc_weights = np.column_stack(weights) if weights else None  # One column for each model
+        self.lc_intercepts = np.array(intercepts)
+
+        for key, pairs in nn_models.items():
+            self.nn[key] = ([i for i, _ in pairs], _combine_nn([model for _, model in pairs]))
+
+    def predict(self, df_X_test):
+        """
+        Scores of all models for the feature matrix. Rows with nans get nan scores.
+
+        :return: Data frame with one column for each model and the same index as the input
+        """
+        X = np.asarray(df_X_test, dtype=float)
+        scores = np.full((len(X), len(self.names)), np.nan)
+
+        rows = np.flatnonzero(~np.isnan(X).any(axis=1))  # Rows without nans
+        if not len(rows):
+            return pd.DataFrame(scores, index=df_X_test.index, columns=self.names)
+        X = X[rows]
+
+        if len(self.lc_ids):
+            scores[np.ix_(rows, self.lc_ids)] = expit(X @ self.lc_weights + self.lc_intercepts)
+
+        inputs = {key: _scale(scaler, X) for key, scaler in self.scalers.items()}
+
+        for key, models in self.gb.items():
+            for i, model in models:
+                scores[rows, i] = model.predict(inputs[key])
+
+        for key, (ids, model) in self.nn.items():
+            if isinstance(model, MlpModel):
+                y_hat = model.predict(inputs[key])
+            else:
+                y_hat = model(inputs[key], training=False)
+            scores[np.ix_(rows, ids)] = np.asarray(y_hat).reshape(len(rows), len(ids))
+
+        return pd.DataFrame(scores, index=df_X_test.index, columns=self.names)
+
+
+def _scaler_key(scaler):
+    """Scalers with the same parameters have the same key."""
+    if scaler is None:
+        return None
+    from sklearn.preprocessing import StandardScaler  # Already loaded with the scaler
+    if isinstance(scaler, StandardScaler):
+        mean, scale = standard_parameters(scaler)
+        return ("standard", mean.tobytes(), scale.tobytes())
+    return id(scaler)
+
+
+def _scale(scaler, X):
+    if scaler is None:
+        return X
+    from sklearn.preprocessing import StandardScaler
+    if isinstance(scaler, StandardScaler):  # Same operations as in transform() but without checks of column names
+        mean, scale = standard_parameters(scaler)
+        X = X - mean
+        X /= scale
+        return X
+    return scaler.transform(X)
+
+
+def _linear_weights(model, scaler):
+    """Weights and intercept of a binary linear classifier with the scaler folded in (applied to unscaled features)."""
+    model = LinearModel.from_sklearn(model, scaler)
+    return model.coef_[0], float(model.intercept_[0])
+
+
+def _combine_nn(models: list):
+    """One network which returns the outputs of all the networks (for the same input) as columns."""
+    if len(models) == 1:
+        return models[0]
+    if all(isinstance(model, MlpModel) for model in models):
+        return MlpModel.combine(models)
+
+    from keras.models import Model
+    from keras.layers import Input, Concatenate
+    inputs = Input(shape=models[0].input_shape[1:])
+    outputs = Concatenate()([model(inputs) for model in models])
+    return Model(inputs=inputs, outputs=outputs)
+
+
 #
 # Utils
 #
@@ -447,24 +575,41 @@ def save_model_pair(model_path, score_column_name: str, model_pair: tuple):
     dump(scaler, scaler_file_name)
     # Save prediction model
     if score_column_name.endswith("_nn"):
+        from keras.models import save_model
+
         model_extension = ".h5"
         model_file_name = model_path.joinpath(score_column_name).with_suffix(model_extension)
         save_model(model, model_file_name)
+        # Also weights for evaluation without TensorFlow (scaler is included)
+        if App.config.get("nn_engine") == "numpy":
+            export_nn(model, scaler, model_path.joinpath(score_column_name).with_suffix(".npz"))
     else:
         model_extension = ".pickle"
         model_file_name = model_path.joinpath(score_column_name).with_suffix(model_extension)
         dump(model, model_file_name)
+        if score_column_name.endswith("_gb") and App.config.get("gb_engine") == "numpy":
+            # Also flat trees for evaluation without LightGBM (scaler is included)
+            export_gb(model, scaler, model_path.joinpath(score_column_name).with_suffix(".npz"))
 
 
 def load_model_pair(model_path, score_column_name: str):
-    """Load a pair consisting of scaler model (possibly null) and prediction model from two files."""
+    """
+    Load a pair consisting of scaler model (possibly null) and prediction model from two files.
+    If App.config["nn_engine"] ("gb_engine") is "numpy", then NN (GB) models are loaded from .npz files (with their scaler)
+    and evaluated without TensorFlow (LightGBM).
+    """
     if not isinstance(model_path, Path):
         model_path = Path(model_path)
+    if score_column_name.endswith("_nn") and App.config.get("nn_engine") == "numpy":
+        return (load_nn(model_path.joinpath(score_column_name).with_suffix(".npz")), None)
+    if score_column_name.endswith("_gb") and App.config.get("gb_engine") == "numpy":
+        return (load_gb(model_path.joinpath(score_column_name).with_suffix(".npz")), None)
     # Load scaler
     scaler_file_name = model_path.joinpath(score_column_name).with_suffix(".scaler")
     scaler = load(scaler_file_name)
     # Load prediction model
     if score_column_name.endswith("_nn"):
+        from keras.models import load_model
         model_extension = ".h5"
         model_file_name = model_path.joinpath(score_column_name).with_suffix(model_extension)
         model = load_model(model_file_name)
@@ -477,17 +622,70 @@ def load_model_pair(model_path, score_column_name: str):
 
 
 def load_models(model_path, labels: list, feature_sets: list, algorithms: list):
-    """Load all model pairs for all combinations of the model parameters and return as a dict."""
+    """
+    Load all model pairs for all combinations of the model parameters and return as a dict.
+    If App.config["model_bundle"] is set, then the models are loaded from this bundle file in the model folder (see model_bundle).
+    """
+    names = model_names(labels, feature_sets, algorithms)
+
+    bundle = App.config.get("model_bundle")
+    if bundle:
+        from common.model_bundle import load_model_bundle
+        return load_model_bundle(Path(model_path) / bundle, names)
+
     models = {}
-    for predicted_label in itertools.product(labels, feature_sets, algorithms):
-        score_column_name = predicted_label[0] + "_" + predicted_label[1][0] + "_" + predicted_label[2]
+    for score_column_name in names:
         model_pair = load_model_pair(model_path, score_column_name)
         models[score_column_name] = model_pair
     return models
 
 
+def import_frameworks(algorithms: list):
+    """Import frameworks of the algorithms in advance (e.g., in worker processes) so that training does not wait for imports."""
+    if "gb" in algorithms:
+        import lightgbm
+    if "nn" in algorithms:
+        import tensorflow
+        import keras
+    if "lc" in algorithms or "svc" in algorithms:
+        import sklearn.linear_model
+        import sklearn.svm
+    import sklearn.preprocessing
+
+
+def model_names(labels: list, feature_sets: list, algorithms: list):
+    """Score column names (like "high_10_k_gb") of all combinations of the model parameters."""
+    return [label + "_" + feature_set[0] + "_" + algorithm for label, feature_set, algorithm in itertools.product(labels, feature_sets, algorithms)]
+
+
+def get_models_signature(model_path, names: list):
+    """
+    Value which changes when the models are changed (e.g., retrained). It is computed without loading the models:
+    from the hashes of the models in the manifest of the bundle (if App.config["model_bundle"] is set)
+    or from the sizes and modification times of the model files.
+    """
+    model_path = Path(model_path)
+    bundle = App.config.get("model_bundle")
+    if bundle:
+        from common.model_bundle import read_manifest
+        try:
+            entries = read_manifest(model_path / bundle)["models"]
+        except (OSError, ValueError):  # Not written yet
+            return None
+        return tuple((name, entries[name]["sha256"] if name in entries else None) for name in names)
+
+    signature = []
+    for name in names:
+        for file in sorted(model_path.glob(name + ".*")):
+            stat = file.stat()
+            signature.append((file.name, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
 def compute_scores(y_true, y_hat):
     """Compute several scores and return them as dict."""
+    from sklearn import metrics
+
     y_true = y_true.astype(int)
     y_hat_class = np.where(y_hat.values > 0.5, 1, 0)
 
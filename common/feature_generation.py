@@ -1,4 +1,5 @@
 import os
+from functools import partial
 from datetime import datetime, timezone, timedelta
 from typing import Union
 import json
@@ -7,6 +8,8 @@ import numpy as np
 import pandas as pd
 
 from common.utils import *
+from common.feature_plan import run_tasks
+from common.order_book import OrderBook
 
 """
 Feature/label generation.
@@ -17,78 +20,58 @@ Also, no parameter training is performed.
 """
 
 
-def generate_features(df, use_differences=False):
+def generate_features(df, use_differences=False, workers: int = 1):
     """
     Generate derived features by adding them as new columns to the data frame.
     This (same) function must be used for both training and prediction.
     If we use it for training to produce models then this same function has to be used before applying these models.
+
+    Feature families are independent and are computed concurrently if workers is greater than 1 (see run_feature_families).
     """
     # Parameters of moving averages
     windows = [1, 5, 15, 60, 180, 720]
     base_window = 1440
 
-    features = []
-    to_drop = []
-
     if use_differences:
         df['close'] = to_diff(df['close'])
         df['volume'] = to_diff(df['volume'])
         df['trades'] = to_diff(df['trades'])
 
-    # close mean
-    weight_column_name = 'volume'  # None: no weighting; 'volume': volume average
-    to_drop += add_past_weighted_aggregations(df, 'close', weight_column_name, np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_weighted_aggregations(df, 'close', weight_column_name, np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['close_1', 'close_2', 'close_5', 'close_20', 'close_60', 'close_180']
-
-    # close std
-    to_drop += add_past_aggregations(df, 'close', np.nanstd, base_window)  # Base column
-    features += add_past_aggregations(df, 'close', np.nanstd, windows[1:], '_std', to_drop[-1], 100.0)  # window 1 excluded
-    # ['close_std_1', 'close_std_2', 'close_std_5', 'close_std_20', 'close_std_60', 'close_std_180']
-
-    # volume mean
-    to_drop += add_past_aggregations(df, 'volume', np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_aggregations(df, 'volume', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['volume_1', 'volume_2', 'volume_5', 'volume_20', 'volume_60', 'volume_180']
-
     # Span: high-low difference
     df['span'] = df['high'] - df['low']
-    to_drop.append('span')
-    to_drop += add_past_aggregations(df, 'span', np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_aggregations(df, 'span', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['span_1', 'span_2', 'span_5', 'span_20', 'span_60', 'span_180']
-
-    # Number of trades
-    to_drop += add_past_aggregations(df, 'trades', np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_aggregations(df, 'trades', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['trades_1', 'trades_2', 'trades_5', 'trades_20', 'trades_60', 'trades_180']
-
     # tb_base_av / volume varies around 0.5 in base currency
     df['tb_base'] = df['tb_base_av'] / df['volume']
-    to_drop.append('tb_base')
-    to_drop += add_past_aggregations(df, 'tb_base', np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_aggregations(df, 'tb_base', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['tb_base_1', 'tb_base_2', 'tb_base_5', 'tb_base_20', 'tb_base_60', 'tb_base_180']
-
     # tb_quote_av / quote_av varies around 0.5 in quote currency
     df['tb_quote'] = df['tb_quote_av'] / df['quote_av']
-    to_drop.append('tb_quote')
-    to_drop += add_past_aggregations(df, 'tb_quote', np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_aggregations(df, 'tb_quote', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['tb_quote_1', 'tb_quote_2', 'tb_quote_5', 'tb_quote_20', 'tb_quote_60', 'tb_quote_180']
+    to_drop = ['span', 'tb_base', 'tb_quote']
+
+    families = [
+        # close mean
+        # ['close_1', 'close_2', 'close_5', 'close_20', 'close_60', 'close_180']
+        partial(_add_relative_aggregations, column_name='close', weight_column_name='volume', fn=np.nanmean, windows=windows, base_window=base_window, suffix=''),
+        # close std
+        # ['close_std_1', 'close_std_2', 'close_std_5', 'close_std_20', 'close_std_60', 'close_std_180']
+        partial(_add_relative_aggregations, column_name='close', fn=np.nanstd, windows=windows[1:], base_window=base_window, suffix='_std'),  # window 1 excluded
+    ]
+    # Means of volume, span, number of trades, tb_base, tb_quote
+    # ['volume_1', 'volume_2', 'volume_5', 'volume_20', 'volume_60', 'volume_180'] etc.
+    for column_name in ['volume', 'span', 'trades', 'tb_base', 'tb_quote']:
+        families.append(partial(_add_relative_aggregations, column_name=column_name, fn=np.nanmean, windows=windows, base_window=base_window, suffix=''))
 
     # Area over and under latest close price
-    features += add_area_ratio(df, is_future=False, column_name="close", windows=[60, 120, 180, 300, 720], suffix = "_area")
+    families.append(partial(add_area_ratio, is_future=False, column_name="close", windows=[60, 120, 180, 300, 720], suffix="_area"))
 
     # Linear trend
-    features += add_linear_trends(df, is_future=False, column_name="close", windows=windows[1:], suffix="_trend")  # window 1 excluded
+    families.append(partial(add_linear_trends, is_future=False, column_name="close", windows=windows[1:], suffix="_trend"))  # window 1 excluded
+
+    features = run_feature_families(df, families, workers)
 
     df.drop(columns=to_drop, inplace=True)
 
     return features
 
 
-def generate_features_futur(df, use_differences=False):
+def generate_features_futur(df, use_differences=False, workers: int = 1):
     """
     Generate derived features for futures.
     """
@@ -96,63 +79,70 @@ def generate_features_futur(df, use_differences=False):
     windows = [1, 2, 5, 20, 60, 180]
     base_window = 360
 
-    features = []
-    to_drop = []
-
     if use_differences:
         df['f_close'] = to_diff(df['f_close'])
         df['f_volume'] = to_diff(df['f_volume'])
         df['f_trades'] = to_diff(df['f_trades'])
 
-    # close mean
-    weight_column_name = 'f_volume'  # None: no weighting; 'volume': volume average
-    to_drop += add_past_weighted_aggregations(df, 'f_close', weight_column_name, np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_weighted_aggregations(df, 'f_close', weight_column_name, np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['f_close_1', f_close_2', 'f_close_5', 'f_close_10', 'f_close_20']
+    # Span: high-low difference
+    df['f_span'] = df['f_high'] - df['f_low']
+    to_drop = ['f_span']
+
+    families = [
+        # close mean
+        # ['f_close_1', f_close_2', 'f_close_5', 'f_close_10', 'f_close_20']
+        partial(_add_relative_aggregations, column_name='f_close', weight_column_name='f_volume', fn=np.nanmean, windows=windows, base_window=base_window, suffix=''),
+        # close std
+        # ['f_close_std_1', f_close_std_2', 'f_close_std_5', 'f_close_std_10', 'f_close_std_20']
+        partial(_add_relative_aggregations, column_name='f_close', fn=np.nanstd, windows=windows[1:], base_window=base_window, suffix='_std'),  # window 1 excluded
+    ]
+    # Means of volume, span, number of trades
+    # ['f_volume_1', 'f_volume_2', 'f_volume_5', 'f_volume_10', 'f_volume_20'] etc.
+    # tb_base (f_tb_base_av / f_volume) and tb_quote (f_tb_quote_av / f_quote_av) are not used
+    for column_name in ['f_volume', 'f_span', 'f_trades']:
+        families.append(partial(_add_relative_aggregations, column_name=column_name, fn=np.nanmean, windows=windows, base_window=base_window, suffix=''))
 
-    # close std
-    to_drop += add_past_aggregations(df, 'f_close', np.nanstd, base_window)  # Base column
-    features += add_past_aggregations(df, 'f_close', np.nanstd, windows[1:], '_std', to_drop[-1], 100.0)  # window 1 excluded
-    # ['f_close_std_1', f_close_std_2', 'f_close_std_5', 'f_close_std_10', 'f_close_std_20']
+    # Area over and under latest close price
+    families.append(partial(add_area_ratio, is_future=False, column_name="f_close", windows=[20, 60, 120, 180], suffix="_area"))
 
-    # volume mean
-    to_drop += add_past_aggregations(df, 'f_volume', np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_aggregations(df, 'f_volume', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['f_volume_1', 'f_volume_2', 'f_volume_5', 'f_volume_10', 'f_volume_20']
+    # Linear trend
+    families.append(partial(add_linear_trends, is_future=False, column_name="f_close", windows=windows[1:], suffix="_trend"))  # window 1 excluded
 
-    # Span: high-low difference
-    df['f_span'] = df['f_high'] - df['f_low']
-    to_drop.append('f_span')
-    to_drop += add_past_aggregations(df, 'f_span', np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_aggregations(df, 'f_span', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['f_span_1', 'f_span_2', 'f_span_5', 'f_span_10', 'f_span_20']
+    features = run_feature_families(df, families, workers)
 
-    # Number of trades
-    to_drop += add_past_aggregations(df, 'f_trades', np.nanmean, base_window, suffix='')  # Base column
-    features += add_past_aggregations(df, 'f_trades', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['f_trades_1', 'f_trades_2', 'f_trades_5', 'f_trades_10', 'f_trades_20']
+    df.drop(columns=to_drop, inplace=True)
 
-    # tb_base_av / volume varies around 0.5 in base currency
-    #df['f_tb_base'] = df['f_tb_base_av'] / df['f_volume']
-    #to_drop.append('f_tb_base')
-    #to_drop += add_past_aggregations(df, 'f_tb_base', np.nanmean, base_window, suffix='')  # Base column
-    #features += add_past_aggregations(df, 'f_tb_base', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['f_tb_base_1', 'f_tb_base_2', 'f_tb_base_5', 'f_tb_base_10', 'f_tb_base_20']
+    return features
 
-    # tb_quote_av / quote_av varies around 0.5 in quote currency
-    #df['f_tb_quote'] = df['f_tb_quote_av'] / df['f_quote_av']
-    #to_drop.append('f_tb_quote')
-    #to_drop += add_past_aggregations(df, 'f_tb_quote', np.nanmean, base_window, suffix='')  # Base column
-    #features += add_past_aggregations(df, 'f_tb_quote', np.nanmean, windows, '', to_drop[-1], 100.0)
-    # ['f_tb_quote_1', 'f_tb_quote_2', 'f_tb_quote_5', 'f_tb_quote_10', 'f_tb_quote_20']
 
-    # Area over and under latest close price
-    features += add_area_ratio(df, is_future=False, column_name="f_close", windows=[20, 60, 120, 180], suffix = "_area")
+def _add_relative_aggregations(df, column_name: str, fn, windows: list, base_window: int, suffix: str, weight_column_name: str = None):
+    """Add (weighted) aggregations relative to the aggregation over the base window which is added as a column with no suffix."""
+    if weight_column_name:
+        base = add_past_weighted_aggregations(df, column_name, weight_column_name, fn, base_window, suffix='')  # Base column
+        return add_past_weighted_aggregations(df, column_name, weight_column_name, fn, windows, suffix, base[-1], 100.0)
+    else:
+        base = add_past_aggregations(df, column_name, fn, base_window, suffix='')  # Base column
+        return add_past_aggregations(df, column_name, fn, windows, suffix, base[-1], 100.0)
 
-    # Linear trend
-    features += add_linear_trends(df, is_future=False, column_name="f_close", windows=windows[1:], suffix="_trend")  # window 1 excluded
 
-    df.drop(columns=to_drop, inplace=True)
+def run_feature_families(df, families: list, workers: int = 1):
+    """
+    Compute feature families and add their features to the data frame in the order of families.
+    A family is a function which gets a data frame, adds columns to it and returns the names of its features.
+    Each family gets its own shallow copy of the data frame so that families can be executed concurrently
+    by a pool of threads (numpy, pandas rolling and JIT kernels release the GIL). Other added columns are not copied.
+
+    :return: List of added feature names
+    """
+    def run(family):
+        family_df = df.copy(deep=False)
+        return family_df, family(family_df)
+
+    features = []
+    for family_df, family_features in run_tasks([partial(run, family) for family in families], workers):
+        for name in family_features:
+            df[name] = family_df[name]
+        features += family_features
 
     return features
 
@@ -266,16 +256,7 @@ def depth_to_df(depth: list):
     #
     # Generate a table with feature records
     #
-    table = []
-    for entry in depth:
-        record = depth_to_features(entry, windows, bin_size)
-        table.append(record)
-
-    #
-    # Convert json table to data frame
-    #
-    df = pd.DataFrame.from_dict(table)
-    # Alternatively, from_records() or json_normalize()
+    df = depth_batch_to_features(depth, windows, bin_size)
 
     # Timestamp is an index
     df["timestamp"] = pd.to_datetime(df["timestamp"], unit='ms')
@@ -308,7 +289,7 @@ def depth_to_df(depth: list):
     # Create DatetimeIndex
     # NOTE: if tz is not specified then the index is tz-naive
     #   closed can be specified (which side to include/exclude: left, right or both). it influences if we want ot include/exclude start or end of the interval
-    index = pd.date_range(start, end, freq="T")
+    index = pd.date_range(start, end, freq="min")
     df_out = pd.DataFrame(index=index)
 
     #
@@ -322,18 +303,15 @@ def depth_to_df(depth: list):
 def depth_to_features(entry: list, windows: list, bin_size: float):
     """Convert one record of market depth to a dict of features"""
 
-    bids = entry.get("bids")
-    asks = entry.get("asks")
+    book = OrderBook(entry)
 
     timestamp = entry.get("timestamp")
 
     # Gap feature
-    gap = asks[0][0] - bids[0][0]
-
-    if gap < 0: gap = 0
+    gap = book.gap
 
     # Price feature
-    price = bids[0][0] + (gap / 2)
+    price = book.mid_price
 
     # Densities for bids and asks (volume per price unit)
     densities = mean_volumes(depth=entry, windows=windows, bin_size=bin_size)
@@ -344,5 +322,40 @@ def depth_to_features(entry: list, windows: list, bin_size: float):
     return record
 
 
+def depth_batch_to_features(depth: list, windows: list, bin_size: Union[float, list]):
+    """
+    Convert a list of market depth records to a data frame with the same features as depth_to_features() (one row for each record).
+    Records are packed into arrays of prices and volumes so that all features are computed for all records at once.
+    """
+    timestamps = [entry.get("timestamp") for entry in depth]
+    return packed_depth_to_features(timestamps, pack_depth(depth, "bids"), pack_depth(depth, "asks"), windows, bin_size)
+
+
+def packed_depth_to_features(timestamps: list, bids: tuple, asks: tuple, windows: list, bin_size: Union[float, list]):
+    """Compute depth features from sides packed by pack_depth() (tuples of prices, volumes and numbers of levels)."""
+    bid_prices, bid_volumes, bid_lengths = bids
+    ask_prices, ask_volumes, ask_lengths = asks
+
+    # Gap feature
+    gap = np.maximum(ask_prices[:, 0] - bid_prices[:, 0], 0.0)
+
+    # Price feature
+    price = bid_prices[:, 0] + (gap / 2)
+
+    # Densities for bids and asks (volume per price unit)
+    bin_sizes = bin_size if isinstance(bin_size, list) else [bin_size]
+    bid_densities = batch_volume_densities("bid", bid_prices, bid_volumes, windows, bin_sizes)
+    ask_densities = batch_volume_densities("ask", ask_prices, ask_volumes, windows, bin_sizes)
+
+    columns = {"timestamp": timestamps, "gap": gap, "price": price}
+    for i, size in enumerate(bin_sizes):
+        suffix = f"_bin{size:g}" if isinstance(bin_size, list) else ""
+        for j, length in enumerate(windows):
+            columns[f"bids_{length}{suffix}"] = bid_densities[:, i, j]
+            columns[f"asks_{length}{suffix}"] = ask_densities[:, i, j]
+
+    return pd.DataFrame(columns)
+
+
 if __name__ == "__main__":
     pass
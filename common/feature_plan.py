@@ -0,0 +1,200 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from common.utils import rolling_aggregate, rolling_area_ratio, rolling_slope, window_sums
+
+"""
+Feature plans.
+A list of feature names (like App.config["features_kline"]) is compiled into a plan of operations which is executed for a data frame.
+The plan has stages: source and derived columns -> shared prefix sums and counts -> window aggregations -> requested features.
+Each intermediate result (derived column, prefix sums of a column, aggregation for the base window) is computed once
+and shared by all features which need it. Only the requested features are added to the data frame.
+The result is the same as that of the hard-coded functions in feature_generation.
+"""
+
+# Column prefix and base window (relative features are computed with respect to the aggregation over this window)
+feature_sets = {
+    "kline": dict(prefix="", base_window=1440),
+    "futur": dict(prefix="f_", base_window=360),
+    "depth": dict(prefix="", base_window=30),
+}
+
+# Columns computed from source columns (names without prefix)
+derived_columns = {
+    "span": ("high", "-", "low"),
+    "tb_base": ("tb_base_av", "/", "volume"),
+    "tb_quote": ("tb_quote_av", "/", "quote_av"),
+}
+
+
+def parse_feature(name: str, prefix: str = ""):
+    """
+    Parse feature name like "close_5", "close_std_5", "volume_5", "bids_1_5", "close_area_60", "close_trend_60".
+    Close is weighted by volume (of the same prefix) and other columns are simply averaged.
+
+    :return: tuple with feature family (weighted, mean, std, area, trend), column name and window
+    """
+    match = re.fullmatch(r"(.+?)(?:_(std|area|trend))?_(\d+)", name)
+    if not match:
+        raise ValueError(f"Cannot parse feature name '{name}'.")
+    column, family, window = match.group(1), match.group(2), int(match.group(3))
+    if family is None:
+        family = "weighted" if column == prefix + "close" else "mean"
+    return family, column, window
+
+
+class FeaturePlan:
+    """
+    Operations needed to compute the specified features from a data frame with source columns.
+    """
+
+    def __init__(self, features: list, feature_set: str = "kline"):
+        """
+        :param features: Feature names (output columns) in the order they have to be added to the data frame
+        :param feature_set: One of the keys of feature_sets (kline, futur, depth)
+        """
+        self.features = features
+        self.prefix = feature_sets[feature_set]["prefix"]
+        self.base_window = feature_sets[feature_set]["base_window"]
+
+        self.outputs = []  # Tuples (name, family, column, window)
+        self.mean_windows = {}  # Column -> windows. All windows of one column use shared prefix sums
+        self.std_windows = {}  # Column -> windows
+
+        for name in features:
+            family, column, w = parse_feature(name, self.prefix)
+            if family == "weighted":
+                weight = self.prefix + "volume"
+                self._add_windows(self.mean_windows, column + "*" + weight, w)
+                self._add_windows(self.mean_windows, weight, w)
+            elif family == "mean":
+                self._add_windows(self.mean_windows, column, w)
+            elif family == "std":
+                self._add_windows(self.std_windows, column, w)
+            self.outputs.append((name, family, column, w))
+
+    def _add_windows(self, windows: dict, column: str, w: int):
+        windows.setdefault(column, set()).update([w, self.base_window])
+
+    def execute(self, df, workers: int = 1, dtype=None):
+        """
+        Compute the features and add them as new columns to the data frame.
+        Independent aggregations and features are computed by a pool of threads if workers is greater than 1.
+        The order of the added columns does not depend on the number of workers.
+        All computations are done in float64 and the features are stored with the specified dtype (if any).
+
+        :return: List of added feature names
+        """
+        columns = {}  # Source and derived columns (arrays)
+
+        def get_column(name):
+            if name not in columns:
+                if "*" in name:
+                    a, b = name.split("*")
+                    columns[name] = get_column(a) * get_column(b)
+                elif name[len(self.prefix):] in derived_columns and name not in df.columns:
+                    a, op, b = derived_columns[name[len(self.prefix):]]
+                    a, b = get_column(self.prefix + a), get_column(self.prefix + b)
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        columns[name] = a - b if op == "-" else a / b
+                else:
+                    columns[name] = df[name].values.astype(float)
+            return columns[name]
+
+        # Columns are computed before starting tasks which only read them
+        tasks = []
+        for column, windows in self.mean_windows.items():
+            tasks.append(partial(_means, column, get_column(column), sorted(windows)))
+        for column, windows in self.std_windows.items():
+            tasks.append(partial(_stds, column, get_column(column), sorted(windows)))
+        for name, family, column, w in self.outputs:
+            if family == "area":
+                tasks.append(partial(_area_ratio, name, get_column(column), w))
+            elif family == "trend":
+                tasks.append(partial(_trend, name, get_column(column), w))
+
+        results = {}
+        for result in run_tasks(tasks, workers):
+            results.update(result)
+
+        # Features
+        for name, family, column, w in self.outputs:
+            if family in ["area", "trend"]:
+                feature = results[name]
+            else:
+                if family == "weighted":
+                    weight = self.prefix + "volume"
+                    products = column + "*" + weight
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        value = results[(products, "mean", w)] / results[(weight, "mean", w)]
+                        base = results[(products, "mean", self.base_window)] / results[(weight, "mean", self.base_window)]
+                elif family == "mean":
+                    value = results[(column, "mean", w)]
+                    base = results[(column, "mean", self.base_window)]
+                else:  # std
+                    value = results[(column, "std", w)]
+                    base = results[(column, "std", self.base_window)]
+
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    feature = 100.0 * (value - base) / base
+
+            df[name] = feature if dtype is None else feature.astype(dtype)
+
+        return [output[0] for output in self.outputs]
+
+
+def run_tasks(tasks: list, workers: int = 1):
+    """
+    Call the functions without arguments and return their results in the same order.
+    If workers is greater than 1, they are executed by a pool of threads (rolling kernels release the GIL).
+    """
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+    with ThreadPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+        return list(executor.map(lambda task: task(), tasks))
+
+
+#
+# Tasks. Each of them returns a dict with its results
+#
+
+def _means(column: str, x: np.ndarray, windows: list):
+    """Means for all windows of one column computed from shared prefix sums."""
+    if np.isinf(x).any():
+        return {(column, "mean", w): rolling_aggregate(pd.Series(x), w, np.nanmean, max(1, w // 10)).values for w in windows}
+
+    valid = ~np.isnan(x)
+    sums = window_sums(np.where(valid, x, 0.0), windows)
+    counts = window_sums(valid.astype(float), windows)
+    means = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i, w in enumerate(windows):
+            mean = sums[i] / counts[i]
+            mean[counts[i] < max(1, w // 10)] = np.nan
+            means[(column, "mean", w)] = mean
+    return means
+
+
+def _stds(column: str, x: np.ndarray, windows: list):
+    x = pd.Series(x)
+    return {(column, "std", w): rolling_aggregate(x, w, np.nanstd, max(1, w // 10)).values for w in windows}
+
+
+def _area_ratio(name: str, x: np.ndarray, w: int):
+    return {name: rolling_area_ratio(pd.Series(x), w, max(1, w // 10), is_future=False).values}
+
+
+def _trend(name: str, x: np.ndarray, w: int):
+    return {name: rolling_slope(pd.Series(x), w, max(1, w // 5)).values}
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,306 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+import numpy as np
+import pandas as pd
+
+from common.feature_plan import parse_feature
+
+"""
+Incremental (streaming) computation of kline features.
+It produces the same features as generate_features() but only for the newest kline and without recomputing the whole history.
+The state consists of raw values of the latest klines and running sums for each window which are updated
+in O(1) for each new kline. The state is periodically rebuilt from the stored values in order to avoid accumulation of rounding errors.
+"""
+
+# Column ids of the raw values stored for each kline
+CLOSE, VOLUME, SPAN, TRADES, TB_BASE, TB_QUOTE = range(6)
+
+# Ids of the terms aggregated over windows (computed from raw values)
+T_CLOSE_VOLUME, T_VOLUME, T_CLOSE_DEV, T_CLOSE_DEV2, T_SPAN, T_TRADES, T_TB_BASE, T_TB_QUOTE = range(8)
+
+# Features with the mean of a column relative to its mean for the base window
+mean_terms = {"volume": T_VOLUME, "span": T_SPAN, "trades": T_TRADES, "tb_base": T_TB_BASE, "tb_quote": T_TB_QUOTE}
+
+
+class StreamingFeatures:
+    """
+    Kline features (listed in App.config["features_kline"]) computed incrementally for the newest kline.
+
+    Usage: call update() for each new kline (in the order of their timestamps) and then get_features() to get the feature values of the last kline.
+    """
+
+    def __init__(self, features: list, base_window: int = 1440, rebuild_period: int = None):
+        """
+        :param features: Names of features to be computed like "close_5" or "close_trend_60"
+        :param base_window: Window of the mean and std values used to compute relative features
+        :param rebuild_period: Number of updates after which all running sums are recomputed from the stored values
+        """
+        self.features = features
+        self.base_window = base_window
+
+        self.specs = [parse_kline_feature(name) for name in features]
+
+        aggregation_windows = {base_window}
+        self.area_windows = set()
+        trend_windows = set()
+        for family, column, w in self.specs:
+            if family in ["weighted", "std", "mean"]:
+                aggregation_windows.add(w)
+            elif family == "area":
+                self.area_windows.add(w)
+            elif family == "trend":
+                trend_windows.add(w)
+
+        self.windows = np.array(sorted(aggregation_windows))
+        self.window_ids = {w: i for i, w in enumerate(self.windows)}
+        self.trend_windows = np.array(sorted(trend_windows), dtype=float)
+        self.trend_window_ids = {int(w): i for i, w in enumerate(self.trend_windows)}
+
+        self.history = max([base_window] + list(self.area_windows) + list(trend_windows)) + 1  # Also the element which leaves windows
+        self.rebuild_period = rebuild_period or self.history
+
+        self.reset()
+
+    def reset(self):
+        """Forget all klines."""
+        self.values = np.full((6, 2 * self.history), np.nan)  # Raw values of the latest klines (last ones are at the end)
+        self.length = 0
+        self.last_timestamp = None
+        self.anchor = None  # Close price subtracted from closes to reduce cancellation in sums of squares
+        self.updates = 0  # Since the last rebuild
+
+        shape = (8, len(self.windows))
+        self.sums = np.zeros(shape)
+        self.counts = np.zeros(shape)
+        self.infs = np.zeros(shape)  # Number of infinite values. Such windows are aggregated directly
+
+        # Regression accumulators for positions k and (anchored) closes y: sums of 1, k, k*k, y, k*y
+        self.trends = np.zeros((5, len(self.trend_windows)))
+
+    #
+    # Update
+    #
+
+    def update(self, kline: list):
+        """
+        Add a new kline given as a list of values (as returned by API). Klines which are not newer than the last added kline are ignored.
+
+        :return: True if the kline was added and False if it was ignored
+        """
+        timestamp = int(kline[0])
+        if self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            return False
+
+        row = kline_to_values(kline)
+
+        if self.length == self.values.shape[1]:  # Move the latest values to the start of the buffer
+            self.values[:, :self.history] = self.values[:, -self.history:]
+            self.length = self.history
+        self.values[:, self.length] = row
+        self.length += 1
+        self.last_timestamp = timestamp
+
+        self.updates += 1
+        if self.anchor is None or self.updates >= self.rebuild_period:
+            self.rebuild()
+            return True
+
+        #
+        # Add the new value to all windows and remove the value which leaves each window
+        #
+        terms = self._terms(row[:, None])[:, 0]
+        self._accumulate(np.repeat(terms[:, None], len(self.windows), axis=1), +1)
+
+        old_ids = self.length - 1 - self.windows
+        old_terms = np.full((8, len(self.windows)), np.nan)
+        has_old = old_ids >= 0
+        old_terms[:, has_old] = self._terms(self.values[:, old_ids[has_old]])
+        self._accumulate(old_terms, -1)
+
+        #
+        # Trends: remove the oldest value (position 0), shift positions by -1, and add the new value at the last position
+        #
+        if len(self.trend_windows):
+            s0, s1, s2, sy, sky = self.trends
+
+            old_ids = self.length - 1 - self.trend_windows.astype(int)
+            old_y = np.full(len(self.trend_windows), np.nan)
+            old_y[old_ids >= 0] = self.values[CLOSE, old_ids[old_ids >= 0]] - self.anchor
+            old_valid = ~np.isnan(old_y)
+            s0 -= old_valid
+            sy -= np.where(old_valid, old_y, 0.0)
+
+            s2 += s0 - 2 * s1
+            s1 -= s0
+            sky -= sy
+
+            y = row[CLOSE] - self.anchor
+            if not np.isnan(y):
+                k = self.trend_windows - 1
+                s0 += 1
+                s1 += k
+                s2 += k * k
+                sy += y
+                sky += k * y
+
+        return True
+
+    def rebuild(self):
+        """Recompute all running sums from the stored values."""
+        self.updates = 0
+
+        closes = self.values[CLOSE, :self.length]
+        valid_closes = closes[~np.isnan(closes)]
+        self.anchor = valid_closes[-1] if len(valid_closes) else 0.0
+
+        for i, w in enumerate(self.windows):
+            terms = self._terms(self._window(w))
+            valid = ~np.isnan(terms)
+            finite = np.isfinite(terms)
+            self.sums[:, i] = np.where(finite, terms, 0.0).sum(axis=1)
+            self.counts[:, i] = valid.sum(axis=1)
+            self.infs[:, i] = (valid & ~finite).sum(axis=1)
+
+        for i, w in enumerate(self.trend_windows.astype(int)):
+            y = self._window(w)[CLOSE] - self.anchor
+            k = np.arange(w - len(y), w, dtype=float)  # Positions end with w-1
+            valid = ~np.isnan(y)
+            k = k[valid]
+            y = y[valid]
+            self.trends[:, i] = [len(k), k.sum(), (k * k).sum(), y.sum(), (k * y).sum()]
+
+    def _window(self, w: int):
+        """Raw values of the last w klines (fewer if not enough klines)."""
+        return self.values[:, max(0, self.length - w):self.length]
+
+    def _terms(self, values: np.ndarray):
+        """Terms aggregated over windows for the raw values. Columns of the input are klines."""
+        close_dev = values[CLOSE] - self.anchor
+        return np.stack([
+            values[CLOSE] * values[VOLUME],
+            values[VOLUME],
+            close_dev,
+            close_dev * close_dev,
+            values[SPAN],
+            values[TRADES],
+            values[TB_BASE],
+            values[TB_QUOTE],
+        ])
+
+    def _accumulate(self, terms: np.ndarray, sign: int):
+        valid = ~np.isnan(terms)
+        finite = np.isfinite(terms)
+        self.sums += sign * np.where(finite, terms, 0.0)
+        self.counts += sign * valid
+        self.infs += sign * (valid & ~finite)
+
+    #
+    # Features
+    #
+
+    def get_features(self):
+        """
+        Compute features of the last kline from the current state.
+
+        :return: dict with feature names as keys and their values
+        """
+        min_periods = np.maximum(1, self.windows // 10)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = self.sums / self.counts
+            means[self.counts < min_periods] = np.nan
+            for t, i in zip(*np.nonzero(self.infs > 0)):  # Infinite values are aggregated in the same way as by np.nanmean
+                terms = self._terms(self._window(self.windows[i]))[t]
+                means[t, i] = np.nanmean(terms) if len(terms[~np.isnan(terms)]) >= min_periods[i] else np.nan
+
+            weighted = means[T_CLOSE_VOLUME] / means[T_VOLUME]
+
+            n = self.counts[T_CLOSE_DEV]
+            variance = (self.sums[T_CLOSE_DEV2] - self.sums[T_CLOSE_DEV] ** 2 / n) / n
+            std = np.sqrt(np.maximum(variance, 0.0))
+            std[n < min_periods] = np.nan
+
+            s0, s1, s2, sy, sky = self.trends
+            denominator = s0 * s2 - s1 * s1
+            slopes = np.where(denominator > 0, (s0 * sky - s1 * sy) / denominator, 0.0)
+            slopes[s0 < np.maximum(1, self.trend_windows.astype(int) // 5)] = np.nan
+
+            base = self.window_ids[self.base_window]
+
+            def relative(values, i):
+                return 100.0 * (values[i] - values[base]) / values[base]
+
+            features = {}
+            for name, (family, column, w) in zip(self.features, self.specs):
+                if family == "weighted":
+                    value = relative(weighted, self.window_ids[w])
+                elif family == "std":
+                    value = relative(std, self.window_ids[w])
+                elif family == "mean":
+                    value = relative(means[mean_terms[column]], self.window_ids[w])
+                elif family == "area":
+                    value = self._area_ratio(w)
+                else:  # trend
+                    value = slopes[self.trend_window_ids[w]]
+                features[name] = float(value)
+
+        return features
+
+    def _area_ratio(self, w: int):
+        x = self._window(w)[CLOSE]
+        if len(x) < max(1, w // 10) or np.isnan(x).any():
+            return np.nan
+        x_diff = x - x[-1]
+        return x_diff.sum() / np.absolute(x_diff).sum()
+
+
+def parse_kline_feature(name: str):
+    """
+    Parse the name of a kline feature generated by generate_features().
+
+    :return: tuple with feature family, column and window
+    """
+    try:
+        family, column, w = parse_feature(name)
+    except ValueError:
+        family, column = None, None
+    if column != "close" and (family != "mean" or column not in mean_terms):
+        raise ValueError(f"Unknown kline feature '{name}'. It cannot be computed incrementally.")
+    return family, column, w
+
+
+def kline_to_values(kline: list):
+    """Convert one kline (list of values as returned by API) to an array of raw values used for feature generation."""
+    high = float(kline[2])
+    low = float(kline[3])
+    close = float(kline[4])
+    volume = float(kline[5])
+    quote_av = float(kline[7])
+    trades = float(kline[8])
+    tb_base_av = float(kline[9])
+    tb_quote_av = float(kline[10])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tb_base = np.float64(tb_base_av) / volume
+        tb_quote = np.float64(tb_quote_av) / quote_av
+
+    return np.array([close, volume, high - low, trades, tb_base, tb_quote])
+
+
+def compare_features(expected: dict, actual: dict, rtol: float = 1e-6, atol: float = 1e-8):
+    """
+    Compare two feature vectors, for example, computed in batch and incrementally.
+
+    :return: dict of features with different values (both nans are equal). Values are pairs of expected and actual values.
+    """
+    mismatches = {}
+    for name, value in expected.items():
+        other = actual.get(name, np.nan)
+        if pd.isna(value) and pd.isna(other):
+            continue
+        if pd.isna(value) or pd.isna(other) or not np.isclose(other, value, rtol=rtol, atol=atol):
+            mismatches[name] = (value, other)
+    return mismatches
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,72 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+import sys
+import time
+import builtins
+
+"""
+Measure how long it takes to import modules at start up (the same as "python -X importtime" but as a sorted report).
+Profiling is switched on by the command line flag --profile-imports and it has to be started before the imports to be measured.
+Cumulative time of a module includes the modules it imports while self time does not.
+"""
+
+_original_import = None
+
+_profile = {}  # Key is module name, value is list [cumulative seconds, self seconds]
+_stack = []  # Time spent in nested imports of the modules being imported (one element per import level)
+
+
+def start_import_profile(argv: list = None):
+    """Start measuring imports if the command line has the --profile-imports flag. Return True if profiling has started."""
+    global _original_import
+    if "--profile-imports" not in (sys.argv if argv is None else argv):
+        return False
+    if _original_import is None:
+        _original_import = builtins.__import__
+        builtins.__import__ = _profiled_import
+    return True
+
+
+def stop_import_profile():
+    global _original_import
+    if _original_import is not None:
+        builtins.__import__ = _original_import
+        _original_import = None
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:  # Relative imports and imported modules are not measured
+        return _original_import(name, globals, locals, fromlist, level)
+
+    _stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        times = _profile.setdefault(name, [0.0, 0.0])
+        times[0] += elapsed
+        times[1] += elapsed - nested
+
+
+def get_import_profile():
+    """List of tuples (module, cumulative seconds, self seconds) ordered by cumulative time."""
+    return sorted(((name, t[0], t[1]) for name, t in _profile.items()), key=lambda x: x[1], reverse=True)
+
+
+def print_import_profile(top: int = 20):
+    """Print the slowest imports and stop profiling."""
+    stop_import_profile()
+    profile = get_import_profile()
+    if not profile:
+        return
+    total = sum(t[2] for t in profile)
+    print(f"Imported {len(profile)} modules in {total:.2f} seconds. Slowest imports (cumulative and self seconds):")
+    for name, cumulative, self_time in profile[:top]:
+        print(f"{cumulative:8.3f} {self_time:8.3f}  {name}")
+
+
+if __name__ == "__main__":
+    pass
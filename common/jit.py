@@ -0,0 +1,154 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+import os
+from importlib.util import find_spec
+
+import numpy as np
+
+"""
+Optional JIT compilation of per-row kernels (rolling windows, order book and tree ensembles) with numba.
+It is switched on by App.config["jit"] or by the environment variable ITB_JIT=1.
+If numba is not installed, then the kernels are not used and the NumPy (or Python) implementations are used instead.
+Numba is imported only when the first kernel is compiled. Kernels are compiled on first use. Call warm_up() in advance to avoid compilation delays at run time.
+"""
+
+_enabled = os.environ.get("ITB_JIT", "").lower() in ["1", "true", "yes"]
+
+_kernels = {}  # Compiled kernels. Key is kernel name
+
+_numba_available = find_spec("numba") is not None
+
+
+def enable_jit(enabled: bool = True):
+    """Switch JIT kernels on or off. Return True if they are going to be used (numba is available)."""
+    global _enabled
+    _enabled = bool(enabled)
+    return jit_enabled()
+
+
+def jit_enabled():
+    return _enabled and _numba_available
+
+
+def get_kernel(name: str):
+    """Compiled version of the kernel with the specified name."""
+    kernel = _kernels.get(name)
+    if kernel is None:
+        import numba
+        kernel = numba.njit(cache=True, nogil=True, error_model="numpy")(_python_kernels[name])
+        _kernels[name] = kernel
+    return kernel
+
+
+def warm_up():
+    """Compile all kernels by calling them with small inputs. Return False if JIT is not enabled."""
+    if not jit_enabled():
+        return False
+    x = np.array([1.0, 2.0, np.nan, 1.5, 0.5])
+    get_kernel("area_ratio")(x, 2, 1, False)
+    get_kernel("discretize")(np.array([1.0, 1.5, 3.0]), np.array([1.0, 2.0, 3.0]), 1.0, 1.0, 3, True)
+    leaf = np.array([-1], dtype=np.int32)
+    get_kernel("tree_ensemble")(x[None, :], np.array([0], dtype=np.int32), leaf, np.zeros(1), leaf, leaf, np.zeros(1), np.zeros(1, dtype=bool), np.zeros(1, dtype=np.int8))
+    return True
+
+
+#
+# Kernels (Python code compiled by numba)
+#
+
+def _area_ratio_kernel(x, window, min_periods, is_future):
+    """Same as rolling_area_ratio() but with explicit loops over rows and window elements."""
+    n = len(x)
+    ratio = np.full(n, np.nan)
+    for i in range(n):
+        if is_future:
+            start, end = i, i + window
+            if end > n:
+                continue
+        else:
+            start, end = max(0, i - window + 1), i + 1
+            if end - start < min_periods:
+                continue
+        level = x[i]
+        a = 0.0
+        b = 0.0
+        for j in range(start, end):
+            diff = x[j] - level
+            a += diff
+            b += abs(diff)
+        if np.isnan(a):  # The window has nans
+            continue
+        ratio[i] = a / b
+    return ratio
+
+
+def _discretize_kernel(prices, volumes, start, bin_size, bin_count, price_increase):
+    """
+    Same as discretize() but in one pass over points and bins.
+    Volume of a point is used from its price till the next point. Before the first point, the volume is 0.
+    """
+    n = len(prices)
+    bin_volumes = np.zeros(bin_count)
+    i = 0
+    prev_volume = 0.0
+    for b in range(bin_count):
+        if price_increase:
+            bin_start = start + b*bin_size
+            bin_end = bin_start + bin_size
+        else:
+            bin_start = start - b*bin_size
+            bin_end = bin_start - bin_size
+
+        # Points before this bin only define the initial volume
+        while i < n and (prices[i] < bin_start if price_increase else prices[i] > bin_start):
+            prev_volume = volumes[i]
+            i += 1
+
+        prev_price = bin_start
+        bin_volume = 0.0
+        while i < n and (prices[i] < bin_end if price_increase else prices[i] > bin_end):
+            price_coeff = abs(prices[i] - prev_price) / bin_size  # Portion of this interval in bin
+            bin_volume += prev_volume * price_coeff
+            prev_price = prices[i]
+            prev_volume = volumes[i]
+            i += 1
+
+        # Last point contributes till the end of this bin
+        price_coeff = abs(bin_end - prev_price) / bin_size
+        bin_volume += prev_volume * price_coeff
+
+        bin_volumes[b] = bin_volume
+    return bin_volumes
+
+
+def _tree_ensemble_kernel(x, roots, feature, threshold, left, right, value, default_left, missing_type):
+    """Sum of leaf values of all trees for each row (TreeModel in flat arrays). Missing types: 0 None, 1 Zero, 2 NaN."""
+    n = x.shape[0]
+    raw = np.zeros(n)
+    for i in range(n):
+        total = 0.0
+        for root in roots:
+            node = root
+            while feature[node] >= 0:
+                v = x[i, feature[node]]
+                is_nan = np.isnan(v)
+                if is_nan and missing_type[node] != 2:
+                    v = 0.0
+                if (missing_type[node] == 1 and abs(v) <= 1e-35) or (missing_type[node] == 2 and is_nan):
+                    go_left = default_left[node]
+                else:
+                    go_left = v <= threshold[node]
+                node = left[node] if go_left else right[node]
+            total += value[node]
+        raw[i] = total
+    return raw
+
+
+_python_kernels = {
+    "area_ratio": _area_ratio_kernel,
+    "discretize": _discretize_kernel,
+    "tree_ensemble": _tree_ensemble_kernel,
+}
+
+
+if __name__ == "__main__":
+    pass
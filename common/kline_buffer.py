@@ -0,0 +1,207 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+
+import numpy as np
+import pandas as pd
+
+"""
+Columnar buffer of the latest klines of one symbol.
+Klines are parsed once when they are added and stored in preallocated arrays (one array for each column).
+The storage is twice as long as the capacity and the latest klines are moved to its start only when it is full,
+so that the stored klines are always contiguous and windows are returned as views (without copying).
+The buffer is a regular 1m time series: the position of a kline is computed from its timestamp
+and klines which have not been received (gaps) are rows with nan values.
+"""
+
+interval = 60_000  # Milliseconds between timestamps of klines
+
+# Columns of klines as returned by API (the last column "ignore" is not stored)
+kline_columns = [
+    'timestamp',
+    'open', 'high', 'low', 'close', 'volume',
+    'close_time',
+    'quote_av', 'trades', 'tb_base_av', 'tb_quote_av',
+]
+
+time_columns = ['timestamp', 'close_time']  # Integer milliseconds
+
+
+class KlineBuffer:
+    """
+    The latest klines (at most capacity) ordered by timestamp.
+    """
+
+    def __init__(self, capacity: int, dtype=np.float64):
+        """
+        :param capacity: Maximum number of stored klines (older klines are removed)
+        :param dtype: Type of value columns (prices, volumes etc.)
+        """
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.arrays = {
+            name: np.zeros(2 * capacity, dtype=np.int64 if name in time_columns else self.dtype)
+            for name in kline_columns
+        }
+        self.received = np.zeros(2 * capacity, dtype=bool)  # False for gaps
+        self.start = 0
+        self.end = 0
+        self.missing = 0  # Number of gaps (rows with not received klines)
+        self.history_changed = False  # Whether the last upsert filled or created gaps or changed stored klines (not only appended klines)
+
+    def __len__(self):
+        return self.end - self.start
+
+    #
+    # Update
+    #
+
+    def upsert(self, klines: list):
+        """
+        Store klines (lists of values as returned by API) by overwriting klines with the same timestamps.
+        Positions are computed from timestamps so the cost does not depend on the number of stored klines.
+        Klines after the last stored kline extend the buffer (with gaps if they are not adjacent) and the oldest klines exceeding the capacity are removed.
+        Klines older than the first stored kline are ignored.
+        The flag history_changed is set if the klines filled or created gaps or overwrote klines with other values.
+
+        :return: Number of stored klines
+        """
+        self.history_changed = False
+        if not klines:
+            return 0
+        values = np.array([kline[:len(kline_columns)] for kline in klines], dtype=np.float64)  # Strings are parsed here
+        timestamps = values[:, 0].astype(np.int64)
+
+        first_timestamp = int(self.arrays["timestamp"][self.start]) if len(self) else int(timestamps.min())
+        offsets = timestamps - first_timestamp
+        is_regular = (offsets >= 0) & (offsets % interval == 0)
+        values, timestamps = values[is_regular], timestamps[is_regular]
+        if not len(values):
+            return 0
+
+        # Klines for existing rows change the history if they fill gaps or have other values
+        old_last_timestamp = self.last_timestamp() if len(self) else None
+        if old_last_timestamp is not None:
+            is_old = timestamps <= old_last_timestamp
+            old_ids = (timestamps[is_old] - first_timestamp) // interval + self.start
+            self.history_changed = not self.received[old_ids].all() or any(
+                not np.array_equal(self.arrays[name][old_ids], values[is_old, i].astype(self.dtype), equal_nan=True)
+                for i, name in enumerate(kline_columns) if name not in time_columns
+            )
+
+        last_timestamp = int(timestamps.max())
+        if len(self) and last_timestamp > self.last_timestamp():
+            self._extend((last_timestamp - self.last_timestamp()) // interval)
+        elif not len(self):
+            self._extend((last_timestamp - first_timestamp) // interval + 1, first_timestamp)
+
+        ids = (timestamps - int(self.arrays["timestamp"][self.start])) // interval + self.start
+        is_stored = ids >= self.start  # Too old klines could be removed by extension
+        ids, values = ids[is_stored], values[is_stored]
+
+        for i, name in enumerate(kline_columns):
+            self.arrays[name][ids] = values[:, i]
+        self.missing -= int((~self.received[np.unique(ids)]).sum())
+        self.received[ids] = True
+
+        # New rows which are still gaps
+        new_count = len(self) if old_last_timestamp is None else min((self.last_timestamp() - old_last_timestamp) // interval, len(self))
+        if not self.received[self.end - new_count:self.end].all():
+            self.history_changed = True
+
+        return len(ids)
+
+    def _extend(self, count: int, first_timestamp: int = None):
+        """Add rows for the next timestamps (gaps till klines are stored) and remove the oldest rows exceeding the capacity."""
+        if first_timestamp is None:
+            first_timestamp = self.last_timestamp() + interval
+
+        if count >= self.capacity:  # All existing rows are removed
+            first_timestamp += (count - self.capacity) * interval
+            count = self.capacity
+            self.start, self.end, self.missing = 0, 0, 0
+        elif self.end + count > len(self.received):  # Move the latest rows to the start of the storage
+            keep = min(len(self), self.capacity - count)
+            self.missing -= int((~self.received[self.start:self.end - keep]).sum())  # Removed rows
+            for array in list(self.arrays.values()) + [self.received]:
+                array[:keep] = array[self.end - keep:self.end]
+            self.start, self.end = 0, keep
+
+        new = slice(self.end, self.end + count)
+        timestamps = first_timestamp + np.arange(count, dtype=np.int64) * interval
+        for name, array in self.arrays.items():
+            array[new] = np.nan if name not in time_columns else timestamps
+        self.arrays["close_time"][new] += interval - 1
+        self.received[new] = False
+        self.missing += count
+        self.end += count
+
+        to_delete = len(self) - self.capacity
+        if to_delete > 0:
+            self.missing -= int((~self.received[self.start:self.start + to_delete]).sum())
+            self.start += to_delete
+
+    def gaps(self):
+        """
+        Ranges of timestamps of klines which are missing in the buffer (have not been received).
+
+        :return: list of tuples with the first and the last timestamp (inclusive) of each range
+        """
+        if not self.missing:
+            return []
+        received = self.received[self.start:self.end]
+        timestamps = self.arrays["timestamp"][self.start:self.end]
+        changes = np.flatnonzero(np.diff(np.concatenate([[True], received, [True]]).astype(np.int8)))  # Borders of gaps
+        return [(int(timestamps[a]), int(timestamps[b - 1])) for a, b in zip(changes[0::2], changes[1::2])]
+
+    #
+    # Access
+    #
+
+    def view(self, name: str, last: int = None):
+        """Read-only array of the column values of the stored klines (or only the last ones). It is not a copy."""
+        array = self.arrays[name][self.start:self.end]
+        if last is not None:
+            array = array[max(len(array) - last, 0):]
+        array = array.view()
+        array.flags.writeable = False
+        return array
+
+    def last_timestamp(self):
+        return int(self.arrays["timestamp"][self.end - 1]) if len(self) else 0
+
+    def last_kline(self):
+        """The last kline as a list of values in the same order as returned by API (or None)."""
+        if not len(self):
+            return None
+        return self.to_klines(last=1)[0]
+
+    def to_klines(self, last: int = None):
+        """
+        Stored klines (or only the last ones) as lists of values in the same order as returned by API.
+        Gaps are klines with nan values (except for the time columns).
+        """
+        rows = zip(*[self.view(name, last) for name in kline_columns])
+        trades = kline_columns.index("trades")
+        klines = []
+        for row in rows:
+            kline = [int(v) if name in time_columns else float(v) for name, v in zip(kline_columns, row)]
+            if not np.isnan(kline[trades]):
+                kline[trades] = int(kline[trades])
+            klines.append(kline)
+        return klines
+
+    def to_df(self, last: int = None):
+        """
+        Data frame with the same columns as klines_to_df() (except for "ignore") for the stored klines (or only the last ones).
+        Columns are created from the views without parsing.
+        """
+        columns = {}
+        for name in kline_columns:
+            values = self.view(name, last)
+            columns[name] = pd.to_datetime(values, unit='ms') if name in time_columns else values
+        df = pd.DataFrame(columns)
+        df.set_index('timestamp', inplace=True)
+        return df
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,174 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+import os
+import io
+import json
+import mmap
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from joblib import dump, load
+
+from common.numpy_models import MlpModel, TreeModel, LinearModel
+
+"""
+Model bundle: one file with all model pairs of a label x feature set x algorithm grid.
+The file starts with a JSON manifest (format version, grid, models and their arrays with dtype, shape, offset and SHA-256 hash)
+followed by the aligned raw data of the arrays. Loaded arrays are read-only views of the memory-mapped file (they are not copied),
+hence only used pages are read and processes loading the same bundle on one host share these pages (in the page cache).
+Models are stored as NumPy models (see numpy_models) and evaluated without TensorFlow, LightGBM or scikit-learn.
+Other models (e.g., with non-standard scalers) are stored as pickled model pairs.
+"""
+
+magic = b"ITBMODEL"
+bundle_version = 1
+alignment = 64  # Offsets of arrays are multiples of it
+
+model_kinds = {"mlp": MlpModel, "trees": TreeModel, "linear": LinearModel}
+
+
+#
+# Write
+#
+
+def save_model_bundle(file, models: dict, grid: dict = None):
+    """
+    Write model pairs to a bundle file. The file is replaced atomically so that running processes can continue using the old version.
+
+    :param models: Dict with score column names as keys (ending with the algorithm like "_gb") and model pairs as values
+    :param grid: Parameters of the models (like labels, feature sets and algorithms) stored in the manifest
+    """
+    file = Path(file)
+    entries, payloads = {}, []
+    offset = 0
+    for name, model_pair in models.items():
+        kind, arrays = _to_arrays(name, model_pair)
+        entry = {"kind": kind, "arrays": {}}
+        for array_name, a in arrays.items():
+            a = np.asarray(a)
+            if a.dtype.hasobject:
+                raise ValueError(f"Array '{array_name}' of model '{name}' has objects and cannot be stored.")
+            data = a.tobytes()  # C order
+            entry["arrays"][array_name] = {
+                "dtype": a.dtype.str, "shape": list(a.shape), "offset": offset, "size": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            }
+            payloads.append(data)
+            offset = _align(offset + len(data))
+        entry["sha256"] = _model_hash(entry)
+        entries[name] = entry
+
+    manifest = {"version": bundle_version, "grid": grid or {}, "models": entries}
+    header = json.dumps(manifest).encode("utf-8")
+    data_start = _align(len(magic) + 8 + len(header))  # Array offsets in the manifest are relative to it
+
+    tmp_file = file.with_name(file.name + ".tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(magic)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for data in payloads:
+            f.write(b"\0" * (_align(f.tell()) - f.tell()))
+            f.write(data)
+    os.replace(tmp_file, file)
+
+    return manifest
+
+
+def _to_arrays(name: str, model_pair: tuple):
+    """Kind and arrays of a model pair (NumPy model with the scaler included or pickled pair)."""
+    model, scaler = model_pair
+    try:
+        if isinstance(model, (MlpModel, TreeModel, LinearModel)) and scaler is None:
+            pass
+        elif name.endswith("_nn"):
+            model = MlpModel.from_keras(model, scaler)
+        elif name.endswith("_gb"):
+            model = TreeModel.from_booster(model, scaler)
+        elif name.endswith("_lc") and hasattr(model, "coef_"):
+            model = LinearModel.from_sklearn(model, scaler)
+        else:
+            model = None
+    except ValueError:  # The model or its scaler cannot be converted
+        model = None
+
+    if model is None:
+        buffer = io.BytesIO()
+        dump(model_pair, buffer)
+        return "pickle", {"pair": np.frombuffer(buffer.getvalue(), dtype=np.uint8)}
+    kind = next(k for k, cls in model_kinds.items() if isinstance(model, cls))
+    return kind, model.to_arrays()
+
+
+def _align(offset: int):
+    return -(-offset // alignment) * alignment
+
+
+def _model_hash(entry: dict):
+    """Hash of a model computed from the hashes of its arrays (equal models in different bundles have equal hashes)."""
+    h = hashlib.sha256(entry["kind"].encode())
+    for array_name, info in sorted(entry["arrays"].items()):
+        h.update(f"{array_name}:{info['dtype']}:{info['shape']}:{info['sha256']}".encode())
+    return h.hexdigest()
+
+
+#
+# Read
+#
+
+def read_manifest(file):
+    """Manifest of a bundle file (without reading the arrays)."""
+    with open(file, "rb") as f:
+        manifest, _ = _read_header(f)
+    return manifest
+
+
+def _read_header(f):
+    if f.read(len(magic)) != magic:
+        raise ValueError(f"File '{f.name}' is not a model bundle.")
+    header_size = int.from_bytes(f.read(8), "little")
+    manifest = json.loads(f.read(header_size).decode("utf-8"))
+    if manifest.get("version") != bundle_version:
+        raise ValueError(f"Model bundle version {manifest.get('version')} is not supported. Supported version: {bundle_version}.")
+    return manifest, _align(len(magic) + 8 + header_size)
+
+
+def load_model_bundle(file, names: list = None, verify: bool = True, max_workers: int = None):
+    """
+    Load model pairs from a bundle file. Models are created in parallel from memory-mapped arrays.
+
+    :param names: Score column names of the models to load (all models if None). Error if some of them are not in the bundle
+    :param verify: Check hashes of the arrays (it reads all the arrays of the loaded models)
+    :return: Dict with score column names as keys and model pairs (with None instead of scalers) as values
+    """
+    with open(file, "rb") as f:
+        manifest, data_start = _read_header(f)
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # Remains open while arrays reference it
+
+    entries = manifest["models"]
+    names = list(entries.keys()) if names is None else list(names)
+    missing = [name for name in names if name not in entries]
+    if missing:
+        raise ValueError(f"Models {missing} are not in the bundle '{file}'. Bundle models: {list(entries.keys())}.")
+
+    def load_model(name):
+        entry = entries[name]
+        arrays = {}
+        for array_name, info in entry["arrays"].items():
+            view = memoryview(buffer)[data_start + info["offset"]:data_start + info["offset"] + info["size"]]
+            if verify and hashlib.sha256(view).hexdigest() != info["sha256"]:
+                raise ValueError(f"Array '{array_name}' of model '{name}' in the bundle '{file}' is corrupted (wrong hash).")
+            arrays[array_name] = np.frombuffer(view, dtype=np.dtype(info["dtype"])).reshape(tuple(info["shape"]))
+        if entry["kind"] == "pickle":
+            return load(io.BytesIO(arrays["pair"].tobytes()))
+        return (model_kinds[entry["kind"]].from_arrays(arrays), None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:  # Hashing and NumPy release the GIL
+        pairs = list(executor.map(load_model, names))
+
+    return dict(zip(names, pairs))
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,397 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+from pathlib import Path
+
+import numpy as np
+from scipy.special import expit
+
+from common.jit import jit_enabled, get_kernel
+
+"""
+Evaluation of trained models with NumPy only (without TensorFlow and LightGBM).
+Models are exported to compact .npz files (or model bundles) as dicts of arrays with their parameters and the parameters of their scaler.
+Loaded models have the same predict() interface as the original models and scale the input themselves
+(hence, they are used in model pairs without a scaler).
+"""
+
+activations = {
+    "sigmoid": expit,
+    "relu": lambda x: np.maximum(x, 0.0),
+    "tanh": np.tanh,
+    "linear": lambda x: x,
+}
+
+
+def standard_parameters(scaler):
+    """Mean and scale applied by a StandardScaler (or None) as arrays (zero and one if they are switched off)."""
+    if scaler is None:
+        return None, None
+    n = scaler.n_features_in_
+    mean = scaler.mean_ if scaler.with_mean else np.zeros(n)
+    scale = scaler.scale_ if scaler.with_std else np.ones(n)
+    return np.asarray(mean, dtype=float), np.asarray(scale, dtype=float)
+
+
+#
+# MLP (NN)
+#
+
+class MlpModel:
+    """
+    Multi-layer perceptron with dense layers evaluated by matrix products.
+    """
+
+    def __init__(self, kernels: list, biases: list, activation_names: list, mean=None, scale=None):
+        """
+        :param kernels: Weight matrices of the layers (inputs x outputs)
+        :param biases: Bias vectors of the layers
+        :param activation_names: Activation function of each layer (keys of activations)
+        :param mean: Mean subtracted from the input (if any)
+        :param scale: Scale dividing the input (if any)
+        """
+        for name in activation_names:
+            if name not in activations:
+                raise ValueError(f"Activation '{name}' is not supported. Supported activations: {list(activations.keys())}.")
+        self.kernels = [np.asarray(k, dtype=float) for k in kernels]
+        self.biases = [np.asarray(b, dtype=float) for b in biases]
+        self.activation_names = [str(name) for name in activation_names]
+        self.mean = None if mean is None else np.asarray(mean, dtype=float)
+        self.scale = None if scale is None else np.asarray(scale, dtype=float)
+
+    def predict(self, X):
+        """Outputs of the network as a matrix with one row for each input row (like keras predict())."""
+        x = np.asarray(X, dtype=float)
+        if self.mean is not None:
+            x = x - self.mean
+        if self.scale is not None:
+            x = x / self.scale
+        for kernel, bias, name in zip(self.kernels, self.biases, self.activation_names):
+            x = activations[name](x @ kernel + bias)
+        return x
+
+    def fold_scaler(self):
+        """Equivalent model without scaling (scaling is included in the weights of the first layer)."""
+        kernel, bias = self.kernels[0], self.biases[0]
+        if self.scale is not None:
+            kernel = kernel / self.scale[:, None]
+        if self.mean is not None:
+            bias = bias - self.mean @ kernel
+        return MlpModel([kernel] + self.kernels[1:], [bias] + self.biases[1:], self.activation_names)
+
+    @staticmethod
+    def from_keras(model, scaler=None):
+        """
+        Weights of a keras model with dense layers (built by train_nn()) and parameters of its scaler.
+        Layers without weights (like dropout) do nothing at inference time and are skipped.
+        """
+        kernels, biases, names = [], [], []
+        for layer in model.layers:
+            weights = layer.get_weights()
+            if not weights:
+                continue
+            if type(layer).__name__ != "Dense":
+                raise ValueError(f"Layer {type(layer).__name__} cannot be exported. Only dense layers are supported.")
+            kernels.append(weights[0])
+            biases.append(weights[1])
+            names.append(layer.get_config()["activation"])
+        mean, scale = standard_parameters(scaler)
+        return MlpModel(kernels, biases, names, mean, scale)
+
+    def to_arrays(self):
+        arrays = {}
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            arrays[f"kernel_{i}"], arrays[f"bias_{i}"] = kernel, bias
+        arrays["activations"] = np.array(self.activation_names)
+        if self.mean is not None:
+            arrays["mean"], arrays["scale"] = self.mean, self.scale
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        """Model from a dict (or npz file) with arrays returned by to_arrays(). Arrays are not copied."""
+        names = list(arrays["activations"])
+        kernels = [arrays[f"kernel_{i}"] for i in range(len(names))]
+        biases = [arrays[f"bias_{i}"] for i in range(len(names))]
+        mean = arrays["mean"] if "mean" in arrays else None
+        scale = arrays["scale"] if "scale" in arrays else None
+        return MlpModel(kernels, biases, names, mean, scale)
+
+    @staticmethod
+    def combine(models: list):
+        """
+        One model which returns the outputs of all the models (for the same input) as columns.
+        The first layers are concatenated and the other layers are block-diagonal.
+        """
+        models = [model.fold_scaler() for model in models]
+        names = models[0].activation_names
+        if any(model.activation_names != names for model in models):
+            raise ValueError(f"Only models with the same layers can be combined.")
+        kernels = [np.hstack([model.kernels[0] for model in models])]
+        for layer in range(1, len(names)):
+            kernels.append(_block_diagonal([model.kernels[layer] for model in models]))
+        biases = [np.concatenate([model.biases[layer] for model in models]) for layer in range(len(names))]
+        return MlpModel(kernels, biases, names)
+
+
+def _block_diagonal(matrices: list):
+    result = np.zeros((sum(m.shape[0] for m in matrices), sum(m.shape[1] for m in matrices)))
+    row, column = 0, 0
+    for m in matrices:
+        result[row:row + m.shape[0], column:column + m.shape[1]] = m
+        row, column = row + m.shape[0], column + m.shape[1]
+    return result
+
+
+def export_nn(model, scaler, file):
+    """Write weights of a keras model with dense layers (built by train_nn()) and parameters of its scaler to a .npz file."""
+    np.savez(file, **MlpModel.from_keras(model, scaler).to_arrays())
+
+
+def load_nn(file):
+    """Load MLP model from a .npz file written by export_nn()."""
+    with np.load(Path(file)) as data:
+        return MlpModel.from_arrays(data)
+
+
+#
+# Gradient boosting trees (GB)
+#
+
+# Missing value types of splits (as in LightGBM)
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+missing_types = {"None": MISSING_NONE, "Zero": MISSING_ZERO, "NaN": MISSING_NAN}
+
+zero_threshold = 1e-35  # Values with smaller magnitude are zero for missing type Zero (as in LightGBM)
+
+tree_arrays = ["roots", "feature", "threshold", "left", "right", "value", "default_left", "missing_type"]
+
+
+class TreeModel:
+    """
+    Ensemble of binary decision trees (LightGBM booster) stored in flat arrays.
+    Nodes of all trees are in the same arrays: split feature (-1 for leaves), threshold, left and right child, leaf value,
+    default direction and missing type. The output is the sum of leaf values transformed by the objective (like Booster.predict()).
+    If all trees are stumps (depth 1), then the sum is a sum of step functions of individual features.
+    Each step function is evaluated for all rows by one binary search in its sorted thresholds.
+    """
+
+    def __init__(self, arrays: dict, objective: str, average_output: bool = False, mean=None, scale=None):
+        self.arrays = {name: np.ascontiguousarray(arrays[name]) for name in tree_arrays}
+        for name, a in self.arrays.items():
+            setattr(self, name, a)
+        self.objective = objective
+        self.average_output = bool(average_output)
+        self.mean = None if mean is None else np.asarray(mean, dtype=float)
+        self.scale = None if scale is None else np.asarray(scale, dtype=float)
+
+        self.transform = _objective_transform(objective)
+
+        # Step functions if all splits are stumps (and zero values are not treated as missing)
+        roots = self.roots
+        is_split = self.feature[roots] >= 0
+        self.is_stumps = bool(
+            (self.feature[self.left[roots[is_split]]] < 0).all() and (self.feature[self.right[roots[is_split]]] < 0).all()
+            and not (self.missing_type == MISSING_ZERO).any()
+        )
+        if self.is_stumps:
+            self._build_steps(roots[is_split], roots[~is_split])
+
+    @staticmethod
+    def from_booster(booster, scaler=None):
+        """Flatten a trained LightGBM booster (and parameters of its scaler)."""
+        mean, scale = standard_parameters(scaler)
+        return TreeModel.from_dump(booster.dump_model(), mean, scale)
+
+    @staticmethod
+    def from_dump(dump: dict, mean=None, scale=None):
+        """Flatten a model dumped to a dict by Booster.dump_model()."""
+        if dump.get("num_class", 1) != 1:
+            raise ValueError(f"Only models with one class can be flattened but the model has {dump.get('num_class')} classes.")
+
+        nodes = {name: [] for name in tree_arrays if name != "roots"}
+
+        def add_node(node):
+            i = len(nodes["feature"])
+            for name in nodes:
+                nodes[name].append(0)
+            if "leaf_value" in node:
+                nodes["feature"][i] = -1
+                nodes["value"][i] = node["leaf_value"]
+                return i
+            if node.get("decision_type", "<=") != "<=":
+                raise ValueError(f"Decision type {node.get('decision_type')} (categorical split) is not supported.")
+            nodes["feature"][i] = node["split_feature"]
+            nodes["threshold"][i] = node["threshold"]
+            nodes["default_left"][i] = node.get("default_left", True)
+            nodes["missing_type"][i] = missing_types[node.get("missing_type", "None")]
+            nodes["left"][i] = add_node(node["left_child"])
+            nodes["right"][i] = add_node(node["right_child"])
+            return i
+
+        roots = [add_node(tree["tree_structure"]) for tree in dump["tree_info"]]
+
+        arrays = dict(
+            roots=np.array(roots, dtype=np.int32),
+            feature=np.array(nodes["feature"], dtype=np.int32),
+            threshold=np.array(nodes["threshold"], dtype=np.float64),
+            left=np.array(nodes["left"], dtype=np.int32),
+            right=np.array(nodes["right"], dtype=np.int32),
+            value=np.array(nodes["value"], dtype=np.float64),
+            default_left=np.array(nodes["default_left"], dtype=bool),
+            missing_type=np.array(nodes["missing_type"], dtype=np.int8),
+        )
+        return TreeModel(arrays, dump.get("objective", "regression"), dump.get("average_output", False), mean, scale)
+
+    def to_arrays(self):
+        arrays = dict(self.arrays, objective=np.array(self.objective), average_output=np.array(self.average_output))
+        if self.mean is not None:
+            arrays["mean"], arrays["scale"] = self.mean, self.scale
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        """Model from a dict (or npz file) with arrays returned by to_arrays(). Arrays are not copied."""
+        mean = arrays["mean"] if "mean" in arrays else None
+        scale = arrays["scale"] if "scale" in arrays else None
+        return TreeModel(
+            {name: arrays[name] for name in tree_arrays}, str(arrays["objective"]), bool(arrays["average_output"]), mean, scale
+        )
+
+    def _build_steps(self, split_roots, leaf_roots):
+        """Sorted thresholds of each feature and sums of value differences (left minus right) for thresholds from each position."""
+        self.base_value = float(self.value[self.right[split_roots]].sum() + self.value[leaf_roots].sum())
+        self.steps = []  # Tuples (feature, sorted thresholds, suffix sums)
+        features = self.feature[split_roots]
+        for f in np.unique(features):
+            roots = split_roots[features == f]
+            order = np.argsort(self.threshold[roots], kind="stable")
+            roots = roots[order]
+            differences = self.value[self.left[roots]] - self.value[self.right[roots]]
+            suffix_sums = np.concatenate([np.cumsum(differences[::-1])[::-1], [0.0]])
+            self.steps.append((int(f), self.threshold[roots], suffix_sums))
+
+    def predict(self, X):
+        """Predictions (transformed by the objective) as a 1d array with one value for each row."""
+        x = np.asarray(X, dtype=float)
+        if self.mean is not None:
+            x = x - self.mean
+        if self.scale is not None:
+            x = x / self.scale
+        if self.is_stumps:
+            has_nan = np.isnan(x).any(axis=1)  # Missing values are processed by the general evaluator
+            raw = np.empty(len(x))
+            raw[~has_nan] = self._predict_steps(x[~has_nan])
+            raw[has_nan] = self._predict_trees(x[has_nan])
+        else:
+            raw = self._predict_trees(x)
+        if self.average_output:
+            raw = raw / max(len(self.roots), 1)
+        return self.transform(raw)
+
+    def _predict_steps(self, x):
+        raw = np.full(len(x), self.base_value)
+        for f, thresholds, suffix_sums in self.steps:
+            raw += suffix_sums[np.searchsorted(thresholds, x[:, f], side="left")]  # Trees with x <= threshold go left
+        return raw
+
+    def _predict_trees(self, x):
+        if jit_enabled():
+            return get_kernel("tree_ensemble")(x, *[self.arrays[name] for name in tree_arrays])
+        return self._predict_nodes(x)
+
+    def _predict_nodes(self, x, block_rows: int = 10_000):
+        """Move all rows in all trees one level down per step until all of them are in leaves."""
+        raw = np.zeros(len(x))
+        for start in range(0, len(x), block_rows):
+            block = x[start:start + block_rows]
+            nodes = np.repeat(self.roots[None, :], len(block), axis=0)
+            while True:
+                rows, trees = np.nonzero(self.feature[nodes] >= 0)
+                if not len(rows):
+                    break
+                split = nodes[rows, trees]
+                values = block[rows, self.feature[split]]
+                nodes[rows, trees] = np.where(
+                    _go_left(values, self.threshold[split], self.default_left[split], self.missing_type[split]),
+                    self.left[split], self.right[split]
+                )
+            raw[start:start + len(block)] = self.value[nodes].sum(axis=1)
+        return raw
+
+
+def _go_left(values, thresholds, default_left, missing_type):
+    """Numerical decisions of LightGBM (missing values go to the default child)."""
+    is_nan = np.isnan(values)
+    values = np.where(is_nan & (missing_type != MISSING_NAN), 0.0, values)
+    is_missing = ((missing_type == MISSING_ZERO) & (np.abs(values) <= zero_threshold)) | ((missing_type == MISSING_NAN) & is_nan)
+    return np.where(is_missing, default_left, values <= thresholds)
+
+
+def _objective_transform(objective: str):
+    """Output transformation of LightGBM objectives like "binary sigmoid:1" or "cross_entropy"."""
+    name, *params = objective.split()
+    if name == "binary":
+        sigmoid = next((float(p.split(":")[1]) for p in params if p.startswith("sigmoid:")), 1.0)
+        return lambda raw: expit(sigmoid * raw)
+    if name in ["cross_entropy", "xentropy"]:
+        return expit
+    if name in ["regression", "regression_l2", "regression_l1", "huber", "fair", "quantile", "mape"]:
+        return lambda raw: raw
+    raise ValueError(f"Objective '{objective}' is not supported.")
+
+
+def export_gb(booster, scaler, file):
+    """Write flat arrays of a LightGBM booster (built by train_gb()) and parameters of its scaler to a .npz file."""
+    np.savez(file, **TreeModel.from_booster(booster, scaler).to_arrays())
+
+
+def load_gb(file):
+    """Load tree model from a .npz file written by export_gb()."""
+    with np.load(Path(file)) as data:
+        return TreeModel.from_arrays(data)
+
+
+#
+# Linear classifier (LC)
+#
+
+class LinearModel:
+    """
+    Binary linear classifier with the scaler folded into its weights (like LogisticRegression applied to unscaled features).
+    """
+
+    def __init__(self, coef, intercept):
+        """
+        :param coef: Weights as a matrix with one row (like LogisticRegression.coef_)
+        :param intercept: Intercept as an array with one element (like LogisticRegression.intercept_)
+        """
+        self.coef_ = np.asarray(coef, dtype=float).reshape(1, -1)
+        self.intercept_ = np.asarray(intercept, dtype=float).reshape(1)
+
+    @staticmethod
+    def from_sklearn(model, scaler=None):
+        """Weights of a binary linear classifier (built by train_lc()) with its StandardScaler (or None) folded in."""
+        w = np.asarray(model.coef_[0], dtype=float)
+        b = float(model.intercept_[0])
+        if scaler is not None:
+            if type(scaler).__name__ != "StandardScaler":
+                raise ValueError(f"Linear models can be combined only with StandardScaler but {type(scaler).__name__} is used.")
+            mean, scale = standard_parameters(scaler)
+            w = w / scale
+            b -= float(mean @ w)
+        return LinearModel(w[None, :], [b])
+
+    def predict_proba(self, X):
+        """Probabilities of classes 0 and 1 as two columns (like LogisticRegression.predict_proba())."""
+        p = expit(np.asarray(X, dtype=float) @ self.coef_[0] + self.intercept_[0])
+        return np.column_stack([1.0 - p, p])
+
+    def to_arrays(self):
+        return dict(coef=self.coef_, intercept=self.intercept_)
+
+    @staticmethod
+    def from_arrays(arrays):
+        return LinearModel(arrays["coef"], arrays["intercept"])
+
+
+if __name__ == "__main__":
+    pass
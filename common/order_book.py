@@ -0,0 +1,118 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+
+import numpy as np
+
+"""
+Immutable snapshot of an order book with cumulative volume and notional (price * volume) arrays.
+All queries are answered by binary search over these arrays (O(log n)) without modifying or filtering the source lists.
+Side of queries is the side of our order: "buy" consumes asks (prices increase) and "sell" consumes bids (prices decrease).
+"""
+
+
+class OrderBook:
+    """
+    Order book snapshot created from a depth record like {"bids": [[price, volume], ...], "asks": [[price, volume], ...]}.
+    Values can be strings (as returned by API). Volumes of levels are not accumulated (as returned by API).
+    """
+
+    def __init__(self, depth: dict):
+        self.timestamp = depth.get("timestamp")
+        self._sides = {
+            "buy": _BookSide(depth.get("asks") or [], price_increase=True),
+            "sell": _BookSide(depth.get("bids") or [], price_increase=False),
+        }
+
+    @property
+    def best_bid(self):
+        return self._sides["sell"].best_price()
+
+    @property
+    def best_ask(self):
+        return self._sides["buy"].best_price()
+
+    @property
+    def gap(self):
+        """Difference between the best ask and the best bid (not negative)."""
+        return max(self.best_ask - self.best_bid, 0.0)
+
+    @property
+    def mid_price(self):
+        return self.best_bid + self.gap / 2
+
+    def levels(self, side: str):
+        """Read-only arrays of prices, volumes, cumulative volumes and cumulative notional values of the levels."""
+        s = self._get_side(side)
+        return s.prices, s.volumes, s.cumulative_volumes, s.cumulative_notionals
+
+    def price_to_volume(self, side: str, price_limit: float):
+        """Volume available at prices not worse than the limit (the limit is inclusive)."""
+        s = self._get_side(side)
+        count = s.count_levels(price_limit)
+        return float(s.cumulative_volumes[count - 1]) if count else 0.0
+
+    def volume_to_price(self, side: str, volume: float):
+        """Worst price (price of the last level) needed to fill the volume or None if the book does not have this volume."""
+        s = self._get_side(side)
+        level = s.fill_level(volume)
+        return float(s.prices[level]) if level is not None else None
+
+    def fill_price(self, side: str, volume: float):
+        """Mean price (VWAP) of filling the volume by consuming levels starting from the best price or None if the book does not have this volume."""
+        s = self._get_side(side)
+        level = s.fill_level(volume)
+        if level is None or volume <= 0:
+            return None
+        filled_volume = s.cumulative_volumes[level - 1] if level else 0.0
+        filled_notional = s.cumulative_notionals[level - 1] if level else 0.0
+        return float((filled_notional + (volume - filled_volume) * s.prices[level]) / volume)
+
+    def limit_price(self, side: str, volume: float, price_limit: float):
+        """
+        Limit price for an order which has to be filled immediately at prices not worse than the limit.
+        It is the price of the last level needed to fill the volume if this price is better than the limit (the order is filled
+        in the same way but it cannot be filled at worse prices if the book changes). Otherwise, it is the limit itself.
+        """
+        s = self._get_side(side)
+        level = s.fill_level(volume)
+        if level is None or level >= s.count_levels(price_limit):  # Not enough volume within the limit
+            return price_limit
+        return float(s.prices[level])
+
+    def _get_side(self, side: str):
+        s = self._sides.get(side)
+        if s is None:
+            raise ValueError(f"Wrong side '{side}'. Side is either buy or sell.")
+        return s
+
+
+class _BookSide:
+    """Levels of one side ordered from the best price."""
+
+    def __init__(self, levels: list, price_increase: bool):
+        points = np.array(levels, dtype=float).reshape(-1, 2)
+        self.price_increase = price_increase
+        self.prices = points[:, 0]
+        self.volumes = points[:, 1]
+        self.cumulative_volumes = np.cumsum(self.volumes)
+        self.cumulative_notionals = np.cumsum(self.prices * self.volumes)
+        self._keys = self.prices if price_increase else -self.prices  # Increasing for binary search
+
+        for array in [self.prices, self.volumes, self.cumulative_volumes, self.cumulative_notionals, self._keys]:
+            array.setflags(write=False)
+
+    def best_price(self):
+        return float(self.prices[0]) if len(self.prices) else np.nan
+
+    def count_levels(self, price_limit: float):
+        """Number of levels with prices not worse than the limit."""
+        key = price_limit if self.price_increase else -price_limit
+        return int(np.searchsorted(self._keys, key, side="right"))
+
+    def fill_level(self, volume: float):
+        """Index of the level where the cumulative volume reaches the volume or None if there is not enough volume."""
+        level = int(np.searchsorted(self.cumulative_volumes, volume, side="left"))
+        return level if level < len(self.cumulative_volumes) else None
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,93 @@
+from __future__ import annotations  # Eliminates problem with type annotations like list[int]
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+"""
+Feature matrix shared by worker processes without sending it to them.
+Columns of one type are written once to a .npy file which is memory-mapped by each process (read-only).
+Workers receive only a small spec (file and column names) and then row ranges and column names of their tasks,
+and get data frames which are views of the mapped file (not copies). Pages of the file are in the page cache once,
+hence memory does not grow with the number of workers.
+Rows are positions in the source data frame (its index is expected to be a range index).
+"""
+
+
+class SharedFrame:
+    """
+    Columns of a data frame stored in a memory-mapped matrix (one row per record and one column per source column).
+    """
+
+    def __init__(self, file, columns: list):
+        self.file = Path(file)
+        self.columns = list(columns)
+        self.positions = {name: i for i, name in enumerate(self.columns)}
+        self.values = np.load(self.file, mmap_mode="r")
+        if self.values.shape[1] != len(self.columns):
+            raise ValueError(f"File {self.file} has {self.values.shape[1]} columns but {len(self.columns)} column names are specified.")
+
+    @staticmethod
+    def create(df: pd.DataFrame, columns: list, file, dtype=None):
+        """
+        Write the columns of the data frame to the file and open it.
+        Columns are stored in the specified order so that consecutive columns (e.g., features of one set) are returned without copying.
+        """
+        dtype = np.dtype(dtype) if dtype is not None else np.result_type(*[df[c].dtype for c in columns])
+        values = np.lib.format.open_memmap(file, mode="w+", dtype=dtype, shape=(len(df), len(columns)))
+        for i, name in enumerate(columns):
+            values[:, i] = df[name].to_numpy(dtype=dtype)
+        values.flush()
+        del values
+        return SharedFrame(file, columns)
+
+    def spec(self):
+        """Parameters for opening this frame in another process (they are small and cheap to send)."""
+        return dict(file=str(self.file), columns=self.columns)
+
+    @staticmethod
+    def open(spec: dict):
+        return SharedFrame(spec["file"], spec["columns"])
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, start: int, end: int, columns: list, row_mask=None):
+        """
+        Data frame with the rows from start to end (exclusive) and the specified columns.
+        It is a read-only view of the file if the columns are consecutive (in the stored order) and all rows are selected.
+
+        :param row_mask: Boolean array of the length end-start with selected rows (or None for all rows)
+        """
+        values = self._columns(self.values[start:end], columns)
+        index = pd.RangeIndex(start, start + len(values))
+        if row_mask is not None and not row_mask.all():
+            values, index = values[row_mask], index[row_mask]
+        return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+    def get_column(self, start: int, end: int, column: str, row_mask=None):
+        """Series with the values of one column for rows from start to end (view of the file if all rows are selected)."""
+        values = self.values[start:end, self.positions[column]]
+        index = pd.RangeIndex(start, start + len(values))
+        if row_mask is not None and not row_mask.all():
+            values, index = values[row_mask], index[row_mask]
+        return pd.Series(values, index=index, name=column, copy=False)
+
+    def notnull_mask(self, start: int, end: int, columns: list):
+        """Rows from start to end without nans (and infinite values) in the columns (like dropna(subset=columns) with use_inf_as_na)."""
+        return np.isfinite(self._columns(self.values[start:end], columns)).all(axis=1)
+
+    def _columns(self, values, columns: list):
+        ids = [self.positions[name] for name in columns]
+        if ids == list(range(ids[0], ids[0] + len(ids))):  # Slice is a view
+            return values[:, ids[0]:ids[0] + len(ids)]
+        return values[:, ids]
+
+    def delete(self):
+        """Close the file and delete it. Data frames returned by this object must not be used after it."""
+        del self.values
+        self.file.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    pass
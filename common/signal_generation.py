@@ -7,12 +7,6 @@ import json
 import numpy as np
 import pandas as pd
 
-from sklearn.model_selection import train_test_split
-from sklearn import metrics
-from sklearn import neighbors
-
-import statsmodels.api as sm
-
 """
 Signals are binary features. 
 However, they are not trained but rather found using grid search by checking their overall performance during trading for some period
@@ -95,6 +89,7 @@ def generate_score(df, feature_sets):
 
 
 def train_score_forecast_model(sr, order):
+    import statsmodels.api as sm  # Slow to import
     model = sm.tsa.statespace.SARIMAX(sr, order=order, enforce_stationarity=True, enforce_invertibility=False)
     model_fit = model.fit(disp=False)
     print(model_fit.summary())
@@ -108,6 +103,7 @@ def rolling_forecast(history, sr, model_order, result_params):
     Indexes correspond to the time for which forecast is made, that is, next time after appended value.
     No forecast for the last appended value.
     """
+    import statsmodels.api as sm  # Slow to import
     model = sm.tsa.SARIMAX(history, order=model_order)
     result = model.filter(result_params)
 
@@ -131,6 +127,7 @@ def fitted_forecast(history, model_order, result_params):
     """
     Given forecast model and data, find in-sample forecasts for all these values.
     """
+    import statsmodels.api as sm  # Slow to import
     model = sm.tsa.SARIMAX(history, order=model_order)
     result = model.filter(result_params)
 
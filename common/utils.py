@@ -1,18 +1,18 @@
 from __future__ import annotations  # Eliminates problem with type annotations like list[int] and error "'type' object is not subscriptable"
-import dateparser
-import pytz
 from datetime import datetime, timezone, timedelta
 from typing import Union
 import json
 from decimal import *
+from itertools import chain
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 
-from sklearn import linear_model
-
 from binance.helpers import date_to_milliseconds, interval_to_milliseconds
 
+from common.jit import jit_enabled, get_kernel
+
 
 #
 # Decimals
@@ -121,6 +121,9 @@ def find_index(df: pd.DataFrame, date_str: str, column_name: str= "timestamp"):
     :return: row id in the input data frame which can be then used in iloc function
     :rtype: int
     """
+    import dateparser  # Slow to import
+    import pytz
+
     d = dateparser.parse(date_str)
     try:
         res = df[df[column_name] == d]
@@ -198,18 +201,18 @@ def depth_accumulate(depth: list, start, end):
 
 def discretize(side: str, depth: list, bin_size: float, start: float):
     """
-    Main problem: current point can contribute to this bin (till bin end) and next bin (from bin end till next point)
-    Iterate over bins. For each iteration, initial function value must be provided which works till first point or end
-      With each bin iteration, iterate over points (global pointer).
-      If point within this bin, the set current volume instead of initial, and compute contribution of the previous value
-      If point in next bin, then still use current volume for the next bin, compute contribution till end only. Do not iterate point (it is needed when starting next bin)
-        When we start next bin, compute contribution
-
-    :param side:
-    :param depth:
-    :param bin_size:
-    :param start:
-    :return:
+    Find (volume) area within each price bin given the step function volume(price) and divide it by bin size.
+    A point (price, volume) specifies volume from its price till the next point. Before the first point, the volume is 0.
+    Bins start from the specified price (or the first point) and cover the last point.
+
+    Bin areas are differences of one cumulative area curve at bin borders, which are found by binary search.
+    Hence, the cost is linear in the number of points and bins.
+
+    :param side: "ask" (prices in depth list increase) or "bid" (prices in depth list decrease)
+    :param depth: list of points (price, volume) ordered by price
+    :param bin_size: price interval of one bin
+    :param start: price where the first bin starts (first point if None)
+    :return: list of mean volumes (per price unit) in the bins
     """
     if side.startswith("ask") or side.startswith("sell"):
         price_increase = True
@@ -224,74 +227,51 @@ def discretize(side: str, depth: list, bin_size: float, start: float):
 
     # End covers the last point
     bin_count = int(abs(depth[-1][0] - start) // bin_size) + 1
-    all_bins_length = bin_count * bin_size
-    end = start + all_bins_length if price_increase else start - all_bins_length
 
-    bin_volumes = []
-    for b in range(bin_count):
-        bin_start = start + b*bin_size if price_increase else start - b*bin_size
-        bin_end = bin_start + bin_size if price_increase else bin_start - bin_size
+    points = np.asarray(depth, dtype=float)
 
-        # Find point ids within this bin
-        if price_increase:
-            bin_point_ids = [i for i, x in enumerate(depth) if bin_start <= x[0] < bin_end]
-        else:
-            bin_point_ids = [i for i, x in enumerate(depth) if bin_end < x[0] <= bin_start]
+    if jit_enabled():
+        return list(get_kernel("discretize")(points[:, 0], points[:, 1], start, bin_size, bin_count, price_increase))
 
-        if bin_point_ids:
-            first_point_id = min(bin_point_ids)
-            last_point_id = max(bin_point_ids)
-            prev_point = depth[first_point_id-1] if first_point_id >= 1 else None
-        else:
-            first_point_id = None
-            last_point_id = None
-
-        #
-        # Iterate over points in this bin by collecting their contribution using previous interval
-        #
-        prev_price = bin_start
-        prev_volume = prev_point[1] if prev_point else 0.0
-        bin_volume = 0.0
-
-        if first_point_id is None:  # Bin is empty
-            # Update current bin volume
-            price = bin_end
-            price_delta = abs(price - prev_price)
-            price_coeff = price_delta / bin_size  # Portion of this interval in bin
-            bin_volume += prev_volume * price_coeff  # Each point in the bin contributes to this bin final value
+    sign = 1.0 if price_increase else -1.0  # Prices of bids are negated so that they increase
+    borders = sign * start + np.arange(bin_count + 1) * bin_size
+    areas = _step_areas(sign * points[:, 0], points[:, 1], borders)
 
-            # Store current bin as finished
-            bin_volumes.append(bin_volume)
+    return list(np.diff(areas) / bin_size)
 
-            continue
 
-        # Bin is not empty
-        for point_id in range(first_point_id, last_point_id+1):
-            point = depth[point_id]
+def _step_areas(prices: np.ndarray, volumes: np.ndarray, x: np.ndarray):
+    """
+    Area under the step function (volume from its price till the next price and 0 before the first price)
+    from the first price till each x. Prices must increase.
+    """
+    cumulative = np.concatenate([[0.0], np.cumsum(volumes[:-1] * np.diff(prices))])  # Area till each point
+    ids = np.searchsorted(prices, x, side="right") - 1  # Last point before or at x
+    point_ids = np.maximum(ids, 0)
+    return np.where(ids >= 0, cumulative[point_ids] + volumes[point_ids] * (x - prices[point_ids]), 0.0)
+
 
-            # Update current bin volume
-            price = point[0]
-            price_delta = abs(price - prev_price)
-            price_coeff = price_delta / bin_size  # Portion of this interval in bin
-            bin_volume += prev_volume * price_coeff  # Each point in the bin contributes to this bin final value
+def volume_densities(side: str, depth: list, windows: list, bin_sizes: list):
+    """
+    Mean volume per bin for the first bins (window is the number of bins) for several bin sizes.
+    The result is the same as the mean of the first bins returned by discretize() (with no explicit start)
+    but it is computed from one cumulative area curve without discretizing the whole side.
 
-            # Iterate
-            prev_price = point[0]
-            prev_volume = point[1]
-            prev_point = point
-        #
-        # Last point contributes till the end of this bin
-        #
-        # Update current bin volume
-        price = bin_end
-        price_delta = abs(price - prev_price)
-        price_coeff = price_delta / bin_size  # Portion of this interval in bin
-        bin_volume += prev_volume * price_coeff  # Each point in the bin contributes to this bin final value
+    :return: 2d array with one row for each bin size and one column for each window
+    """
+    points = np.asarray(depth, dtype=float)
+    sign = 1.0 if side.startswith("ask") or side.startswith("sell") else -1.0
+    prices = sign * points[:, 0]
+    volumes = points[:, 1]
 
-        # Store current bin as finished
-        bin_volumes.append(bin_volume)
+    densities = np.zeros((len(bin_sizes), len(windows)))
+    for i, bin_size in enumerate(bin_sizes):
+        bin_count = int((prices[-1] - prices[0]) // bin_size) + 1
+        lengths = np.minimum(windows, bin_count) * bin_size  # Windows do not exceed the bins which cover the last point
+        areas = _step_areas(prices, volumes, prices[0] + lengths)
+        densities[i] = areas / lengths
 
-    return bin_volumes
+    return densities
 
 
 # OBSOLETE: Because works only for increasing prices (ask). Use general version instead.
@@ -371,25 +351,78 @@ def discretize_ask(depth: list, bin_size: float, start: float):
     return bin_volumes
 
 
-def mean_volumes(depth: list, windows: list, bin_size: 1.0):
+def pack_depth(depth: list, side: str):
+    """
+    Pack one side ("bids" or "asks") of many depth records into 2d arrays of prices and volumes with one row for each record.
+    Rows are padded with nan prices and zero volumes to the maximum number of levels.
+
+    :return: tuple of price array, volume array and array with the numbers of levels
+    """
+    sides = [entry.get(side) or [] for entry in depth]
+    lengths = np.array([len(points) for points in sides], dtype=int)
+    levels = max(1, lengths.max(initial=0))
+
+    # All values are converted at once (they can be strings as returned by API)
+    values = np.fromiter(map(float, chain.from_iterable(chain.from_iterable(sides))), dtype=float, count=2 * lengths.sum())
+
+    is_level = np.arange(levels) < lengths[:, None]
+    prices = np.full((len(sides), levels), np.nan)
+    volumes = np.zeros((len(sides), levels))
+    prices[is_level] = values[0::2]
+    volumes[is_level] = values[1::2]
+
+    return prices, volumes, lengths
+
+
+def batch_volume_densities(side: str, prices: np.ndarray, volumes: np.ndarray, windows: list, bin_sizes: list):
+    """
+    Batch version of volume_densities() for packed depth records (see pack_depth()).
+    Records without levels get nan densities.
+
+    :return: 3d array with densities for each record, bin size and window
+    """
+    sign = 1.0 if side.startswith("ask") or side.startswith("sell") else -1.0
+    distances = sign * (prices - prices[:, :1])  # From the first point. Increase for both sides
+    valid = ~np.isnan(distances)
+    distances[~valid] = np.inf  # Padding is after all prices
+
+    with np.errstate(invalid="ignore"):
+        steps = np.diff(distances, axis=1)
+    areas = volumes[:, :-1] * np.where(valid[:, 1:], steps, 0.0)
+    cumulative = np.concatenate([np.zeros((len(prices), 1)), np.cumsum(areas, axis=1)], axis=1)  # Area till each point
+
+    last = np.where(valid.any(axis=1), distances[np.arange(len(prices)), np.maximum(valid.sum(axis=1) - 1, 0)], np.nan)
+
+    rows = np.arange(len(prices))
+    densities = np.full((len(prices), len(bin_sizes), len(windows)), np.nan)
+    for i, bin_size in enumerate(bin_sizes):
+        bin_count = np.floor(last / bin_size) + 1
+        for j, w in enumerate(windows):
+            length = np.minimum(w, bin_count) * bin_size  # Windows do not exceed the bins which cover the last point
+            ids = np.maximum((distances <= length[:, None]).sum(axis=1) - 1, 0)  # Last point before or at the window end
+            area = cumulative[rows, ids] + volumes[rows, ids] * (length - distances[rows, ids])
+            densities[:, i, j] = area / length
+
+    return densities
+
+
+def mean_volumes(depth: dict, windows: list, bin_size: Union[float, list] = 1.0):
     """
     Density. Mean volume per price unit (bin) computed using the specified number of price bins.
-    First, we discreteize and then find average value for the first element (all if length is not specified).
-    Return a list of values each value being a mean volume for one aggregation window (number of bins)
+    Return a dict of values with names like "bids_5" each value being a mean volume for one aggregation window (number of bins).
+    If a list of bin sizes is specified, then densities are computed for all of them and bin size is added to the names like "bids_5_bin2".
     """
+    bin_sizes = bin_size if isinstance(bin_size, list) else [bin_size]
 
-    bid_volumes = discretize(side="bid", depth=depth.get("bids"), bin_size=bin_size, start=None)
-    ask_volumes = discretize(side="ask", depth=depth.get("asks"), bin_size=bin_size, start=None)
+    bid_densities = volume_densities("bid", depth.get("bids"), windows, bin_sizes)
+    ask_densities = volume_densities("ask", depth.get("asks"), windows, bin_sizes)
 
     ret = {}
-    for length in windows:
-        density = np.nanmean(bid_volumes[0:min(length, len(bid_volumes))])
-        feature_name = f"bids_{length}"
-        ret[feature_name] = density
-
-        density = np.nanmean(ask_volumes[0:min(length, len(ask_volumes))])
-        feature_name = f"asks_{length}"
-        ret[feature_name] = density
+    for i, size in enumerate(bin_sizes):
+        suffix = f"_bin{size:g}" if isinstance(bin_size, list) else ""
+        for j, length in enumerate(windows):
+            ret[f"bids_{length}{suffix}"] = bid_densities[i, j]
+            ret[f"asks_{length}{suffix}"] = ask_densities[i, j]
 
     return ret
 
@@ -446,12 +479,274 @@ def to_diff(sr):
     Convert the specified input column to differences.
     Each value of the output series is equal to the difference between current and previous values divided by the current value.
     """
+    prev = sr.shift(periods=1)
+    diff = 100 * (sr - prev) / prev
+    return diff
+
+
+def to_float_dtype(df, columns: list, dtype="float64"):
+    """
+    Convert float columns among the specified ones to the specified float type (other columns are not changed).
+    float32 halves memory and bandwidth. It is enough for stored features because they are computed in float64.
+    """
+    for column in columns:
+        if df[column].dtype.kind == "f" and df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
 
-    def diff_fn(x):  # ndarray. last element is current row and first element is most old historic value
-        return 100 * (x[1] - x[0]) / x[0]
 
-    diff = sr.rolling(window=2, min_periods=2).apply(diff_fn, raw=True)
-    return diff
+#
+# Rolling kernels
+#
+
+# Reducers which are computed by native rolling operations instead of calling them from apply() for each window.
+# Value is the rolling method name and whether nans propagate to the result (np.mean) or are skipped (np.nanmean)
+_rolling_kernels = {
+    np.nanmean: ("mean", False),
+    np.mean: ("mean", True),
+    np.nansum: ("sum", False),
+    np.sum: ("sum", True),
+    np.nanstd: ("std", False),
+    np.std: ("std", True),
+    np.nanmax: ("max", False),
+    np.max: ("max", True),
+    np.amax: ("max", True),
+    np.nanmin: ("min", False),
+    np.min: ("min", True),
+    np.amin: ("min", True),
+}
+
+
+def rolling_aggregate(column: pd.Series, window: int, fn, min_periods: int):
+    """
+    Apply the function to all rolling windows of the column and return the result series.
+
+    Known reducers (listed in _rolling_kernels) are computed natively in O(n) rather than via Python calls for each row.
+    The result is the same as for apply(fn) including the min_periods semantics: the value is None if the window
+    has fewer than min_periods non-nan values. Other functions (and columns with infinite values) are applied as is.
+    """
+    ro = column.rolling(window=window, min_periods=min_periods)
+
+    kernel = _rolling_kernels.get(fn)
+    if kernel is None or np.isinf(column.values).any():
+        return ro.apply(fn, raw=True)
+
+    method, propagate_nans = kernel
+    if method == "std":
+        feature = ro.std(ddof=0)  # Numpy uses population std
+    else:
+        feature = getattr(ro, method)()
+
+    if propagate_nans:
+        # Native operations skip nans while these functions return nan if there is at least one nan in the window
+        nans = column.isna().astype(float).rolling(window=window, min_periods=1).sum()
+        feature = feature.where(nans == 0)
+
+    return feature
+
+
+def rolling_weighted_aggregate(column: pd.Series, weight_column: pd.Series, fn, windows: list, min_periods: list):
+    """
+    Aggregate products of the column and weights and then the weights themselves for each window and return their ratios.
+    The result is a list of series (one for each window) each equal to fn(x*w)/fn(w) of this window.
+
+    Means and sums (with or without nans) are computed for all windows from shared prefix sums and counts.
+    Each of the two aggregations has its own min_periods check exactly as if it were computed separately by apply().
+    """
+    products_column = column * weight_column
+
+    kernel = _rolling_kernels.get(fn)
+    if kernel is None or kernel[0] not in ["mean", "sum"] or np.isinf(products_column.values).any() or np.isinf(weight_column.values).any():
+        features = []
+        for w, mp in zip(windows, min_periods):
+            feature = rolling_aggregate(products_column, w, fn, min_periods=mp)
+            weights = rolling_aggregate(weight_column, w, fn, min_periods=mp)
+            features.append(feature / weights)
+        return features
+
+    method, propagate_nans = kernel
+
+    products = products_column.values.astype(float)
+    weights = weight_column.values.astype(float)
+    products_valid = ~np.isnan(products)
+    weights_valid = ~np.isnan(weights)
+
+    # One array of prefix sums is used for all windows
+    products_sums = window_sums(np.where(products_valid, products, 0.0), windows)
+    products_counts = window_sums(products_valid.astype(float), windows)
+    weights_sums = window_sums(np.where(weights_valid, weights, 0.0), windows)
+    weights_counts = window_sums(weights_valid.astype(float), windows)
+
+    lengths = np.arange(1, len(products) + 1)  # Windows at the start are shorter
+
+    features = []
+    for i, (w, mp) in enumerate(zip(windows, min_periods)):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if method == "mean":
+                feature = products_sums[i] / products_counts[i]
+                weight = weights_sums[i] / weights_counts[i]
+            else:
+                feature = products_sums[i]
+                weight = weights_sums[i]
+
+            feature[products_counts[i] < mp] = np.nan
+            weight[weights_counts[i] < mp] = np.nan
+            if propagate_nans:
+                window_lengths = np.minimum(lengths, w)
+                feature[products_counts[i] < window_lengths] = np.nan
+                weight[weights_counts[i] < window_lengths] = np.nan
+
+            feature = feature / weight
+
+        features.append(pd.Series(feature, index=column.index))
+
+    return features
+
+
+def window_sums(values: np.ndarray, windows: list):
+    """
+    Sums over past windows (the current element included) for all window sizes computed from one array of prefix sums.
+    The result is a 2d array with one row for each window.
+
+    Prefix sums restart at each block border, so the rounding error depends on the block length rather than on the series length.
+    Blocks are not shorter than the largest window, hence any window overlaps with at most two blocks.
+    """
+    n = len(values)
+    if n == 0:
+        return np.zeros((len(windows), 0))
+    block = max(windows)
+    block_count = -(-n // block)
+
+    padded = np.zeros(block_count * block)
+    padded[:n] = values
+    prefix = np.cumsum(padded.reshape(block_count, block), axis=1)
+    totals = prefix[:, -1]  # Sum of each block
+    prefix = prefix.ravel()
+
+    # Sum of the previous elements of the same block
+    exclusive = np.empty_like(prefix)
+    exclusive[0] = 0.0
+    exclusive[1:] = prefix[:-1]
+    exclusive[::block] = 0.0
+
+    ids = np.arange(n)
+    block_ids = ids // block
+
+    sums = np.empty((len(windows), n))
+    for i, w in enumerate(windows):
+        if w == 1:
+            sums[i] = values
+            continue
+        starts = np.maximum(ids - w + 1, 0)
+        start_block_ids = starts // block
+        # Window part in the block of its last element plus the part in the previous block (if any)
+        tail = np.where(start_block_ids < block_ids, totals[start_block_ids] - exclusive[starts], 0.0)
+        head = prefix[:n] - np.where(start_block_ids < block_ids, 0.0, exclusive[starts])
+        sums[i] = head + tail
+
+    return sums
+
+
+def rolling_slope(column: pd.Series, window: int, min_periods: int):
+    """
+    Slope of the least squares line fitted to the values of each rolling window as a function of their position.
+    The result is the same as for fitting a regression model for each window: nans are dropped from the window,
+    windows with fewer than min_periods values produce nan, and a window with one value has zero slope.
+
+    The slope is computed in closed form from windowed sums of 1, k, k*k, y and k*y over the non-nan values.
+    Since the slope does not depend on where positions k start, they are counted from the start of the block
+    (of window length) of the last window element. It keeps all sums small (no cancellation of large numbers).
+    """
+    w = window
+    y = column.values.astype(float)
+    n = len(y)
+    block_count = -(-n // w)
+
+    valid = ~np.isnan(y)
+    k = np.tile(np.arange(w, dtype=float), block_count)[:n]  # Position within block
+
+    moments = np.zeros((5, block_count * w))
+    moments[0, :n] = valid
+    moments[1, :n] = np.where(valid, k, 0.0)
+    moments[2, :n] = np.where(valid, k * k, 0.0)
+    moments[3, :n] = np.where(valid, y, 0.0)
+    moments[4, :n] = np.where(valid, k * y, 0.0)
+    moments = np.cumsum(moments.reshape(5, block_count, w), axis=2)
+
+    # Window part in the block of its last element is the prefix of this block
+    # Window part in the previous block is the suffix of that block with positions shifted by -w
+    head = moments
+    tail = np.zeros_like(moments)
+    tail[:, 1:, :] = moments[:, :-1, -1:] - moments[:, :-1, :]
+
+    count = head[0] + tail[0]
+    sum_k = head[1] + tail[1] - w * tail[0]
+    sum_kk = head[2] + tail[2] - 2 * w * tail[1] + w * w * tail[0]
+    sum_y = head[3] + tail[3]
+    sum_ky = head[4] + tail[4] - w * tail[3]
+
+    numerator = count * sum_ky - sum_k * sum_y
+    denominator = count * sum_kk - sum_k * sum_k  # Exact (integers) and zero only for one point
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(denominator > 0, numerator / denominator, 0.0)
+
+    slope = slope.ravel()[:n]
+    slope[count.ravel()[:n] < min_periods] = np.nan
+
+    return pd.Series(slope, index=column.index)
+
+
+def rolling_area_ratio(column: pd.Series, window: int, min_periods: int, is_future: bool, block_length: int = 1_000_000):
+    """
+    Ratio of the area over and under the level for each window scaled to [-1,+1]: sum(x-level) / sum(|x-level|).
+    For past windows, the level is the newest element of the window ending in this row.
+    For future windows, the level is the oldest element of the window starting in this row (that is, this row).
+    A window with nans or fewer than min_periods values produces nan (same as applying the ratio function to windows).
+
+    Windows are processed as blocks of sliding window views so temporary arrays never exceed block_length elements.
+    If JIT is enabled, then a compiled loop over rows is used instead (no temporary arrays).
+    """
+    if jit_enabled():
+        ratio = get_kernel("area_ratio")(column.values.astype(float), window, min_periods, is_future)
+        return pd.Series(ratio, index=column.index)
+
+    w = window
+    x = column.values.astype(float)
+    n = len(x)
+
+    nans = np.isnan(x)
+    nan_counts = window_sums(nans.astype(float), [w])[0]  # For windows ending in each row
+    values = np.where(nans, 0.0, x)  # Windows with nans will be set to nan anyway
+
+    if is_future:
+        windows_view = sliding_window_view(values, w)  # One window starting in each row (except for the last rows)
+        level_id = 0
+        nan_counts = nan_counts[w-1:]
+    else:
+        padded = np.concatenate([np.full(w-1, np.nan), values])  # Shorter windows at the start
+        windows_view = sliding_window_view(padded, w)  # One window ending in each row
+        level_id = w-1
+
+    ratio = np.full(n, np.nan)
+    rows = max(1, block_length // w)
+    for start in range(0, len(windows_view), rows):
+        block = windows_view[start:start+rows]
+
+        diff = block - block[:, level_id:level_id+1]  # Difference from the level
+        if start < w-1:
+            np.nan_to_num(diff, copy=False)  # Padding does not contribute to the areas
+        a = diff.sum(axis=1)
+        np.absolute(diff, out=diff)
+        b = diff.sum(axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio[start:start+len(block)] = a / b
+
+    ratio[:len(nan_counts)][nan_counts > 0] = np.nan
+    if not is_future:
+        ratio[:min_periods-1] = np.nan  # Too short windows at the start
+
+    return pd.Series(ratio, index=column.index)
 
 
 def add_past_weighted_aggregations(df, column_name: str, weight_column_name: str, fn, windows: Union[int, list[int]], suffix=None, rel_column_name: str = None, rel_factor: float = 1.0):
@@ -500,8 +795,7 @@ def _add_aggregations(df, is_future: bool, column_name: str, fn, windows: Union[
     features = []
     for w in windows:
         # Aggregate
-        ro = column.rolling(window=w, min_periods=max(1, w // 10))
-        feature = ro.apply(fn, raw=True)
+        feature = rolling_aggregate(column, w, fn, min_periods=max(1, w // 10))
 
         # Convert past aggregation to future aggregation
         if is_future:
@@ -531,8 +825,6 @@ def _add_weighted_aggregations(df, is_future: bool, column_name: str, weight_col
         # If weight column is not specified then it is equal to constant 1.0
         weight_column = pd.Series(data=1.0, index=column.index)
 
-    products_column = column * weight_column
-
     if isinstance(windows, int):
         windows = [windows]
 
@@ -542,19 +834,11 @@ def _add_weighted_aggregations(df, is_future: bool, column_name: str, weight_col
     if suffix is None:
         suffix = "_" + fn.__name__
 
-    features = []
-    for w in windows:
-
-        # Sum of products
-        ro = products_column.rolling(window=w, min_periods=max(1, w // 10))
-        feature = ro.apply(fn, raw=True)
+    # Weighted aggregations for all windows are computed together
+    weighted = rolling_weighted_aggregate(column, weight_column, fn, windows, [max(1, w // 10) for w in windows])
 
-        # Sum of weights
-        w_ro = weight_column.rolling(window=w, min_periods=max(1, w // 10))
-        weights = w_ro.apply(fn, raw=True)
-
-        # Weighted feature
-        feature = feature / weights
+    features = []
+    for w, feature in zip(windows, weighted):
 
         # Convert past aggregation to future aggregation
         if is_future:
@@ -571,10 +855,13 @@ def _add_weighted_aggregations(df, is_future: bool, column_name: str, weight_col
     return features
 
 
-def add_area_ratio(df, is_future: bool, column_name: str, windows: Union[int, list[int]], suffix=None):
+def add_area_ratio(df, is_future: bool, column_name: str, windows: Union[int, list[int]], suffix=None, reference: bool = False):
     """
     For past, we take this element and compare the previous sub-series: the area under and over this element
     For future, we take this element and compare the next sub-series: the area under and over this element
+
+    Ratios are computed for blocks of windows by rolling_area_ratio(). If reference is True, then the ratio function
+    is applied to each window instead (much slower, used for validation).
     """
     column = df[column_name]
 
@@ -602,14 +889,15 @@ def add_area_ratio(df, is_future: bool, column_name: str, windows: Union[int, li
     for w in windows:
         feature_name = column_name + suffix + '_' + str(w)
 
-        ro = column.rolling(window=w, min_periods=max(1, w // 10))
-
-        feature = ro.apply(area_ratio_fn, kwargs=dict(is_future=is_future), raw=True)
-
-        if is_future:
-            df[feature_name] = feature.shift(periods=-(w-1))
+        if reference:
+            ro = column.rolling(window=w, min_periods=max(1, w // 10))
+            feature = ro.apply(area_ratio_fn, kwargs=dict(is_future=is_future), raw=True)
+            if is_future:
+                feature = feature.shift(periods=-(w-1))
         else:
-            df[feature_name] = feature
+            feature = rolling_area_ratio(column, w, min_periods=max(1, w // 10), is_future=is_future)
+
+        df[feature_name] = feature
 
         features.append(feature_name)
 
@@ -684,12 +972,15 @@ def ___add_label_column(df, window, threshold, max_column_name='<HIGH>', ref_col
     return df
 
 
-def add_linear_trends(df, is_future: bool, column_name: str, windows: Union[int, list[int]], suffix=None):
+def add_linear_trends(df, is_future: bool, column_name: str, windows: Union[int, list[int]], suffix=None, reference: bool = False):
     """
     Use a series of points to compute slope of the fitted line and return it.
     For past, we use previous series.
     For future, we use future series.
     This point is included in series in both cases.
+
+    Slopes are computed in closed form by rolling_slope(). If reference is True, then a linear regression model
+    is fitted for each window instead (much slower, used for validation).
     """
     column = df[column_name]
 
@@ -713,6 +1004,7 @@ def add_linear_trends(df, is_future: bool, column_name: str, windows: Union[int,
 
         X_array = X_array.reshape(-1, 1)  # Make matrix
 
+        from sklearn import linear_model
         model = linear_model.LinearRegression()
         model.fit(X_array, y_array)
         return model.coef_[0]
@@ -721,9 +1013,11 @@ def add_linear_trends(df, is_future: bool, column_name: str, windows: Union[int,
     for w in windows:
         feature_name = column_name + suffix + '_' + str(w)
 
-        ro = column.rolling(window=w, min_periods=max(1, w // 5))
-
-        feature = ro.apply(linear_trend_fn, raw=True)
+        if reference:
+            ro = column.rolling(window=w, min_periods=max(1, w // 5))
+            feature = ro.apply(linear_trend_fn, raw=True)
+        else:
+            feature = rolling_slope(column, w, min_periods=max(1, w // 5))
 
         if is_future:
             df[feature_name] = feature.shift(periods=-(w-1))
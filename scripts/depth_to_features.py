@@ -4,6 +4,8 @@ import math
 from pathlib import Path
 import json
 import time
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta, datetime
 from dateutil import parser
 from tqdm import tqdm_notebook #(Optional, used for progress-bars)
@@ -32,9 +34,12 @@ Features:
 - [ask_slope, bid_slope] - angle of the line computed either via regression or using min and max 
 - do we need and is it meaningful to process price and volume information separately or together?
 
-Parameters defined in feature_generation::depth_to_df():
+Parameters (the same as in feature_generation::depth_to_df()):
 - bin_size=1.0
 - windows=[1, 2, 5, 10, 20]
+Files are processed in parallel by a pool of processes (one file per process).
+Each file is read in chunks of lines so that memory of a process is bounded by the chunk size (and not by the file size).
+Features and depth statistics (see find_depth_statistics()) are computed in the same pass over the lines.
 Output columns:
 -timestamp, end of latest 1m interval (time of request)
 -gap, - difference between ask and bid
@@ -109,6 +114,12 @@ symbol = "BTCUSDT"  # BTCUSDT ETHBTC IOTAUSDT
 in_path_name = r"C:\DATA2\BITCOIN\COLLECTED\DEPTH\batch6-partial-till-0307"
 #in_path_name = r"C:\DATA2\BITCOIN\COLLECTED\DEPTH\_test_"
 
+bin_size = 1.0  # In USDT
+windows = [1, 2, 5, 10, 20]  # No of price bins for aggregate/smoothing
+
+chunk_lines = 10_000  # Number of lines parsed and converted at once by one process
+max_workers = None  # Number of processes (files processed in parallel). None means number of CPUs
+
 
 #
 # Historic data
@@ -124,47 +135,167 @@ def get_symbol_files(symbol):
     return list(paths)
 
 
+#
+# Depth statistics
+#
+
+statistics_names = ["bid_spans", "ask_spans", "bid_lens", "ask_lens", "bid_vols", "ask_vols"]
+
+
+def new_statistics():
+    """Running statistics: count, sum, min, max for each measure and the number of bad lines."""
+    stats = {name: dict(count=0, sum=0.0, min=np.inf, max=-np.inf) for name in statistics_names}
+    stats["bad_lines"] = 0
+    return stats
+
+
+def update_statistics(stats, name, values):
+    if len(values) == 0:
+        return
+    s = stats[name]
+    s["count"] += len(values)
+    s["sum"] += float(np.sum(values))
+    s["min"] = min(s["min"], float(np.min(values)))
+    s["max"] = max(s["max"], float(np.max(values)))
+
+
+def merge_statistics(stats, other):
+    """Add statistics of another file to the statistics."""
+    for name in statistics_names:
+        s, o = stats[name], other[name]
+        s["count"] += o["count"]
+        s["sum"] += o["sum"]
+        s["min"] = min(s["min"], o["min"])
+        s["max"] = max(s["max"], o["max"])
+    stats["bad_lines"] += other["bad_lines"]
+    return stats
+
+
+def print_statistics(stats):
+    for name in statistics_names:
+        s = stats[name]
+        title = name.replace("_", " ").capitalize()
+        if not s["count"]:
+            print(f"{title}: no data")
+            continue
+        print(f"{title}: min={s['min']:.2f}, max={s['max']:.2f}, mean={s['sum'] / s['count']:.2f}")
+    print(f"Bad lines: {stats['bad_lines']}")
+
+
 def find_depth_statistics():
     """Utility to research the depth data by computing: price span (min, max, mean)"""
-
     paths = get_symbol_files(symbol)
-    bad_lines = 0
-    bid_spans = []
-    ask_spans = []
-    bid_lens = []
-    ask_lens = []
-    bid_vols = []
-    ask_vols = []
-    for path in paths:
-
-        with open(path, 'r') as f:
-            for line in f:
-                try:
-                    entry = json.loads(line)
-                except:
-                    bad_lines += 1
-                    continue
-                # File can contain error lines which we skip
-                if not entry.get("bids") or not entry.get("asks"):
-                    bad_lines += 1
-                    continue
-                # Replace all price-volume strings by floats
-                bids = [float(x[0]) for x in entry.get("bids")]
-                asks = [float(x[0]) for x in entry.get("asks")]
-                bid_spans.append(np.max(bids) - np.min(bids))
-                ask_spans.append(np.max(asks) - np.min(asks))
-                bid_lens.append(len(bids))
-                ask_lens.append(len(asks))
-                bid_vols.append(np.sum([float(x[1]) for x in entry.get("bids")]))
-                ask_vols.append(np.sum([float(x[1]) for x in entry.get("asks")]))
-
-    print(f"Bid spans: min={np.min(bid_spans):.2f}, max={np.max(bid_spans):.2f}, mean={np.mean(bid_spans):.2f}")
-    print(f"Ask spans: min={np.min(ask_spans):.2f}, max={np.max(ask_spans):.2f}, mean={np.mean(ask_spans):.2f}")
-    print(f"Bid lens: min={np.min(bid_lens):.2f}, max={np.max(bid_lens):.2f}, mean={np.mean(bid_lens):.2f}")
-    print(f"Ask lens: min={np.min(ask_lens):.2f}, max={np.max(ask_lens):.2f}, mean={np.mean(ask_lens):.2f}")
-    print(f"Bid vols: min={np.min(bid_vols):.2f}, max={np.max(bid_vols):.2f}, mean={np.mean(bid_vols):.2f}")
-    print(f"Ask vols: min={np.min(ask_vols):.2f}, max={np.max(ask_vols):.2f}, mean={np.mean(ask_vols):.2f}")
-    print(f"Bad lines: {bad_lines}")
+    stats = new_statistics()
+    for file_stats in _map_files(paths, store=False):
+        merge_statistics(stats, file_stats)
+    print_statistics(stats)
+
+
+#
+# Features
+#
+
+def read_chunks(f, stats):
+    """Generate lists of parsed depth records with at most chunk_lines lines each. Bad lines are skipped and counted."""
+    while True:
+        lines = list(islice(f, chunk_lines))
+        if not lines:
+            return
+        table = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except:
+                stats["bad_lines"] += 1
+                continue
+            # File can contain error lines which we skip
+            if not entry.get("bids") or not entry.get("asks"):
+                stats["bad_lines"] += 1
+                continue
+            table.append(entry)
+        yield table
+
+
+def process_file(path, store=True):
+    """
+    Convert one depth file to a csv file with features (if store is True) and return its depth statistics.
+    The output is the same as that of depth_to_df() for the whole file: a continuous 1m index (gaps are empty rows)
+    and timestamps shifted by one row to conform to klines. Records are expected to be ordered by timestamp
+    (as they are collected) but are also sorted within a chunk.
+    """
+    path = Path(path)
+    out_path = Path(path.with_suffix('.csv').name)
+    stats = new_statistics()
+    last_ts = None  # Last timestamp stored (to continue the index in the next chunk)
+    header = True
+
+    with open(path, 'r') as f:
+        for table in read_chunks(f, stats):
+            if not table:
+                continue
+
+            # Replace all price-volume strings by floats (once for statistics and features)
+            bids = pack_depth(table, "bids")
+            asks = pack_depth(table, "asks")
+
+            with np.errstate(invalid="ignore"):
+                update_statistics(stats, "bid_spans", np.nanmax(bids[0], axis=1) - np.nanmin(bids[0], axis=1))
+                update_statistics(stats, "ask_spans", np.nanmax(asks[0], axis=1) - np.nanmin(asks[0], axis=1))
+            update_statistics(stats, "bid_lens", bids[2])
+            update_statistics(stats, "ask_lens", asks[2])
+            update_statistics(stats, "bid_vols", bids[1].sum(axis=1))
+            update_statistics(stats, "ask_vols", asks[1].sum(axis=1))
+
+            if not store:
+                continue
+
+            # If it is not 1m data then skip
+            timestamps = np.array([entry.get("timestamp") for entry in table], dtype=np.int64)
+            is_1m = timestamps % 60_000 == 0
+            if not is_1m.any():
+                continue
+
+            # Transform packed records to data frame with features
+            # ---
+            df = packed_depth_to_features(
+                timestamps[is_1m],
+                tuple(a[is_1m] for a in bids), tuple(a[is_1m] for a in asks),
+                windows, bin_size
+            )
+            # ---
+            df["timestamp"] = pd.to_datetime(df["timestamp"], unit='ms')
+            df = df.set_index("timestamp").sort_index()
+
+            # Continuous index from the last stored timestamp (or from the first record of the file)
+            start = df.index[0] if last_ts is None else last_ts + pd.Timedelta(minutes=1)
+            end = df.index[-1]
+            if end < start:
+                continue  # Records are older than the stored ones
+            index = pd.date_range(start, end, freq="min")
+            df_out = pd.DataFrame(index=index).join(df.loc[start:])
+            df_out = df_out.reset_index().rename(columns={"index": "timestamp"})
+
+            # Make timestamp conform to klines: it has to be start of 1m interval (and not end as it is in collected depth data)
+            # Move forward (down) - use previous timestamp (the last timestamp of the previous chunk for its first row)
+            df_out["timestamp"] = df_out["timestamp"].shift(periods=1)
+            if last_ts is not None:
+                df_out.loc[0, "timestamp"] = last_ts
+            last_ts = end
+
+            # Store file with features
+            df_out.to_csv(out_path, mode="w" if header else "a", header=header, index=False, float_format="%.4f")
+            header = False
+
+    return stats
+
+
+def _map_files(paths, store=True):
+    """Process files by a pool of processes and generate their statistics (in the order of files)."""
+    if max_workers == 1 or len(paths) <= 1:
+        yield from (process_file(path, store) for path in paths)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(process_file, paths, [store] * len(paths))
 
 
 def main(args=None):
@@ -173,50 +304,13 @@ def main(args=None):
     print(f"Start processing...")
 
     paths = get_symbol_files(symbol)
-    for path in paths:
-
-        # Load file as a list of dict records
-        bad_lines = 0
-        table = []
-        with open(path, 'r') as f:
-            for line in f:
-                try:
-                    entry = json.loads(line)
-                except:
-                    bad_lines += 1
-                    continue
-                # File can contain error lines which we skip
-                if not entry.get("bids") or not entry.get("asks"):
-                    bad_lines += 1
-                    continue
-                # If it is not 1m data then skip
-                timestamp = entry.get("timestamp")
-                if timestamp % 60_000 != 0:
-                    continue
-                # Replace all price-volume strings by floats
-                bids = [[float(x[0]), float(x[1])] for x in entry.get("bids")]
-                asks = [[float(x[0]), float(x[1])] for x in entry.get("asks")]
-                entry["bids"] = bids
-                entry["asks"] = asks
-                table.append(entry)
-
-        # Transform json table to data frame with features
-        # ---
-        df = depth_to_df(table)
-        # ---
-        df = df.reset_index().rename(columns={"index": "timestamp"})
-
-        # Make timestamp conform to klines: it has to be start of 1m interval (and not end as it is in collected depth data)
-        df["timestamp"] = df["timestamp"].shift(periods=1)  # Move forward (down) - use previous timestamp
-
-        # Store file with features
-        df.to_csv(path.with_suffix('.csv').name, index=False, float_format="%.4f")
-
+    stats = new_statistics()
+    for path, file_stats in zip(paths, _map_files(paths)):
         print(f"Finished processing file: {path}")
+        print(f"Bad lines: {file_stats['bad_lines']}")
+        merge_statistics(stats, file_stats)
 
-        print(f"Bad lines: {bad_lines}")
-
-        pass
+    print_statistics(stats)
 
     elapsed = datetime.now() - start_dt
     print(f"Finished processing in {int(elapsed.total_seconds())} seconds.")
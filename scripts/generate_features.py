@@ -11,6 +11,8 @@ import pandas as pd
 
 from service.App import *
 from common.feature_generation import *
+from common.feature_plan import FeaturePlan
+from common.jit import enable_jit
 from common.label_generation import *
 
 #
@@ -21,11 +23,21 @@ class P:
 
     in_nrows = 10_000_000
 
+    use_feature_plan = True  # Compute only configured features (App.config["features_*"]) sharing intermediate results
+
+    # Out-of-core mode. If chunk size (number of rows) is specified, then the source file is processed in blocks
+    # and peak memory is bounded by the chunk size rather than the file size. The output is the same as in memory.
+    chunk_size = None  # 1_000_000
+    past_halo = 1440  # Largest past window of features (kline base window)
+    future_halo = 300  # Largest future window of labels (close_area_future_300)
+
 
 @click.command()
 @click.option('--config_file', '-c', type=click.Path(), default='', help='Configuration file name')
 def main(config_file):
     load_config(config_file)
+    if App.config.get("jit"):
+        enable_jit()
 
     freq = "1m"
     symbol = App.config["symbol"]
@@ -36,46 +48,127 @@ def main(config_file):
 
     start_dt = datetime.now()
 
+    in_path = (data_path / f"{symbol}-{freq}.csv").resolve()
+
+    out_file_name = f"{symbol}-{freq}-features.csv"
+    out_file = (data_path / out_file_name).resolve()
+
+    if P.chunk_size:
+        generate_chunked(in_path, out_file)
+    else:
+        generate_in_memory(in_path, out_file)
+
+    elapsed = datetime.now() - start_dt
+    print(f"Finished feature generation in {int(elapsed.total_seconds())} seconds")
+    print(f"Output file location: {out_file}")
+
+
+def generate_in_memory(in_path, out_file):
     #
     # Load historic data
     #
-    in_path = (data_path / f"{symbol}-{freq}.csv").resolve()
-
     print(f"Loading data from source file {str(in_path)}...")
 
     in_df = pd.read_csv(in_path, parse_dates=['timestamp'], nrows=P.in_nrows)
 
     print(f"Finished loading {len(in_df)} records with {len(in_df.columns)} columns.")
 
+    generate_features_and_labels(in_df)
+
+    #
+    # Store feature matrix in output file
+    #
+    print(f"Storing feature matrix with {len(in_df)} records and {len(in_df.columns)} columns in output file...")
+
+    in_df.to_csv(out_file, index=False, float_format="%.4f")
+
+    #in_df.to_parquet(out_path.with_suffix('.parquet'), engine='auto', compression=None, index=None, partition_cols=None)
+
+
+def generate_chunked(in_path, out_file):
+    """
+    Process the source file in blocks of rows. Each block is extended by a halo of past rows (needed by features)
+    and future rows (needed by labels) which are used for computations but not stored.
+    Hence, each stored row is computed from the same data as in the in-memory mode.
+    """
+    print(f"Processing source file {str(in_path)} in chunks of {P.chunk_size} rows...")
+
+    reader = pd.read_csv(in_path, parse_dates=['timestamp'], nrows=P.in_nrows, chunksize=P.chunk_size)
+
+    buffer = None  # Source rows: past halo (already stored) followed by rows which have not been stored yet
+    halo_count = 0  # Number of past halo rows at the start of the buffer
+    stored_count = 0
+    for chunk in reader:
+        buffer = chunk if buffer is None else pd.concat([buffer, chunk], ignore_index=True)
+
+        end = len(buffer) - P.future_halo  # Rows after it do not have enough future rows
+        if end <= halo_count:
+            continue
+
+        stored_count += _store_rows(buffer, halo_count, end, out_file, header=(stored_count == 0))
+
+        buffer = buffer.iloc[max(0, end - P.past_halo):].reset_index(drop=True)
+        halo_count = min(end, P.past_halo)
+
+    if buffer is not None and len(buffer) > halo_count:  # Last rows do not have future rows (as in the in-memory mode)
+        stored_count += _store_rows(buffer, halo_count, len(buffer), out_file, header=(stored_count == 0))
+
+    print(f"Stored {stored_count} records.")
+
+
+def _store_rows(buffer, start, end, out_file, header):
+    """Generate features and labels for the buffer and append rows from start to end to the output file."""
+    df = buffer.copy()
+    generate_features_and_labels(df, verbose=False)
+    df.iloc[start:end].to_csv(out_file, mode="w" if header else "a", header=header, index=False, float_format="%.4f")
+    print(f"Stored {end - start} records.")
+    return end - start
+
+
+def generate_features_and_labels(in_df, verbose=True):
+    """Add feature columns and label columns to the data frame."""
+    log = print if verbose else lambda *args: None
+
     #
     # Generate derived features
     #
+    workers = App.config.get("feature_workers", 1)
+    dtype = App.config.get("feature_dtype", "float64")
 
     if "kline" in P.feature_sets:
-        print(f"Generating klines features...")
-        k_features = generate_features(in_df)
-        print(f"Finished generating {len(k_features)} kline features")
+        log(f"Generating klines features...")
+        if P.use_feature_plan:
+            k_features = FeaturePlan(App.config["features_kline"], "kline").execute(in_df, workers, dtype)
+        else:
+            k_features = generate_features(in_df, workers=workers)
+        log(f"Finished generating {len(k_features)} kline features")
     else:
         k_features = []
 
     if "futur" in P.feature_sets:
-        print(f"Generating futur features...")
-        f_features = generate_features_futur(in_df)
-        print(f"Finished generating {len(f_features)} futur features")
+        log(f"Generating futur features...")
+        if P.use_feature_plan:
+            f_features = FeaturePlan(App.config["features_futur"], "futur").execute(in_df, workers, dtype)
+        else:
+            f_features = generate_features_futur(in_df, workers=workers)
+        log(f"Finished generating {len(f_features)} futur features")
     else:
         f_features = []
 
     if "depth" in P.feature_sets:
-        print(f"Generating depth features...")
-        d_features = generate_features_depth(in_df)
-        print(f"Finished generating {len(f_features)} depth features")
+        log(f"Generating depth features...")
+        if P.use_feature_plan:
+            d_features = FeaturePlan(App.config["features_depth"], "depth").execute(in_df, workers, dtype)
+        else:
+            d_features = generate_features_depth(in_df)
+        log(f"Finished generating {len(d_features)} depth features")
     else:
         d_features = []
 
     #
     # Generate labels (always the same, currently based on kline data which must be therefore present)
     #
-    print(f"Generating labels...")
+    log(f"Generating labels...")
     labels = []
 
     # Binary labels whether max has exceeded a threshold or not
@@ -84,23 +177,11 @@ def main(config_file):
     # Numeric label which is ration between areas over and under the latest price
     labels += add_area_ratio(in_df, is_future=True, column_name="close", windows=[60, 120, 180, 300], suffix = "_area_future")
 
-    print(f"Finished generating {len(labels)} labels")
-
-    #
-    # Store feature matrix in output file
-    #
-    out_file_name = f"{symbol}-{freq}-features.csv"
-    out_file = (data_path / out_file_name).resolve()
+    log(f"Finished generating {len(labels)} labels")
 
-    print(f"Storing feature matrix with {len(in_df)} records and {len(in_df.columns)} columns in output file...")
+    to_float_dtype(in_df, k_features + f_features + d_features + labels, dtype)  # Also features generated without plans
 
-    in_df.to_csv(out_file, index=False, float_format="%.4f")
-
-    #in_df.to_parquet(out_path.with_suffix('.parquet'), engine='auto', compression=None, index=None, partition_cols=None)
-
-    elapsed = datetime.now() - start_dt
-    print(f"Finished feature generation in {int(elapsed.total_seconds())} seconds")
-    print(f"Output file location: {out_file}")
+    return k_features + f_features + d_features, labels
 
 
 if __name__ == '__main__':
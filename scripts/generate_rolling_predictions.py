@@ -6,7 +6,8 @@ from datetime import datetime, timezone, timedelta
 from typing import Union
 import json
 import pickle
-from concurrent.futures import ProcessPoolExecutor
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import click
 
 import numpy as np
@@ -16,6 +17,7 @@ from service.App import *
 from common.utils import *
 from common.classifiers import *
 from common.feature_generation import *
+from common.shared_frame import SharedFrame
 
 """
 Generate label predictions for the whole input feature matrix by iteratively training models using historic data and predicting labels for some future horizon.
@@ -95,6 +97,85 @@ params_lc = {
 }
 
 
+# Train-predict functions and parameters of the algorithms
+algorithms = {
+    "gb": (train_predict_gb, params_gb),
+    "nn": (train_predict_nn, params_nn),
+    "lc": (train_predict_lc, params_lc),
+}
+
+algorithm_costs = {"nn": 3, "gb": 2, "lc": 1}  # Relative training time used to order tasks
+
+
+def get_feature_set_params():
+    """Features, name tag and train length (rows) of each feature set."""
+    return {
+        "kline": dict(features=P.features_kline, name_tag="_k_", train_length=int(1.5 * 525_600)),
+        "futur": dict(features=P.features_futur, name_tag="_f_", train_length=int(4 * 43_800)),
+    }
+
+
+def step_tasks(step: int, predict_start: int, stride: int):
+    """
+    Train-predict tasks of one step: one for each feature set, label and algorithm.
+    Tasks contain only row ranges and column names (not data) so that they are cheap to send to worker processes.
+    """
+    tasks = []
+    predict_end = predict_start + stride
+    for feature_set, params in get_feature_set_params().items():
+        if feature_set not in P.feature_sets:
+            continue
+        # We exclude recent objects from training, because they do not have labels yet - the labels are in future
+        # In real (stream) data, we will have null labels for recent objects. During simulation, labels are available and hence we need to ignore/exclude them manually
+        train_end = predict_start - P.labels_horizon - 1
+        train_start = max(train_end - params["train_length"], 0)
+        for label in P.labels:  # Train-predict different labels (and algorithms) using same X
+            for algorithm in algorithms:
+                tasks.append(dict(
+                    step=step, score_column_name=label + params["name_tag"] + algorithm,
+                    features=params["features"], label=label, algorithm=algorithm,
+                    train_start=int(train_start), train_end=int(train_end), predict_start=predict_start, predict_end=predict_end,
+                ))
+    return tasks
+
+
+_worker_frames = None  # Shared features and labels opened by the (worker) process
+
+
+def init_worker(frame_specs: dict):
+    """Initialize a worker process: open shared features and labels and import frameworks of all algorithms."""
+    global _worker_frames
+    _worker_frames = {name: SharedFrame.open(spec) for name, spec in frame_specs.items()}
+    import_frameworks(list(algorithms.keys()))
+
+
+def close_worker():
+    """Close the shared frames opened by init_worker() in this process."""
+    global _worker_frames
+    _worker_frames = None
+
+
+def unique_file(folder: Path, name: str):
+    """New empty .npy file with a unique name in the folder."""
+    fd, file = tempfile.mkstemp(dir=folder, prefix=f"{name}-", suffix=".npy")
+    os.close(fd)
+    return Path(file)
+
+
+def train_predict_task(task: dict):
+    """Train a model on the train rows of the task and return its predictions for the predict rows."""
+    features = task["features"]
+    features_frame, labels_frame = _worker_frames["features"], _worker_frames["labels"]
+    train_start, train_end = task["train_start"], task["train_end"]  # Row positions are equal to index
+    row_mask = features_frame.notnull_mask(train_start, train_end, features)  # Same as dropna(subset=features)
+    df_X = features_frame.get(train_start, train_end, features, row_mask)
+    df_y = labels_frame.get_column(train_start, train_end, task["label"], row_mask)
+    df_X_test = features_frame.get(task["predict_start"], task["predict_end"], features)
+
+    train_predict, params = algorithms[task["algorithm"]]
+    return train_predict(df_X, df_y, df_X_test, params)
+
+
 #
 # Main
 #
@@ -118,6 +199,15 @@ def main(config_file):
     # Load feature matrix
     #
     print(f"Loading feature matrix from input file...")
+
+    # Only necessary columns are loaded and features are parsed directly as the configured type (float32 halves memory)
+    features = []
+    if "kline" in P.feature_sets:
+        features += P.features_kline
+    if "futur" in P.feature_sets:
+        features += P.features_futur
+    columns = set(P.in_features_kline + features + P.labels)
+    dtypes = {f: App.config.get("feature_dtype", "float64") for f in features}
     start_dt = datetime.now()
 
     in_file_name = f"{symbol}-{freq}-features.csv"
@@ -127,7 +217,7 @@ def main(config_file):
         return
 
     if in_file_name.endswith(".csv"):
-        in_df = pd.read_csv(in_path, parse_dates=['timestamp'], nrows=P.in_nrows)  # , skiprows=range(1,P.skiprows)
+        in_df = pd.read_csv(in_path, parse_dates=['timestamp'], nrows=P.in_nrows, usecols=lambda c: c in columns, dtype=dtypes)  # , skiprows=range(1,P.skiprows)
         #in_df.to_pickle('aaa.pickle')
     elif in_file_name.endswith(".parquet"):
         in_df = pd.read_parquet(in_path)
@@ -137,19 +227,17 @@ def main(config_file):
         print(f"ERROR: Unknown input file extension. Only csv and parquet are supported.")
 
     print(f"Feature matrix loaded. Length: {len(in_df)}. Width: {len(in_df.columns)}")
+    to_float_dtype(in_df, features, App.config.get("feature_dtype", "float64"))  # Parquet and pickle files are not parsed
 
     if P.in_nrows_tail:
         in_df = in_df.tail(P.in_nrows_tail)
 
     for label in P.labels:
-        in_df[label] = in_df[label].astype(int)  # "category" NN does not work without this
+        in_df[label] = in_df[label].astype(np.int8)  # "category" NN does not work without this. Binary labels need one byte
 
     # Select necessary features and label
     all_features = P.in_features_kline.copy()
-    if "kline" in P.feature_sets:
-        all_features += P.features_kline
-    if "futur" in P.feature_sets:
-        all_features += P.features_futur
+    all_features += features
     all_features += P.labels
     in_df = in_df[all_features]
 
@@ -176,194 +264,77 @@ def main(config_file):
 
     print(f"Starting rolling predict loop with {steps} steps. Each step with {stride} horizon...")
 
-    # Result rows. Here store only rows for which we make predictions
-    labels_hat_df = pd.DataFrame()
-
+    #
+    # Train-predict tasks of all steps (except for steps with existing results)
+    #
     step_pickle_files = []
+    tasks = []
     for step in range(steps):
-
-        print(f"\n===>>> Start step {step}/{steps}")
         step_fname = f"step{step}of{steps}.pickle"
         step_pickle_file = work_path / step_fname
+        step_pickle_files += [step_pickle_file]
         if os.path.exists(step_pickle_file):
-            print(f"Found existing Pickle for step, skipping...")
-            step_pickle_files += [step_pickle_file]
+            print(f"Found existing Pickle for step {step}, skipping...")
             continue
-
-        # Predict data
-
-        predict_start = prediction_start + (step * stride)
-        predict_end = predict_start + stride
-
-        predict_df = in_df.iloc[predict_start:predict_end]  # We assume that iloc is equal to index
-        # predict_df = predict_df.dropna(subset=features)  # Nans will be droped by the algorithms themselves
-
-        # Here we will collect predicted columns
-        predict_labels_df = pd.DataFrame(index=predict_df.index)
-
-        # ===
-        # kline feature set
-        # ===
-        if "kline" in P.feature_sets:
-            features = P.features_kline
-            name_tag = "_k_"
-            train_length = int(1.5 * 525_600)  # 1.5 * 525_600
-
-            print(f"Start training 'kline' package with {len(features)} features, name tag {name_tag}', and train length {train_length}")
-
-            # Predict data
-
-            df_X_test = predict_df[features]
-            #df_y_test = predict_df[predict_label]  # It will be set in the loop over labels
-
-            # Train data
-
-            # We exclude recent objects from training, because they do not have labels yet - the labels are in future
-            # In real (stream) data, we will have null labels for recent objects. During simulation, labels are available and hence we need to ignore/exclude them manually
-            train_end = predict_start - P.labels_horizon - 1
-            train_start = train_end - train_length
-            train_start = 0 if train_start < 0 else train_start
-
-            train_df = in_df.iloc[int(train_start):int(train_end)]  # We assume that iloc is equal to index
-            train_df = train_df.dropna(subset=features)
-
-            df_X = train_df[features]
-            #df_y = train_df[predict_label]  # It will be set in the loop over labels
-
-            print(f"Train range: [{train_start}, {train_end}]={train_end-train_start}. Prediction range: [{predict_start}, {predict_end}]={predict_end-predict_start}. ")
-
-            for label in P.labels:  # Train-predict different labels (and algorithms) using same X
-                df_y = train_df[label]
-                df_y_test = predict_df[label]
-
-                if P.use_multiprocessing:
-                    # Submit train-predict algorithms to the pool
-                    execution_results = dict()
-                    with ProcessPoolExecutor(max_workers=P.max_workers) as executor:
-                        # --- GB
-                        score_column_name = label + name_tag + "gb"
-                        execution_results[score_column_name] = executor.submit(train_predict_gb, df_X, df_y, df_X_test, params_gb)
-
-                        # --- NN
-                        score_column_name = label + name_tag + "nn"
-                        execution_results[score_column_name] = executor.submit(train_predict_nn, df_X, df_y, df_X_test, params_nn)
-
-                        # --- LC
-                        score_column_name = label + name_tag + "lc"
-                        execution_results[score_column_name] = executor.submit(train_predict_lc, df_X, df_y, df_X_test, params_lc)
-
-                    # Process the results as the tasks are finished
-                    for score_column_name, future in execution_results.items():
-                        predict_labels_df[score_column_name] = future.result()
-                        if future.exception():
-                            print(f"Exception while train-predict {score_column_name}.")
-                            return
-                else:  # No multiprocessing - sequential execution
-                    # --- GB
-                    y_hat = train_predict_gb(df_X, df_y, df_X_test, params=params_gb)
-                    score_column_name = label + name_tag + "gb"
-                    predict_labels_df[score_column_name] = y_hat
-
-                    # --- NN
-                    y_hat = train_predict_nn(df_X, df_y, df_X_test, params=params_nn)
-                    score_column_name = label + name_tag + "nn"
-                    predict_labels_df[score_column_name] = y_hat
-
-                    # --- LC
-                    y_hat = train_predict_lc(df_X, df_y, df_X_test, params=params_lc)
-                    score_column_name = label + name_tag + "lc"
-                    predict_labels_df[score_column_name] = y_hat
-
-        # ===
-        # futur feature set
-        # ===
-        if "futur" in P.feature_sets:
-            features = P.features_futur
-            name_tag = "_f_"
-            train_length = int(4 * 43_800)
-
-            print(f"Start training 'futur' package with {len(features)} features, name tag {name_tag}', and train length {train_length}")
-
-            # Predict data
-
-            df_X_test = predict_df[features]
-            #df_y_test = predict_df[predict_label]  # It will be set in the loop over labels
-
-            # Train data
-
-            # We exclude recent objects from training, because they do not have labels yet - the labels are in future
-            # In real (stream) data, we will have null labels for recent objects. During simulation, labels are available and hence we need to ignore/exclude them manually
-            train_end = predict_start - P.labels_horizon - 1
-            train_start = train_end - train_length
-            train_start = 0 if train_start < 0 else train_start
-
-            train_df = in_df.iloc[int(train_start):int(train_end)]  # We assume that iloc is equal to index
-            train_df = train_df.dropna(subset=features)
-
-            df_X = train_df[features]
-            #df_y = train_df[predict_label]  # It will be set in the loop over labels
-
-            print(f"Train range: [{train_start}, {train_end}]={train_end-train_start}. Prediction range: [{predict_start}, {predict_end}]={predict_end-predict_start}. ")
-
-            for label in P.labels:  # Train-predict different labels (and algorithms) using same X
-                df_y = train_df[label]
-                df_y_test = predict_df[label]
-
-                if P.use_multiprocessing:
-                    # Submit train-predict algorithms to the pool
-                    execution_results = dict()
-                    with ProcessPoolExecutor(max_workers=P.max_workers) as executor:
-                        # --- GB
-                        score_column_name = label + name_tag + "gb"
-                        execution_results[score_column_name] = executor.submit(train_predict_gb, df_X, df_y, df_X_test, params_gb)
-
-                        # --- NN
-                        score_column_name = label + name_tag + "nn"
-                        execution_results[score_column_name] = executor.submit(train_predict_nn, df_X, df_y, df_X_test, params_nn)
-
-                        # --- LC
-                        score_column_name = label + name_tag + "lc"
-                        execution_results[score_column_name] = executor.submit(train_predict_lc, df_X, df_y, df_X_test, params_lc)
-
-                    # Process the results as the tasks are finished
-                    for score_column_name, future in execution_results.items():
-                        predict_labels_df[score_column_name] = future.result()
-                        if future.exception():
-                            print(f"Exception while train-predict {score_column_name}.")
-                            return
-                else:  # No multiprocessing - sequential execution
-                    # --- GB
-                    y_hat = train_predict_gb(df_X, df_y, df_X_test, params=params_gb)
-                    score_column_name = label + name_tag + "gb"
-                    predict_labels_df[score_column_name] = y_hat
-
-                    # --- NN
-                    y_hat = train_predict_nn(df_X, df_y, df_X_test, params=params_nn)
-                    score_column_name = label + name_tag + "nn"
-                    predict_labels_df[score_column_name] = y_hat
-
-                    # --- LC
-                    y_hat = train_predict_lc(df_X, df_y, df_X_test, params=params_lc)
-                    score_column_name = label + name_tag + "lc"
-                    predict_labels_df[score_column_name] = y_hat
-
-        #
-        # Append predicted *rows* to the end of previous predicted rows
-        #
-        # Predictions for all labels and histories (and algorithms) have been generated for the iteration
-        #labels_hat_df = labels_hat_df.append(predict_labels_df)
-        # Save your work:
-        #  save each `predict_labels_df` to a separate pickle file, load and join at the end
-        #  need to skip steps (and appropriate data) if previous step files exist
-        #  save as <labelname>.pickle
-        predict_labels_df.to_pickle(step_pickle_file)
-        step_pickle_files += [step_pickle_file]
-
-        print(f"End step {step}/{steps}.")
-        print(f"Predicted {len(predict_labels_df.columns)} labels.")
-
-    for step_file in step_pickle_files:
-        labels_hat_df = labels_hat_df.append(pd.read_pickle(step_file))
+        tasks += step_tasks(step, prediction_start + (step * stride), stride)
+
+    # Steps are finished in their order. Within a step, expensive tasks are started first so that workers are not idle at the end
+    tasks.sort(key=lambda t: (t["step"], -algorithm_costs[t["algorithm"]]))
+
+    # Predicted columns of each step (a step is stored when all its tasks are finished)
+    step_results = {}
+    step_task_counts = {}
+    for task in tasks:
+        step_task_counts[task["step"]] = step_task_counts.get(task["step"], 0) + 1
+
+    def store_result(task, y_hat):
+        step = task["step"]
+        predict_labels_df = step_results.setdefault(step, pd.DataFrame(index=in_df.index[task["predict_start"]:task["predict_end"]]))
+        predict_labels_df[task["score_column_name"]] = y_hat
+        step_task_counts[step] -= 1
+        if not step_task_counts[step]:
+            # Columns in the same order as in sequential execution
+            columns = [t["score_column_name"] for t in step_tasks(step, task["predict_start"], stride)]
+            step_results.pop(step)[columns].to_pickle(step_pickle_files[step])
+            print(f"End step {step}/{steps}. Predicted {len(columns)} labels.")
+
+    # Features and labels are written once to memory-mapped files and tasks get their rows from these files
+    # Feature sets are stored one after another so that their columns are returned without copying
+    # Files are deleted even if some task fails. Their names are unique so that runs with the same work folder do not overwrite them
+    files = {name: unique_file(work_path, name) for name in ["features", "labels"]}
+    frames = {}
+    try:
+        frames["features"] = SharedFrame.create(in_df, list(dict.fromkeys(features)), files["features"])
+        frames["labels"] = SharedFrame.create(in_df, P.labels, files["labels"])
+        frame_specs = {name: frame.spec() for name, frame in frames.items()}
+
+        print(f"Submitting {len(tasks)} train-predict tasks for {len(step_task_counts)} steps...")
+
+        if P.use_multiprocessing:
+            # One pool for all tasks. Workers open the shared files and import frameworks once when they are started
+            with ProcessPoolExecutor(max_workers=P.max_workers, initializer=init_worker, initargs=(frame_specs,)) as executor:
+                futures = {executor.submit(train_predict_task, task): task for task in tasks}
+                for future in as_completed(futures):
+                    task = futures[future]
+                    try:
+                        y_hat = future.result()
+                    except Exception as e:
+                        print(f"Exception while train-predict {task['score_column_name']} in step {task['step']}: {e}")
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        return
+                    store_result(task, y_hat)
+        else:  # No multiprocessing - sequential execution
+            init_worker(frame_specs)
+            for task in sorted(tasks, key=lambda t: t["step"]):
+                store_result(task, train_predict_task(task))
+    finally:
+        close_worker()  # Frames opened by this process in sequential execution have to be closed before their files are deleted
+        for frame in frames.values():
+            frame.delete()
+        for file in files.values():  # Files of frames which could not be created
+            file.unlink(missing_ok=True)
+
+    labels_hat_df = pd.concat([pd.read_pickle(step_file) for step_file in step_pickle_files])
 
     # End of loop over prediction steps
     print("")
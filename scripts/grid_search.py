@@ -9,6 +9,8 @@ import pandas as pd
 
 import matplotlib.pyplot as plt
 
+from sklearn.model_selection import ParameterGrid
+
 from service.App import *
 from common.utils import *
 from common.classifiers import *
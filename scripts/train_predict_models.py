@@ -13,6 +13,7 @@ from service.App import *
 from common.utils import *
 from common.classifiers import *
 from common.feature_generation import *
+from common.model_bundle import save_model_bundle
 
 """
 Use input feature matrix to train *one* label predict model for each label using all specified historic data.
@@ -37,6 +38,7 @@ Parameters:
 #
 class P:
     feature_sets = ["futur", "kline"]  # kline, futur
+    algorithms = ["gb", "nn", "lc"]  # gb, nn, lc
 
     labels = App.config["labels"]
     features_kline = App.config["features_kline"]
@@ -99,6 +101,15 @@ def main(config_file):
     # Load feature matrix
     #
     print(f"Loading feature matrix from input file...")
+
+    # Only necessary columns are loaded and features are parsed directly as the configured type (float32 halves memory)
+    features = []
+    if "kline" in P.feature_sets:
+        features += P.features_kline
+    if "futur" in P.feature_sets:
+        features += P.features_futur
+    columns = set(['timestamp'] + features + P.labels)
+    dtypes = {f: App.config.get("feature_dtype", "float64") for f in features}
     start_dt = datetime.now()
 
     in_file_name = f"{symbol}-{freq}-features.csv"
@@ -109,7 +120,7 @@ def main(config_file):
 
     in_df = None
     if in_file_name.endswith(".csv"):
-        in_df = pd.read_csv(in_path, parse_dates=['timestamp'], nrows=P.in_nrows)
+        in_df = pd.read_csv(in_path, parse_dates=['timestamp'], nrows=P.in_nrows, usecols=lambda c: c in columns, dtype=dtypes)
     elif in_file_name.endswith(".parquet"):
         in_df = pd.read_parquet(in_path)
     elif in_file_name.endswith(".pickle"):
@@ -118,19 +129,17 @@ def main(config_file):
         print(f"ERROR: Unknown input file extension. Only csv and parquet are supported.")
 
     print(f"Feature matrix loaded. Length: {len(in_df)}. Width: {len(in_df.columns)}")
+    to_float_dtype(in_df, features, App.config.get("feature_dtype", "float64"))  # Parquet and pickle files are not parsed
 
     if P.in_nrows_tail:
         in_df = in_df.tail(P.in_nrows_tail)
 
     for label in P.labels:
-        in_df[label] = in_df[label].astype(int)  # "category" NN does not work without this
+        in_df[label] = in_df[label].astype(np.int8)  # "category" NN does not work without this. Binary labels need one byte
 
     # Select necessary features and label
     all_features = []
-    if "kline" in P.feature_sets:
-        all_features += P.features_kline
-    if "futur" in P.feature_sets:
-        all_features += P.features_futur
+    all_features += features
     all_features += P.labels
     in_df = in_df[all_features]
 
@@ -166,28 +175,31 @@ def main(config_file):
             df_y = train_df[label]
 
             # --- GB
-            score_column_name = label + name_tag + "gb"
-            print(f"Train '{score_column_name}'... ")
-            model_pair = train_gb(df_X, df_y, params=params_gb)
-            models[score_column_name] = model_pair
-            df_y_hat = predict_gb(model_pair, df_X)
-            scores[score_column_name] = compute_scores(df_y, df_y_hat)
+            if "gb" in P.algorithms:
+                score_column_name = label + name_tag + "gb"
+                print(f"Train '{score_column_name}'... ")
+                model_pair = train_gb(df_X, df_y, params=params_gb)
+                models[score_column_name] = model_pair
+                df_y_hat = predict_gb(model_pair, df_X)
+                scores[score_column_name] = compute_scores(df_y, df_y_hat)
 
             # --- NN
-            score_column_name = label + name_tag + "nn"
-            print(f"Train '{score_column_name}'... ")
-            model_pair = train_nn(df_X, df_y, params=params_nn)
-            models[score_column_name] = model_pair
-            df_y_hat = predict_nn(model_pair, df_X)
-            scores[score_column_name] = compute_scores(df_y, df_y_hat)
+            if "nn" in P.algorithms:
+                score_column_name = label + name_tag + "nn"
+                print(f"Train '{score_column_name}'... ")
+                model_pair = train_nn(df_X, df_y, params=params_nn)
+                models[score_column_name] = model_pair
+                df_y_hat = predict_nn(model_pair, df_X)
+                scores[score_column_name] = compute_scores(df_y, df_y_hat)
 
             # --- LC
-            score_column_name = label + name_tag + "lc"
-            print(f"Train '{score_column_name}'... ")
-            model_pair = train_lc(df_X, df_y, params=params_lc)
-            models[score_column_name] = model_pair
-            df_y_hat = predict_lc(model_pair, df_X)
-            scores[score_column_name] = compute_scores(df_y, df_y_hat)
+            if "lc" in P.algorithms:
+                score_column_name = label + name_tag + "lc"
+                print(f"Train '{score_column_name}'... ")
+                model_pair = train_lc(df_X, df_y, params=params_lc)
+                models[score_column_name] = model_pair
+                df_y_hat = predict_lc(model_pair, df_X)
+                scores[score_column_name] = compute_scores(df_y, df_y_hat)
 
     # ===
     # futur feature set
@@ -208,28 +220,31 @@ def main(config_file):
             df_y = train_df[label]
 
             # --- GB
-            score_column_name = label + name_tag + "gb"
-            print(f"Train '{score_column_name}'... ")
-            model_pair = train_gb(df_X, df_y, params=params_gb)
-            models[score_column_name] = model_pair
-            df_y_hat = predict_gb(model_pair, df_X)
-            scores[score_column_name] = compute_scores(df_y, df_y_hat)
+            if "gb" in P.algorithms:
+                score_column_name = label + name_tag + "gb"
+                print(f"Train '{score_column_name}'... ")
+                model_pair = train_gb(df_X, df_y, params=params_gb)
+                models[score_column_name] = model_pair
+                df_y_hat = predict_gb(model_pair, df_X)
+                scores[score_column_name] = compute_scores(df_y, df_y_hat)
 
             # --- NN
-            score_column_name = label + name_tag + "nn"
-            print(f"Train '{score_column_name}'... ")
-            model_pair = train_nn(df_X, df_y, params=params_nn)
-            models[score_column_name] = model_pair
-            df_y_hat = predict_nn(model_pair, df_X)
-            scores[score_column_name] = compute_scores(df_y, df_y_hat)
+            if "nn" in P.algorithms:
+                score_column_name = label + name_tag + "nn"
+                print(f"Train '{score_column_name}'... ")
+                model_pair = train_nn(df_X, df_y, params=params_nn)
+                models[score_column_name] = model_pair
+                df_y_hat = predict_nn(model_pair, df_X)
+                scores[score_column_name] = compute_scores(df_y, df_y_hat)
 
             # --- LC
-            score_column_name = label + name_tag + "lc"
-            print(f"Train '{score_column_name}'... ")
-            model_pair = train_lc(df_X, df_y, params=params_lc)
-            models[score_column_name] = model_pair
-            df_y_hat = predict_lc(model_pair, df_X)
-            scores[score_column_name] = compute_scores(df_y, df_y_hat)
+            if "lc" in P.algorithms:
+                score_column_name = label + name_tag + "lc"
+                print(f"Train '{score_column_name}'... ")
+                model_pair = train_lc(df_X, df_y, params=params_lc)
+                models[score_column_name] = model_pair
+                df_y_hat = predict_lc(model_pair, df_X)
+                scores[score_column_name] = compute_scores(df_y, df_y_hat)
 
     #
     # Store all collected models in files
@@ -237,6 +252,12 @@ def main(config_file):
     for score_column_name, model_pair in models.items():
         save_model_pair(out_path, score_column_name, model_pair)
 
+    # Also all models in one file if they are loaded from it
+    bundle = App.config.get("model_bundle")
+    if bundle:
+        bundle_grid = dict(labels=P.labels, feature_sets=P.feature_sets, algorithms=P.algorithms)
+        save_model_bundle(out_path.joinpath(bundle), models, bundle_grid)
+
     print(f"Models stored in path: {out_path.absolute()}")
 
     #
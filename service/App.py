@@ -110,6 +110,19 @@ class App:
 
         # device config
         "lgbm_device_type": "cuda",
+        # How NN models are evaluated: "keras" or "numpy" (exported .npz weights without TensorFlow)
+        "nn_engine": "keras",
+        # How loaded GB models are evaluated: "lightgbm" or "numpy" (flat trees, also exported to .npz, without LightGBM)
+        "gb_engine": "lightgbm",
+        # Bundle file in the model folder with all models (written by train_predict_models). Empty: separate files of model pairs
+        "model_bundle": "",
+
+        # Compile per-row kernels (rolling windows, order book) with numba if it is installed. Also enabled by env var ITB_JIT=1
+        "jit": False,
+        # Threads for computing independent feature families concurrently (0: number of cores, 1: sequential)
+        "feature_workers": 1,
+        # Type of stored features and numeric labels. float32 halves memory (kernels accumulate in float64 anyway). Klines are always float64
+        "feature_dtype": "float64",
 
         # === analyzer (NAMES, also for scripts) ===
 
@@ -176,6 +189,12 @@ class App:
             "analysis": {  # Same for all symbols
                 # History needed to compute derived features. Take maximum aggregation windows from feature generation code (and add something to be sure that we have all what is needed)
                 "features_horizon": 1440+160,
+                # How features of the newest kline are computed: "batch" (whole history), "stream" (incrementally), "parity" (both with comparison)
+                "feature_engine": "batch",
+                # Number of the newest rows scored by models (0 for all rows). The signal score is the mean of their scores (smoothing if more than 1)
+                "score_rows": 1,
+                # Seconds between checks for retrained models in the model folder (0: never). New models are loaded in background after an analysis
+                "model_reload_interval": 0,
             },
             "model": {
                 # Models: [0.4, -0.44], [0.25, -0.52]
@@ -193,6 +212,7 @@ class App:
 
             "percentage_used_for_trade": 20,  # in % to the available USDT quantity, that is, we will derive how much BTC to buy using this percentage
             "limit_price_adjustment": -0.0001,  # Limit price of orders will be better than the latest close price (0 means no change, positive - better for us, negative - worse for us)
+            "use_order_book": False,  # Retrieve order book before creating an order and limit its price to the price of the last level needed to fill it
 
             # Signal model (trade strategy) - currently NOT USED
             "sell_timeout": 70,  # Seconds
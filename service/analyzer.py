@@ -3,7 +3,9 @@ from typing import Union
 import json
 import pickle
 from datetime import datetime, date, timedelta
+import time
 import queue
+import threading
 
 import numpy as np
 import pandas as pd
@@ -12,6 +14,10 @@ from service.App import *
 from common.utils import *
 from common.classifiers import *
 from common.feature_generation import *
+from common.feature_plan import FeaturePlan
+from common.kline_buffer import KlineBuffer
+from common.jit import enable_jit, warm_up
+from common.feature_stream import StreamingFeatures, compare_features
 from common.signal_generation import *
 
 import logging
@@ -40,12 +46,25 @@ class Analyzer:
         # Data state
         #
 
-        # Klines are stored as a dict of lists. Key is a symbol and the list is a list of latest kline records
-        # One kline record is a list of values (not dict) as returned by API: open time, open, high, low, close, volume etc.
+        # Klines are stored as a dict of columnar buffers. Key is a symbol and the buffer stores the latest klines
+        # Klines are received as lists of values (not dict) as returned by API: open time, open, high, low, close, volume etc.
+        # They are parsed once when stored
         self.klines = {}
+        self.unavailable_klines = {}  # Key is a symbol and value is a set of ranges of missing klines which the exchange returned empty
 
         self.queue = queue.Queue()
 
+        # Features of the newest kline can be computed incrementally (stream) instead of for the whole history (batch)
+        # In parity mode, they are computed in both ways and differences are logged
+        self.feature_engine = App.config["signaler"]["analysis"].get("feature_engine", "batch")
+        self.streaming_features = {}  # Key is a symbol
+        self.feature_plan = FeaturePlan(App.config["features_kline"], "kline")  # Batch mode computes only the features used by models
+
+        # Kernels are compiled in advance so that the first analysis does not wait for compilation
+        if App.config.get("jit"):
+            enable_jit()
+        warm_up()
+
         #
         # Load models
         #
@@ -58,7 +77,19 @@ class Analyzer:
         labels = App.config["labels"]
         feature_sets = ["kline"]
         algorithms = ["gb", "nn", "lc"]
-        self.models = load_models(model_path, labels, feature_sets, algorithms)
+        self.model_path = model_path
+        self.model_grid = (labels, feature_sets, algorithms)
+        self.models_signature = get_models_signature(model_path, model_names(*self.model_grid))
+        self.models = load_models(model_path, *self.model_grid)
+        self.ensemble = ModelEnsemble(self.models)  # All models are applied to the feature matrix at once
+
+        # Retrained models are loaded by a background thread after an analysis (so that it is done between analyses)
+        # and then replace the current models. Each analysis uses the ensemble which was current at its start
+        self.last_predict_df = None  # Features of the last analysis used to validate new models
+        self.analyzed = threading.Event()
+        self.model_reload_interval = App.config["signaler"]["analysis"].get("model_reload_interval", 0)
+        if self.model_reload_interval:
+            threading.Thread(target=self.watch_models, name="model_reload", daemon=True).start()
 
         #
         # Start a thread for storing data
@@ -72,8 +103,15 @@ class Analyzer:
         return len(self.klines.get(symbol, []))
 
     def get_last_kline(self, symbol):
+        """The last kline as a list of (parsed) values in the same order as returned by API."""
+        if self.get_klines_count(symbol) > 0:
+            return self.klines.get(symbol).last_kline()
+        else:
+            return None
+
+    def get_last_close_price(self, symbol):
         if self.get_klines_count(symbol) > 0:
-            return self.klines.get(symbol)[-1]
+            return float(self.klines.get(symbol).view("close")[-1])
         else:
             return None
 
@@ -85,6 +123,18 @@ class Analyzer:
         last_kline_ts = last_kline[0]
         return last_kline_ts
 
+    def get_kline_gaps(self, symbol):
+        """Ranges (first and last timestamp) of klines which are missing in the database and have to be requested."""
+        klines_data = self.klines.get(symbol)
+        gaps = klines_data.gaps() if klines_data is not None else []
+        unavailable = self.unavailable_klines.setdefault(symbol, set())
+        unavailable.intersection_update(gaps)  # Forget ranges which have been filled or removed
+        return [gap for gap in gaps if gap not in unavailable]
+
+    def add_unavailable_klines(self, symbol, start_ts, end_ts):
+        """Remember a range of missing klines which the exchange does not have so that it is not requested again."""
+        self.unavailable_klines.setdefault(symbol, set()).add((start_ts, end_ts))
+
     def get_missing_klines_count(self, symbol):
         now_ts = now_timestamp()
         last_kline_ts = self.get_last_kline_ts(symbol)
@@ -111,44 +161,40 @@ class Analyzer:
             # If symbol does not exist then create
             klines_data = self.klines.get(symbol)
             if klines_data is None:
-                self.klines[symbol] = []
-                klines_data = self.klines.get(symbol)
-
-            ts = klines[0][0]  # Very first timestamp of the new data
-
-            # Find kline with this or younger timestamp in the database
-            # same_kline = next((x for x in klines_data if x[0] == ts), None)
-            existing_indexes = [i for i, x in enumerate(klines_data) if x[0] >= ts]
-            #print(f"===>>> Existing tss: {[x[0] for x in klines_data]}")
-            #print(f"===>>> New tss: {[x[0] for x in klines]}")
-            #print(f"===>>> {symbol} Overlap {len(existing_indexes)}. Existing Indexes: {existing_indexes}")
-            if existing_indexes:  # If there is overlap with new klines
-                start = min(existing_indexes)
-                num_deleted = len(klines_data) - start
-                del klines_data[start:]  # Delete starting from the first kline in new data (which will be added below)
-                if len(klines) < num_deleted:  # It is expected that we add same or more klines than deleted
-                    log.error("More klines is deleted by new klines added, than we actually add. Something woring with timestamps and storage logic.")
-
-            # Append new klines
-            klines_data.extend(klines)
-
-            # Remove too old klines
-            kline_window = App.config["signaler"]["analysis"]["features_horizon"]
-            to_delete = len(klines_data) - kline_window
-            if to_delete > 0:
-                del klines_data[:to_delete]
-
-            # Check validity. It has to be an ordered time series with certain frequency
-            for i, kline in enumerate(self.klines.get(symbol)):
-                ts = kline[0]
-                if i > 0:
-                    if ts - prev_ts != 60_000:
-                        log.error("Wrong sequence of klines. They are expected to be a regular time series with 1m frequency.")
-                prev_ts = kline[0]
+                kline_window = App.config["signaler"]["analysis"]["features_horizon"]
+                klines_data = KlineBuffer(kline_window)  # Prices are float64 (feature_dtype is applied only to computed features)
+                self.klines[symbol] = klines_data
+
+            # Overwrite klines with the same timestamps and append newer klines (too old klines are removed)
+            stored_count = klines_data.upsert(klines)
+            if stored_count < len(klines):
+                log.warning(f"{len(klines) - stored_count} klines are not stored because they are older than the stored klines or not aligned with 1m intervals.")
+
+            # Update incremental features (klines which have been already processed are ignored)
+            if self.feature_engine in ["stream", "parity"]:
+                engine = self.get_streaming_features(symbol)
+                if klines_data.history_changed:  # Older klines were changed or gaps appeared so recompute from the buffer (gaps are nan rows)
+                    engine.reset()
+                    klines = klines_data.to_klines(last=engine.history)
+                for kline in klines:
+                    engine.update(kline)
+
+            # Check validity. It is a regular time series with 1m frequency but some klines might be missing
+            gaps = klines_data.gaps()
+            if gaps:
+                log.error(f"Klines are missing in {len(gaps)} ranges of timestamps: {gaps}")
 
             # Debug message about the last received kline end and current ts (which must be less than 1m - rather small delay)
             log.debug(f"Stored klines. Total {len(klines_data)} in db. Last kline end: {self.get_last_kline_ts(symbol)+60_000}. Current time: {now_ts}")
 
+    def get_streaming_features(self, symbol):
+        """Incremental feature engine for the symbol (created if it does not exist)."""
+        engine = self.streaming_features.get(symbol)
+        if engine is None:
+            engine = StreamingFeatures(App.config["features_kline"])
+            self.streaming_features[symbol] = engine
+        return engine
+
     def store_depth(self, depths: list, freq):
         """
         Persistently store order books from the input list. Each entry is one response from order book request for one symbol.
@@ -243,6 +289,64 @@ class Analyzer:
                 with open(file, 'a+') as f:
                     f.write(data_str + "\n")
 
+    #
+    # Model reload
+    #
+
+    def watch_models(self):
+        """Check for changed models after analyses (at most once per reload interval) and replace the current models with them."""
+        last_check = time.monotonic()
+        pending_signature = None  # Changed models are loaded when they stop changing (are not being written)
+        while True:
+            self.analyzed.wait()
+            self.analyzed.clear()
+            if time.monotonic() - last_check < self.model_reload_interval:
+                continue
+            last_check = time.monotonic()
+
+            signature = get_models_signature(self.model_path, model_names(*self.model_grid))
+            if signature is None or signature == self.models_signature:
+                pending_signature = None
+            elif signature != pending_signature:
+                pending_signature = signature
+            else:
+                self.reload_models(signature)
+                pending_signature = None
+
+    def reload_models(self, signature=None):
+        """
+        Load models from the model folder, validate them on the features of the last analysis and replace the current models.
+        The current models are kept if the new models cannot be loaded or are not valid.
+
+        :return: True if the models have been replaced
+        """
+        start_dt = datetime.now()
+        try:
+            models = load_models(self.model_path, *self.model_grid)
+            ensemble = ModelEnsemble(models)
+            self.validate_models(ensemble)
+        except Exception as e:
+            log.error(f"New models are not used. Error while loading or validating them: {e}")
+            self.models_signature = signature  # Not loaded again until they are changed
+            return False
+
+        self.models, self.ensemble = models, ensemble  # Next analysis uses the new ensemble
+        self.models_signature = signature
+        log.info(f"Replaced models with new models from {self.model_path} in {(datetime.now() - start_dt).total_seconds():.2f} seconds.")
+        return True
+
+    def validate_models(self, ensemble):
+        """Raise an error if the ensemble does not have the same models as the current one or its scores are not valid probabilities."""
+        if ensemble.names != self.ensemble.names:
+            raise ValueError(f"New models {ensemble.names} differ from the current models {self.ensemble.names}.")
+        predict_df = self.last_predict_df
+        if predict_df is None:
+            return
+        scores = ensemble.predict(predict_df).values
+        is_valid = ~predict_df.isnull().any(axis=1).values  # Rows with nans have nan scores
+        if not np.isfinite(scores[is_valid]).all() or (scores[is_valid] < 0).any() or (scores[is_valid] > 1).any():
+            raise ValueError(f"New models return scores which are not in [0, 1] for the last features.")
+
     #
     # Analysis (features, predictions, signals etc.)
     #
@@ -254,7 +358,14 @@ class Analyzer:
         3. Derive (predict) labels by applying models trained for each label
         4. Generate buy/sell signals by applying rule models trained for best overall trade performance
         """
+        try:
+            return self._analyze()
+        finally:
+            self.analyzed.set()  # Models can be reloaded till the next analysis
+
+    def _analyze(self):
         symbol = App.config["symbol"]
+        ensemble = self.ensemble  # Models can be replaced during analysis
 
         klines = self.klines.get(symbol)
         last_kline_ts = self.get_last_kline_ts(symbol)
@@ -266,7 +377,10 @@ class Analyzer:
         # Produce a data frame with înput data
         #
         try:
-            df = klines_to_df(klines)
+            if self.feature_engine == "stream":
+                df = klines.to_df(last=1)  # Features are computed incrementally so only the last kline is needed
+            else:
+                df = klines.to_df()
         except Exception as e:
             print(f"Error in klines_to_df: {e}")
             return
@@ -276,7 +390,17 @@ class Analyzer:
         # Generate all necessary derived features (NaNs are possible due to short history)
         #
         try:
-            features_out = generate_features(df)
+            if self.feature_engine == "stream":
+                for name, value in self.get_streaming_features(symbol).get_features().items():
+                    df[name] = value
+            else:
+                features_out = self.feature_plan.execute(df, App.config.get("feature_workers", 1), App.config.get("feature_dtype"))
+
+            if self.feature_engine == "parity":
+                expected = df[App.config["features_kline"]].iloc[-1].to_dict()
+                mismatches = compare_features(expected, self.get_streaming_features(symbol).get_features())
+                if mismatches:
+                    log.warning(f"Incremental features differ from batch features (expected, actual): {mismatches}")
         except Exception as e:
             print(f"Error in generate_features: {e}")
             return
@@ -293,31 +417,27 @@ class Analyzer:
         predict_df = df[features]
         # Do not drop nans because they will be processed by predictor
 
+        # Only rows whose scores are used are predicted (predictions of a row do not depend on other rows)
+        score_rows = App.config["signaler"]["analysis"].get("score_rows", 1)
+        if score_rows:
+            predict_df = predict_df.iloc[-score_rows:]
+
         # Do prediction by applying models to the data
-        score_df = pd.DataFrame(index=predict_df.index)
         try:
-            for score_column_name, model_pair in self.models.items():
-                if score_column_name.endswith("_gb"):
-                    df_y_hat = predict_gb(model_pair, predict_df)
-                elif score_column_name.endswith("_nn"):
-                    df_y_hat = predict_nn(model_pair, predict_df)
-                elif score_column_name.endswith("_lc"):
-                    df_y_hat = predict_lc(model_pair, predict_df)
-                else:
-                    raise ValueError(f"Unknown column name algorithm suffix {score_column_name[-3:]}. Currently only '_gb', '_nn', '_lc' are supported.")
-                score_df[score_column_name] = df_y_hat
+            score_df = ensemble.predict(predict_df)
+            self.last_predict_df = predict_df
         except Exception as e:
             print(f"Error in predict: {e}")
             return
 
         # Now we have all predictions (score columns) needed to make a buy/sell decision - many predictions for each true label column
-        # We will need only the latest row for signal generation
+        # We will need only the latest row (or the scored tail) for signal generation
 
         #
         # 4.
         # Generate buy/sell signals using rules and thresholds
         #
-        all_scores = self.models.keys()
+        all_scores = ensemble.names
         high_scores = [col for col in all_scores if "high_" in col]  # 3 algos x 3 thresholds x 1 k = 9
         low_scores = [col for col in all_scores if "low_" in col]  # 3 algos x 3 thresholds x 1 k = 9
 
@@ -327,7 +447,8 @@ class Analyzer:
         high_and_low = score_df["high"] + score_df["low"]
         score_df["score"] = ((score_df["high"] / high_and_low) * 2) - 1.0  # in [-1, +1]
 
-        score = score_df.iloc[-1].score
+        # A missing score of some row (e.g., nan features of the newest kline) means no score as without averaging
+        score = score_df["score"].mean(skipna=False) if score_rows else score_df.iloc[-1].score
 
         row = df.iloc[-1]
         close_price = row.close
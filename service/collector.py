@@ -118,6 +118,22 @@ async def sync_data_collector_task():
             log.error("Received empty or wrong result from klines request.")
             return 1
 
+    # Request klines which are missing in the database (gaps between stored klines)
+    for sym in symbols:
+        for start_ts, end_ts in App.analyzer.get_kline_gaps(sym):
+            res = await request_kline_range(sym, "1m", start_ts, end_ts)
+            if sym not in res:  # Request error (it is logged). The range will be requested again
+                continue
+            if res[sym]:
+                try:
+                    App.analyzer.store_klines(res)
+                except Exception as e:
+                    log.error(f"Error storing missing klines in the database. Exception: {e}")
+                    return 1
+            else:
+                log.warning(f"Cannot get missing klines from {start_ts} till {end_ts} for {sym}. They will not be requested again.")
+                App.analyzer.add_unavailable_klines(sym, start_ts, end_ts)
+
     return 0
 
 
@@ -176,6 +192,21 @@ async def request_klines(symbol, freq, limit):
     # Return all received klines with the symbol as a key
     return {symbol: klines_full}
 
+
+async def request_kline_range(symbol, freq, start_ts, end_ts):
+    """
+    Request klines with open time from start till end (inclusive) for one symbol.
+
+    :return: Dict with the symbol as a key and a list of klines as a value (empty dict in the case of errors)
+    """
+    try:
+        klines = App.client.get_historical_klines(symbol=symbol, interval=freq, start_str=start_ts, end_str=end_ts)
+    except Exception as e:
+        log.error(f"Exception while requesting klines from {start_ts} till {end_ts}: {e}")
+        return {}
+
+    return {symbol: [kl for kl in klines if start_ts <= kl[0] <= end_ts]}
+
 #
 # Server and account info
 #
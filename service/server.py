@@ -7,6 +7,9 @@ import click
 
 import asyncio
 
+from common.import_profile import start_import_profile, print_import_profile
+start_import_profile()  # Measure the following imports if the --profile-imports flag is specified
+
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from service.App import *
@@ -58,7 +61,8 @@ async def main_task():
 
 @click.command()
 @click.option('--config_file', '-c', type=click.Path(), default='', help='Configuration file name')
-def start_server(config_file):
+@click.option('--profile-imports', is_flag=True, help='Print the slowest imports at start up')
+def start_server(config_file, profile_imports):
 
     load_config(config_file)
 
@@ -79,6 +83,9 @@ def start_server(config_file):
 
     App.analyzer = Analyzer(App.config)
 
+    if profile_imports:  # Models are loaded so that imports of their frameworks are also measured
+        print_import_profile()
+
     App.loop = asyncio.get_event_loop()
 
     # Do one time server check and state update
@@ -15,6 +15,7 @@ from binance.enums import *
 
 from service.App import *
 from common.utils import *
+from common.order_book import OrderBook
 from service.analyzer import *
 
 import logging
@@ -193,8 +194,7 @@ async def update_trade_status():
         # -----
         await update_account_balance()
 
-        last_kline = App.analyzer.get_last_kline(symbol)
-        last_close_price = to_decimal(last_kline[4])  # Close price of kline has index 4 in the list
+        last_close_price = to_decimal(App.analyzer.get_last_close_price(symbol))
 
         base_quantity = App.base_quantity  # BTC
         btc_assets_in_usd = base_quantity * last_close_price  # Cost of available BTC in USD
@@ -337,8 +337,7 @@ async def new_limit_order(side):
     #
     # Find limit price (from signal, last kline and adjustment parameters)
     #
-    last_kline = App.analyzer.get_last_kline(symbol)
-    last_close_price = to_decimal(last_kline[4])  # Close price of kline has index 4 in the list
+    last_close_price = to_decimal(App.analyzer.get_last_close_price(symbol))
     if not last_close_price:
         log.error(f"Cannot determine last close price in order to create a market buy order.")
         return None
@@ -368,6 +367,23 @@ async def new_limit_order(side):
 
     quantity_str = round_down_str(quantity, int(App.config["trade_precision"]))
 
+    #
+    # If the order can be filled immediately according to the current order book, then its limit price is moved
+    # to the price of the last level needed (the quantity is not changed so that it is still covered by the funds)
+    #
+    if App.config["trader"].get("use_order_book"):
+        try:
+            depth = await App.loop.run_in_executor(
+                None, lambda: App.client.get_order_book(symbol=symbol, limit=App.config["collector"]["depth"]["limit"])
+            )
+            book = OrderBook(depth)
+            book_price = book.limit_price(side.lower(), float(quantity_str), float(price))
+            if book_price != float(price):
+                log.info(f"Order book: limit price {price_str} changed to {book_price} needed to fill {quantity_str} (mean price {book.fill_price(side.lower(), float(quantity_str))}).")
+                price_str = round_str(book_price, 2)
+        except Exception as e:
+            log.error(f"Error retrieving order book: {e}")
+
     #
     # Execute order
     #
@@ -35,3 +35,171 @@ def test_nan_handling_predict():
 
 	pass
 
+
+def test_predict_tail():
+	"""Predictions for the last rows are the same as the last predictions for all rows (rows are predicted independently)."""
+	rng = np.random.default_rng(0)
+	df_X = pd.DataFrame({"x": rng.normal(size=100), "y": rng.normal(size=100)})
+	df_y = (df_X["x"] + rng.normal(size=100) > 0).astype(int)
+	df_X_test = df_X.copy()
+	df_X_test.iloc[[3, 97], 0] = np.nan
+
+	models = train_lc(df_X, df_y, params=dict(is_scale=True))
+	all_hat = predict_lc(models, df_X_test)
+	tail_hat = predict_lc(models, df_X_test.iloc[-5:])
+	pd.testing.assert_series_equal(tail_hat, all_hat.iloc[-5:])
+	assert tail_hat.isnull().sum() == 1
+
+
+def test_model_ensemble(monkeypatch):
+	"""Ensemble scores are the same as the scores of individual models."""
+	monkeypatch.setitem(App.config, "lgbm_device_type", "cpu")
+
+	rng = np.random.default_rng(0)
+	df_X = pd.DataFrame({"x": rng.normal(size=200), "y": rng.normal(size=200), "z": rng.normal(size=200)})
+	df_y = (df_X["x"] - df_X["y"] + rng.normal(size=200) > 0).astype(int)
+	df_X_test = df_X.iloc[:20].copy()
+	df_X_test.iloc[[3, 7], [0, 2]] = np.nan
+
+	gb_params = dict(is_scale=True, objective="cross_entropy", max_depth=2, learning_rate=0.1, num_boost_round=5)
+	nn_params = dict(is_scale=True, learning_rate=0.1, n_epochs=1, bs=50)
+	models = {
+		"high_10_k_gb": train_gb(df_X, df_y, gb_params),
+		"high_10_k_nn": train_nn(df_X, df_y, nn_params),
+		"high_10_k_lc": train_lc(df_X, df_y, dict(is_scale=True)),
+		"low_10_k_gb": train_gb(df_X, 1 - df_y, dict(gb_params, is_scale=False)),
+		"low_10_k_nn": train_nn(df_X, 1 - df_y, nn_params),
+		"low_10_k_lc": train_lc(df_X, 1 - df_y, dict(is_scale=False)),
+	}
+	predict = {"gb": predict_gb, "nn": predict_nn, "lc": predict_lc}
+
+	score_df = ModelEnsemble(models).predict(df_X_test)
+	assert list(score_df.columns) == list(models.keys())
+	for name, model_pair in models.items():
+		expected = predict[name[-2:]](model_pair, df_X_test)
+		np.testing.assert_allclose(score_df[name].values, expected.values, rtol=1e-5)
+	assert score_df.iloc[[3, 7]].isnull().all().all()
+
+
+def test_numpy_nn(tmp_path):
+	"""Exported NN model has the same predictions as the keras model."""
+	rng = np.random.default_rng(0)
+	df_X = pd.DataFrame({"x": rng.normal(size=200), "y": rng.normal(size=200), "z": rng.normal(size=200), "w": rng.normal(size=200)})
+	df_y = (df_X["x"] - df_X["y"] + rng.normal(size=200) > 0).astype(int)
+	df_X_test = df_X.iloc[:20].copy()
+	df_X_test.iloc[5, 1] = np.nan
+
+	model_pair = train_nn(df_X, df_y, dict(is_scale=True, learning_rate=0.1, n_epochs=2, bs=50))
+	export_nn(model_pair[0], model_pair[1], tmp_path / "high_10_k_nn.npz")
+	numpy_pair = (load_nn(tmp_path / "high_10_k_nn.npz"), None)
+
+	expected = predict_nn(model_pair, df_X_test)
+	y_hat = predict_nn(numpy_pair, df_X_test)
+	np.testing.assert_allclose(y_hat.values, expected.values, rtol=1e-5)
+	assert y_hat.isnull().sum() == 1
+
+	# Several models are combined in one network
+	other_pair = (load_nn(tmp_path / "high_10_k_nn.npz"), None)
+	other_pair[0].biases[-1] = other_pair[0].biases[-1] + 1.0
+	score_df = ModelEnsemble({"high_10_k_nn": numpy_pair, "low_10_k_nn": other_pair}).predict(df_X_test)
+	np.testing.assert_allclose(score_df["high_10_k_nn"].values, y_hat.values, rtol=1e-12)
+	np.testing.assert_allclose(score_df["low_10_k_nn"].values, predict_nn(other_pair, df_X_test).values, rtol=1e-12)
+
+
+def test_numpy_gb(tmp_path, monkeypatch):
+	"""Flat trees have the same predictions as the LightGBM model (stumps and deeper trees, with nans)."""
+	monkeypatch.setitem(App.config, "lgbm_device_type", "cpu")
+	rng = np.random.default_rng(0)
+	df_X = pd.DataFrame({"x": rng.normal(size=500), "y": rng.normal(size=500), "z": rng.normal(size=500)})
+	df_y = (df_X["x"] - df_X["y"] * df_X["z"] + rng.normal(size=500) > 0).astype(int)
+	X_test = df_X.values[:100].copy()
+	X_test[[1, 2], [0, 1]] = np.nan
+
+	for max_depth, is_scale in [(1, False), (1, True), (3, False)]:
+		booster, scaler = train_gb(df_X, df_y, dict(is_scale=is_scale, objective="cross_entropy", max_depth=max_depth, learning_rate=0.1, num_boost_round=20))
+		export_gb(booster, scaler, tmp_path / "high_10_k_gb.npz")
+		model = load_gb(tmp_path / "high_10_k_gb.npz")
+		assert model.is_stumps == (max_depth == 1)
+
+		expected = booster.predict(scaler.transform(X_test) if is_scale else X_test)
+		np.testing.assert_allclose(model.predict(X_test), expected, rtol=1e-12)  # Rows with nans use general evaluator
+		np.testing.assert_allclose(model.predict(X_test[3:]), expected[3:], rtol=1e-12)
+
+
+def test_model_bundle(tmp_path, monkeypatch):
+	"""Models loaded from a bundle have the same scores as the trained models and corrupted bundles are detected."""
+	from common.model_bundle import save_model_bundle, load_model_bundle, read_manifest
+	monkeypatch.setitem(App.config, "lgbm_device_type", "cpu")
+	rng = np.random.default_rng(0)
+	df_X = pd.DataFrame({"x": rng.normal(size=200), "y": rng.normal(size=200), "z": rng.normal(size=200)})
+	df_y = (df_X["x"] - df_X["y"] + rng.normal(size=200) > 0).astype(int)
+	df_X_test = df_X.iloc[:20].copy()
+	df_X_test.iloc[3, 1] = np.nan
+
+	models = {
+		"high_10_k_gb": train_gb(df_X, df_y, dict(is_scale=True, objective="cross_entropy", max_depth=2, learning_rate=0.1, num_boost_round=5)),
+		"high_10_k_nn": train_nn(df_X, df_y, dict(is_scale=True, learning_rate=0.1, n_epochs=1, bs=50)),
+		"high_10_k_lc": train_lc(df_X, df_y, dict(is_scale=True)),
+		"high_10_k_svc": train_svc(df_X.iloc[:50], df_y.iloc[:50], dict(is_scale=False)),  # Pickled
+	}
+	file = tmp_path / "models.bundle"
+	save_model_bundle(file, models, dict(labels=["high_10"], feature_sets=["kline"]))
+	assert read_manifest(file)["grid"]["labels"] == ["high_10"]
+
+	bundle_models = load_model_bundle(file, ["high_10_k_gb", "high_10_k_nn", "high_10_k_lc"])
+	expected = ModelEnsemble({name: models[name] for name in bundle_models}).predict(df_X_test)
+	pd.testing.assert_frame_equal(ModelEnsemble(bundle_models).predict(df_X_test), expected, rtol=1e-5)
+	assert not bundle_models["high_10_k_nn"][0].kernels[0].flags.writeable  # Memory-mapped
+
+	svc_pair = load_model_bundle(file, ["high_10_k_svc"])["high_10_k_svc"]
+	np.testing.assert_allclose(predict_svc(svc_pair, df_X_test), predict_svc(models["high_10_k_svc"], df_X_test))
+
+	with pytest.raises(ValueError):
+		load_model_bundle(file, ["low_10_k_gb"])
+
+	data = bytearray(file.read_bytes())
+	data[-1] ^= 1  # Last array
+	file.write_bytes(bytes(data))
+	with pytest.raises(ValueError):
+		load_model_bundle(file)
+
+
+def test_model_reload(tmp_path, monkeypatch):
+	"""Analyzer replaces its models with retrained models from the bundle only if they are changed and valid."""
+	from service.analyzer import Analyzer
+	from common.model_bundle import save_model_bundle
+	monkeypatch.setitem(App.config, "model_folder", str(tmp_path))
+	monkeypatch.setitem(App.config, "model_bundle", "models.bundle")
+	monkeypatch.setitem(App.config, "labels", ["high_10", "low_10"])
+	monkeypatch.setitem(App.config, "lgbm_device_type", "cpu")
+	rng = np.random.default_rng(0)
+	df_X = pd.DataFrame({"x": rng.normal(size=200), "y": rng.normal(size=200)})
+	df_y = (df_X["x"] - df_X["y"] + rng.normal(size=200) > 0).astype(int)
+
+	def train(df_y):
+		nn_params = dict(is_scale=True, learning_rate=0.1, n_epochs=1, bs=50)
+		return {
+			label + "_k_" + algorithm: pair
+			for label, y in [("high_10", df_y), ("low_10", 1 - df_y)]
+			for algorithm, pair in [("gb", train_gb(df_X, y, dict(objective="cross_entropy", max_depth=1, learning_rate=0.1, num_boost_round=5))), ("nn", train_nn(df_X, y, nn_params)), ("lc", train_lc(df_X, y, dict(is_scale=False)))]
+		}
+
+	save_model_bundle(tmp_path / "models.bundle", train(df_y))
+	analyzer = Analyzer(App.config)
+	analyzer.last_predict_df = df_X.iloc[-5:]
+	ensemble = analyzer.ensemble
+	signature = analyzer.models_signature
+	assert get_models_signature(tmp_path, model_names(["high_10", "low_10"], ["kline"], ["gb", "nn", "lc"])) == signature
+
+	save_model_bundle(tmp_path / "models.bundle", train(1 - df_y))  # Retrained
+	new_signature = get_models_signature(tmp_path, list(ensemble.names))
+	assert new_signature != signature
+	assert analyzer.reload_models(new_signature)
+	assert analyzer.ensemble is not ensemble and analyzer.models_signature == new_signature
+
+	models = train(df_y)
+	del models["low_10_k_lc"]
+	save_model_bundle(tmp_path / "models.bundle", models)  # Not all models
+	ensemble = analyzer.ensemble
+	assert not analyzer.reload_models()
+	assert analyzer.ensemble is ensemble
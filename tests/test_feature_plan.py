@@ -0,0 +1,71 @@
+import pytest
+
+from service.App import App
+from common.utils import *
+from common.feature_generation import *
+from common.feature_plan import *
+from tests.test_feature_stream import make_klines
+
+
+def test_feature_plan():
+	df = klines_to_df(make_klines(3000))
+	df["f_close"], df["f_high"], df["f_low"], df["f_volume"], df["f_trades"] = df["close"], df["high"], df["low"], df["volume"], df["trades"]
+
+	for feature_set, generate in [("kline", generate_features), ("futur", generate_features_futur)]:
+		expected = df.copy()
+		generate(expected)
+
+		actual = df.copy()
+		features = FeaturePlan(App.config["features_" + feature_set], feature_set).execute(actual)
+
+		assert features == App.config["features_" + feature_set]
+		pd.testing.assert_frame_equal(actual, expected, rtol=1e-7)
+
+	# Only requested features are added
+	actual = df.copy()
+	FeaturePlan(["close_trend_5", "volume_60", "close_5"]).execute(actual)
+	assert list(actual.columns) == list(df.columns) + ["close_trend_5", "volume_60", "close_5"]
+
+	pass
+
+
+def test_parse_feature():
+	assert parse_feature("close_5") == ("weighted", "close", 5)
+	assert parse_feature("f_close_std_20", "f_") == ("std", "f_close", 20)
+	assert parse_feature("bids_1_5") == ("mean", "bids_1", 5)
+	assert parse_feature("close_area_60") == ("area", "close", 60)
+
+	with pytest.raises(ValueError):
+		parse_feature("close")
+
+	pass
+
+
+def test_parallel_features():
+	df = klines_to_df(make_klines(2000))
+
+	for generate in [generate_features, FeaturePlan(App.config["features_kline"]).execute]:
+		sequential = df.copy()
+		generate(sequential, workers=1)
+		parallel = df.copy()
+		generate(parallel, workers=4)
+
+		pd.testing.assert_frame_equal(parallel, sequential, check_exact=True)
+
+	pass
+
+
+def test_feature_dtype():
+	df = klines_to_df(make_klines(2000))
+	features = App.config["features_kline"]
+
+	expected = df.copy()
+	FeaturePlan(features).execute(expected)
+	actual = df.copy()
+	FeaturePlan(features).execute(actual, dtype="float32")
+
+	assert (actual[features].dtypes == np.float32).all()
+	assert actual[features].memory_usage().sum() < 0.6 * expected[features].memory_usage().sum()
+	pd.testing.assert_frame_equal(actual, to_float_dtype(expected, features, "float32"))
+
+	pass
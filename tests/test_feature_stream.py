@@ -0,0 +1,97 @@
+import pytest
+
+from service.App import App
+from common.utils import *
+from common.feature_generation import *
+from common.feature_stream import *
+
+
+def make_klines(count, seed=0):
+	"""Klines as returned by API (list of strings)."""
+	rng = np.random.default_rng(seed)
+	close = 30000 + np.cumsum(rng.normal(0, 20, count))
+	klines = []
+	for i in range(count):
+		volume = 0.0 if i % 97 == 0 else rng.uniform(0, 100)  # Some klines without trades
+		tb_base_av = volume * rng.uniform(0.2, 0.8)
+		klines.append([
+			1_600_000_000_000 + i * 60_000,
+			str(close[i]), str(close[i] + rng.uniform(0, 30)), str(close[i] - rng.uniform(0, 30)), str(close[i]), str(volume),
+			1_600_000_000_000 + i * 60_000 + 59_999,
+			str(volume * close[i]), int(rng.integers(1, 1000)), str(tb_base_av), str(tb_base_av * close[i]), "0",
+		])
+	return klines
+
+
+def test_streaming_features_parity():
+	features = App.config["features_kline"]
+	horizon = App.config["signaler"]["analysis"]["features_horizon"]
+	klines = make_klines(4000)
+
+	engine = StreamingFeatures(features, rebuild_period=500)
+	for i, kline in enumerate(klines):
+		assert engine.update(kline)
+		if i+1 not in [50, 1000, 1600, 3001, 4000]:
+			continue
+
+		df = klines_to_df(klines[max(0, i+1-horizon):i+1])
+		generate_features(df)
+		expected = df[features].iloc[-1].to_dict()
+
+		mismatches = compare_features(expected, engine.get_features())
+		assert not mismatches, f"After {i+1} klines: {mismatches}"
+
+	# Old klines are ignored
+	assert not engine.update(klines[-1])
+
+	pass
+
+
+def test_streaming_features_backfill():
+	from service.analyzer import Analyzer
+
+	features = App.config["features_kline"]
+	klines = make_klines(2200)
+
+	analyzer = Analyzer.__new__(Analyzer)  # Only the kline state is needed (without models)
+	analyzer.klines = {}
+	analyzer.streaming_features = {}
+	analyzer.unavailable_klines = {}
+	analyzer.feature_engine = "stream"
+
+	def assert_parity():
+		df = analyzer.klines["BTCUSDT"].to_df()
+		generate_features(df)
+		expected = df[features].iloc[-1].to_dict()
+		mismatches = compare_features(expected, analyzer.get_streaming_features("BTCUSDT").get_features())
+		assert not mismatches, mismatches
+
+	# Klines with a gap are stored and the gap is filled later
+	analyzer.store_klines({"BTCUSDT": klines[:1900]})
+	analyzer.store_klines({"BTCUSDT": klines[2000:2100]})
+	gaps = analyzer.get_kline_gaps("BTCUSDT")
+	assert len(gaps) == 1
+	assert_parity()
+
+	# Ranges which the exchange does not have are not requested again
+	analyzer.add_unavailable_klines("BTCUSDT", *gaps[0])
+	assert not analyzer.get_kline_gaps("BTCUSDT")
+
+	analyzer.store_klines({"BTCUSDT": klines[1900:2000]})
+	assert not analyzer.klines["BTCUSDT"].gaps()
+	assert not analyzer.get_kline_gaps("BTCUSDT")
+	assert not analyzer.unavailable_klines["BTCUSDT"]  # Filled ranges are forgotten
+	assert_parity()
+
+	# Overwriting the last kline with other values
+	last_kline = list(klines[2099])
+	last_kline[4] = str(float(last_kline[4]) + 100)
+	analyzer.store_klines({"BTCUSDT": [last_kline]})
+	assert_parity()
+
+	# New klines after that are added incrementally
+	analyzer.store_klines({"BTCUSDT": klines[2100:2200]})
+	assert not analyzer.klines["BTCUSDT"].history_changed
+	assert_parity()
+
+	pass
@@ -0,0 +1,26 @@
+import pytest
+
+from service.App import App
+from common.utils import *
+from scripts.generate_features import P, generate_chunked, generate_in_memory
+from tests.test_feature_stream import make_klines
+
+
+def test_generate_chunked(tmp_path, monkeypatch):
+	"""Chunks extended by past and future halos produce the same file as the in-memory mode."""
+	df = klines_to_df(make_klines(4000)).reset_index()
+	df = df.drop(columns=["close_time", "ignore"], errors="ignore")
+	in_path = tmp_path / "BTCUSDT-1m.csv"
+	df.to_csv(in_path, index=False)
+
+	monkeypatch.setattr(P, "feature_sets", ["kline"])
+	generate_in_memory(in_path, tmp_path / "memory.csv")
+	monkeypatch.setattr(P, "chunk_size", 700)  # Chunk borders are not aligned with halos
+	generate_chunked(in_path, tmp_path / "chunked.csv")
+
+	expected = pd.read_csv(tmp_path / "memory.csv")
+	result = pd.read_csv(tmp_path / "chunked.csv")
+	assert len(expected) == len(df)
+	pd.testing.assert_frame_equal(result, expected)
+
+	pass
@@ -0,0 +1,88 @@
+import pytest
+
+from common.utils import *
+from common.kline_buffer import *
+from tests.test_feature_stream import make_klines
+
+
+def test_kline_buffer():
+	klines = make_klines(1000)
+	buffer = KlineBuffer(300)
+
+	# Add klines in portions of different sizes so that the storage is compacted several times
+	i = 0
+	for size in [1, 50, 299, 7, 300, 1, 342]:
+		buffer.upsert(klines[i:i+size])
+		i += size
+	assert len(buffer) == 300
+	assert buffer.last_timestamp() == klines[i-1][0]
+
+	# Parsed columns are the same as those of klines_to_df()
+	expected = klines_to_df(klines[i-300:i]).drop(columns=["ignore"])
+	df = buffer.to_df()
+	pd.testing.assert_frame_equal(df, expected, check_dtype=False, check_index_type=False, check_freq=False)
+	assert buffer.to_df(last=1).index[0] == expected.index[-1]
+
+	last_kline = buffer.last_kline()
+	assert last_kline[0] == klines[i-1][0]
+	assert last_kline[4] == float(klines[i-1][4])
+
+	# Views are windows of the storage (not copies) and cannot be changed
+	close = buffer.view("close", last=10)
+	assert np.shares_memory(close, buffer.arrays["close"])
+	assert not close.flags.writeable
+	assert len(buffer.view("close", last=1000)) == 300
+
+	# Overlapping klines overwrite the stored klines
+	assert buffer.upsert(klines[i-5:i]) == 5
+	pd.testing.assert_frame_equal(buffer.to_df(), df)
+	assert buffer.gaps() == []
+
+	assert KlineBuffer(10).last_kline() is None
+
+
+def test_kline_buffer_gaps():
+	klines = make_klines(1000)
+	buffer = KlineBuffer(300)
+
+	buffer.upsert(klines[0:100])
+	buffer.upsert(klines[110:200])  # Gap of 10 klines
+	buffer.upsert(klines[203:205])  # Gap of 3 klines
+	assert len(buffer) == 205
+	assert buffer.gaps() == [(klines[100][0], klines[109][0]), (klines[200][0], klines[202][0])]
+	assert np.isnan(buffer.to_df()["close"].iloc[100:110]).all()
+
+	# Backfill missing klines (in any order)
+	buffer.upsert(klines[200:203])
+	buffer.upsert(klines[105:110] + klines[100:105])
+	assert buffer.gaps() == []
+	pd.testing.assert_frame_equal(buffer.to_df(), klines_to_df(klines[0:205]).drop(columns=["ignore"]), check_dtype=False, check_index_type=False, check_freq=False)
+
+	# Old gaps are removed together with old klines
+	buffer.upsert(klines[250:251])
+	assert buffer.gaps() == [(klines[205][0], klines[249][0])]
+	buffer.upsert(klines[600:601])
+	assert len(buffer) == 300
+	assert buffer.gaps() == [(klines[301][0], klines[599][0])]
+	assert buffer.missing == 299
+
+	# Klines which are older than the buffer are ignored
+	assert buffer.upsert(klines[0:10]) == 0
+
+
+def test_kline_buffer_float32_features(monkeypatch):
+	from service.App import App
+	from service.analyzer import Analyzer
+
+	monkeypatch.setitem(App.config, "feature_dtype", "float32")
+	analyzer = Analyzer.__new__(Analyzer)  # Only the kline state is needed (without models)
+	analyzer.klines = {}
+	analyzer.feature_engine = "batch"
+
+	kline = make_klines(1)[0]
+	kline[4] = "60000.01"  # Cannot be represented in float32
+	analyzer.store_klines({"BTCUSDT": [kline]})
+	assert analyzer.klines["BTCUSDT"].view("close").dtype == np.float64
+	assert analyzer.get_last_close_price("BTCUSDT") == 60000.01
+
+	pass
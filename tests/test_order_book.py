@@ -0,0 +1,52 @@
+import pytest
+
+from common.utils import *
+from common.order_book import *
+
+
+def test_order_book():
+	depth = {
+		"bids": [["100.0", "1.0"], ["99.0", "2.0"], ["97.0", "3.0"]],  # Strings as returned by API
+		"asks": [["101.0", "1.0"], ["102.0", "1.0"], ["105.0", "4.0"]],
+	}
+	book = OrderBook(depth)
+
+	assert book.gap == 1.0
+	assert book.mid_price == 100.5
+
+	# Price to volume (limit is inclusive)
+	assert book.price_to_volume("buy", 100.5) == 0.0
+	assert book.price_to_volume("buy", 102.0) == 2.0
+	assert book.price_to_volume("buy", 200.0) == 6.0
+	assert book.price_to_volume("sell", 99.0) == 3.0
+	assert book.price_to_volume("sell", 98.0) == 3.0
+
+	# Volume to price
+	assert book.volume_to_price("buy", 2.0) == 102.0
+	assert book.volume_to_price("buy", 2.5) == 105.0
+	assert book.volume_to_price("buy", 7.0) is None
+	assert book.volume_to_price("sell", 1.5) == 99.0
+
+	# Mean fill price
+	assert book.fill_price("buy", 1.0) == 101.0
+	assert book.fill_price("buy", 4.0) == pytest.approx((101.0 + 102.0 + 2 * 105.0) / 4)
+	assert book.fill_price("sell", 2.0) == pytest.approx((100.0 + 99.0) / 2)
+	assert book.fill_price("sell", 10.0) is None
+
+	# Limit price is not worse than needed to fill the volume
+	assert book.limit_price("buy", 1.5, 103.0) == 102.0
+	assert book.limit_price("buy", 2.5, 103.0) == 103.0  # Part of the volume will wait in the book
+	assert book.limit_price("buy", 1.0, 100.0) == 100.0  # Not marketable
+	assert book.limit_price("sell", 2.0, 98.0) == 99.0
+	assert book.limit_price("sell", 10.0, 98.0) == 98.0
+
+	# Snapshot is immutable and the source is not changed
+	prices, volumes, cumulative_volumes, cumulative_notionals = book.levels("buy")
+	with pytest.raises(ValueError):
+		cumulative_volumes[0] = 0.0
+	assert depth["asks"][1] == ["102.0", "1.0"]
+
+	with pytest.raises(ValueError):
+		book.price_to_volume("ask", 100.0)
+
+	pass
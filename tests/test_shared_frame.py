@@ -0,0 +1,32 @@
+import pytest
+
+from common.utils import *
+from common.shared_frame import *
+
+
+def test_shared_frame(tmp_path):
+	"""Rows and columns of the shared frame are the same as those of the data frame and consecutive columns are not copied."""
+	rng = np.random.default_rng(0)
+	df = pd.DataFrame(rng.normal(size=(100, 4)), columns=["a", "b", "c", "d"])
+	df.loc[[3, 50], "b"] = np.nan
+	df.loc[7, "c"] = np.inf
+	df["label"] = (df["a"] > 0).astype(np.int8)
+
+	frame = SharedFrame.create(df, ["a", "b", "c", "d"], tmp_path / "features.npy")
+	labels = SharedFrame.open(SharedFrame.create(df, ["label"], tmp_path / "labels.npy").spec())
+	assert labels.values.dtype == np.int8
+
+	X = frame.get(10, 60, ["b", "c"])
+	pd.testing.assert_frame_equal(X, df.iloc[10:60][["b", "c"]])
+	assert np.shares_memory(X.values, frame.values)
+	pd.testing.assert_frame_equal(frame.get(0, 20, ["d", "a"]), df.iloc[0:20][["d", "a"]])
+
+	mask = frame.notnull_mask(0, 60, ["a", "b", "c"])
+	expected = df.iloc[0:60].replace([np.inf], np.nan).dropna(subset=["a", "b", "c"])
+	pd.testing.assert_frame_equal(frame.get(0, 60, ["a", "b", "c"], mask), df.loc[expected.index, ["a", "b", "c"]])
+	pd.testing.assert_series_equal(labels.get_column(0, 60, "label", mask), expected["label"])
+
+	frame.delete()
+	assert not (tmp_path / "features.npy").exists()
+
+	pass
@@ -132,6 +132,108 @@ def test_depth_density():
 	pass
 
 
+def test_volume_densities():
+	rng = np.random.default_rng(6)
+	bids = [[float(p), float(v)] for p, v in zip(np.sort(rng.uniform(90, 100, 100))[::-1], rng.uniform(0, 5, 100))]
+	asks = [[float(p), float(v)] for p, v in zip(np.sort(rng.uniform(100, 110, 100)), rng.uniform(0, 5, 100))]
+	windows = [1, 2, 5, 10, 50]
+
+	densities = mean_volumes({"bids": bids, "asks": asks}, windows, bin_size=[0.5, 1.0, 2.0])
+
+	for bin_size in [0.5, 1.0, 2.0]:
+		for side, depth in [("bids", bids), ("asks", asks)]:
+			bins = discretize(side[:3], depth, bin_size, None)
+			for w in windows:
+				assert densities[f"{side}_{w}_bin{bin_size:g}"] == pytest.approx(np.mean(bins[:w]), rel=1e-9)
+
+	assert mean_volumes({"bids": bids, "asks": asks}, windows, bin_size=1.0)["asks_5"] == pytest.approx(densities["asks_5_bin1"])
+
+	pass
+
+
+def test_depth_batch_to_features():
+	from common.feature_generation import depth_to_features, depth_batch_to_features
+
+	rng = np.random.default_rng(7)
+	depth = []
+	for i in range(50):
+		levels = int(rng.integers(1, 40))
+		bids = np.sort(rng.uniform(90, 100, levels))[::-1]
+		asks = np.sort(rng.uniform(100, 110, levels))
+		depth.append({
+			"timestamp": 1_600_000_000_000 + i * 60_000,
+			"bids": [[float(p), float(v)] for p, v in zip(bids, rng.uniform(0, 5, levels))],
+			"asks": [[str(p), str(v)] for p, v in zip(asks, rng.uniform(0, 5, levels))],  # Strings as returned by API
+		})
+
+	df = depth_batch_to_features(depth, windows=[1, 2, 5, 10, 20], bin_size=1.0)
+
+	for i, entry in enumerate(depth):
+		entry = dict(entry, asks=[[float(p), float(v)] for p, v in entry["asks"]])
+		expected = depth_to_features(entry, windows=[1, 2, 5, 10, 20], bin_size=1.0)
+		assert list(df.columns) == list(expected.keys())
+		assert df.iloc[i].tolist() == pytest.approx(list(expected.values()), rel=1e-12)
+
+	pass
+
+
+def test_depth_to_features_chunks(tmp_path, monkeypatch):
+	"""Chunked conversion of a depth file produces the same csv and statistics as the conversion of the whole file."""
+	import json
+	from common.feature_generation import depth_to_df
+	import scripts.depth_to_features as depth_script
+
+	rng = np.random.default_rng(8)
+	lines = []
+	for minute in range(30):
+		if minute in [10, 11, 12]:  # Gap at the border of the second and third chunks
+			continue
+		levels = int(rng.integers(5, 30))
+		entry = {
+			"timestamp": 1_600_000_020_000 + minute * 60_000,  # Aligned with 1m
+			"bids": [[str(p), str(v)] for p, v in zip(np.sort(rng.uniform(90, 100, levels))[::-1], rng.uniform(0, 5, levels))],
+			"asks": [[str(p), str(v)] for p, v in zip(np.sort(rng.uniform(100, 110, levels)), rng.uniform(0, 5, levels))],
+		}
+		lines.append(json.dumps(entry))
+		if minute == 17:
+			lines.append(json.dumps(dict(entry, timestamp=entry["timestamp"] + 30_000)))  # Not 1m record
+		if minute == 22:
+			lines.append("error")
+	path = tmp_path / "depth-BTCUSDT-5s.txt"
+	path.write_text("\n".join(lines) + "\n")
+
+	# Previous conversion and statistics of the whole file
+	table = [json.loads(line) for line in lines if line != "error"]
+	expected_stats = {name: [] for name in depth_script.statistics_names}
+	for entry in table:
+		for side in ["bid", "ask"]:
+			prices = [float(x[0]) for x in entry[side + "s"]]
+			expected_stats[side + "_spans"].append(np.max(prices) - np.min(prices))
+			expected_stats[side + "_lens"].append(len(prices))
+			expected_stats[side + "_vols"].append(np.sum([float(x[1]) for x in entry[side + "s"]]))
+	table = [
+		dict(entry, bids=[[float(p), float(v)] for p, v in entry["bids"]], asks=[[float(p), float(v)] for p, v in entry["asks"]])
+		for entry in table if entry["timestamp"] % 60_000 == 0
+	]
+	df = depth_to_df(table).reset_index().rename(columns={"index": "timestamp"})
+	df["timestamp"] = df["timestamp"].shift(periods=1)
+	df.to_csv(tmp_path / "expected.csv", index=False, float_format="%.4f")
+
+	monkeypatch.chdir(tmp_path)  # Output is written to the current folder
+	monkeypatch.setattr(depth_script, "chunk_lines", 5)
+	stats = depth_script.process_file(path)
+
+	assert (tmp_path / "depth-BTCUSDT-5s.csv").read_text() == (tmp_path / "expected.csv").read_text()
+	assert stats["bad_lines"] == 1
+	for name, values in expected_stats.items():
+		assert stats[name]["count"] == len(values)
+		assert stats[name]["sum"] == pytest.approx(np.sum(values))
+		assert stats[name]["min"] == pytest.approx(np.min(values))
+		assert stats[name]["max"] == pytest.approx(np.max(values))
+
+	pass
+
+
 def test_area_ratio():
 	price = [10, 20, 30, 20, 10, 20, 30]
 	df = pd.DataFrame(data={"price": price})
@@ -163,3 +265,125 @@ def test_linear_trends():
 	npt.assert_almost_equal(df["price_trend_6"].values, np.array([0, 10, 15, 11, 6, 0.857143]))
 
 	pass
+
+
+def test_rolling_aggregate():
+	rng = np.random.default_rng(1)
+	values = rng.normal(100, 5, 500)
+	values[[3, 40, 41, 42, 300]] = np.nan
+	sr = pd.Series(values)
+
+	for fn in [np.nanmean, np.nansum, np.nanstd, np.nanmax, np.nanmin, np.mean, np.sum, np.std, np.max, np.min]:
+		for w in [1, 5, 60]:
+			min_periods = max(1, w // 10)
+			expected = sr.rolling(window=w, min_periods=min_periods).apply(fn, raw=True)
+			result = rolling_aggregate(sr, w, fn, min_periods=min_periods)
+			npt.assert_allclose(result.values, expected.values, rtol=1e-9, atol=1e-9, err_msg=f"{fn.__name__} {w}")
+
+	# Unknown function falls back to apply
+	fn = lambda x: x[-1] - x[0]
+	expected = sr.rolling(window=5, min_periods=1).apply(fn, raw=True)
+	result = rolling_aggregate(sr, 5, fn, min_periods=1)
+	npt.assert_allclose(result.values, expected.values)
+
+	# Empty input (e.g., fully trimmed chunk)
+	assert window_sums(np.array([]), [3, 5]).shape == (2, 0)
+	assert len(rolling_aggregate(pd.Series([], dtype=float), 5, np.nanmean, min_periods=1)) == 0
+	assert [len(sr) for sr in rolling_weighted_aggregate(pd.Series([], dtype=float), pd.Series([], dtype=float), np.nanmean, [3, 5], [1, 1])] == [0, 0]
+
+	pass
+
+
+def test_weighted_aggregations():
+	rng = np.random.default_rng(2)
+	close = rng.normal(30000, 100, 3000)
+	volume = rng.uniform(0, 10, 3000)
+	close[[5, 100, 101]] = np.nan
+	volume[[7, 100, 2000]] = np.nan
+	volume[1500:1510] = 0.0  # No trades so weighted mean is nan
+	df = pd.DataFrame({"close": close, "volume": volume})
+	windows = [1, 5, 15, 60, 1440]
+
+	for fn in [np.nanmean, np.nansum, np.mean, np.nanmax]:
+		features = add_past_weighted_aggregations(df, "close", "volume", fn, windows, suffix="_w")
+		products = df["close"] * df["volume"]
+		for w, feature_name in zip(windows, features):
+			mp = max(1, w // 10)
+			expected = products.rolling(w, min_periods=mp).apply(fn, raw=True) / df["volume"].rolling(w, min_periods=mp).apply(fn, raw=True)
+			npt.assert_allclose(df[feature_name].values, expected.values, rtol=1e-10, err_msg=f"{fn.__name__} {w}")
+
+	pass
+
+
+def test_rolling_slope():
+	rng = np.random.default_rng(3)
+	price = 30000 + np.cumsum(rng.normal(0, 10, 1000))
+	price[[0, 10, 11, 12, 13, 500, 998]] = np.nan
+	df = pd.DataFrame(data={"price": price})
+
+	windows = [2, 5, 15, 60]
+	add_linear_trends(df, is_future=False, column_name="price", windows=windows, suffix="_fast")
+	add_linear_trends(df, is_future=False, column_name="price", windows=windows, suffix="_ref", reference=True)
+	for w in windows:
+		npt.assert_allclose(df[f"price_fast_{w}"].values, df[f"price_ref_{w}"].values, rtol=1e-7, atol=1e-8, err_msg=f"{w}")
+
+	pass
+
+
+def test_rolling_area_ratio():
+	rng = np.random.default_rng(4)
+	price = 30000 + np.cumsum(rng.normal(0, 10, 1000))
+	price[[10, 500, 501, 998]] = np.nan
+	price[700:710] = price[699]  # Constant price produces zero areas
+	df = pd.DataFrame(data={"price": price})
+
+	windows = [4, 20, 60, 120]
+	for is_future in [False, True]:
+		add_area_ratio(df, is_future=is_future, column_name="price", windows=windows, suffix="_fast")
+		add_area_ratio(df, is_future=is_future, column_name="price", windows=windows, suffix="_ref", reference=True)
+		for w in windows:
+			npt.assert_allclose(df[f"price_fast_{w}"].values, df[f"price_ref_{w}"].values, rtol=1e-9, atol=1e-12, err_msg=f"{is_future} {w}")
+
+	# Small blocks produce the same result
+	for is_future in [False, True]:
+		add_area_ratio(df, is_future=is_future, column_name="price", windows=20, suffix="_ref", reference=True)
+		ratio = rolling_area_ratio(df["price"], 20, min_periods=2, is_future=is_future, block_length=100)
+		npt.assert_allclose(ratio.values, df["price_ref_20"].values, rtol=1e-9, atol=1e-12)
+
+	pass
+
+
+def test_jit_kernels():
+	pytest.importorskip("numba")
+	from common import jit
+
+	rng = np.random.default_rng(5)
+	price = pd.Series(30000 + np.cumsum(rng.normal(0, 10, 1000)))
+	price[[10, 500, 998]] = np.nan
+	bids = [[float(p), float(v)] for p, v in zip(np.sort(rng.uniform(90, 100, 50))[::-1], rng.uniform(0, 5, 50))]
+	asks = [[float(p), float(v)] for p, v in zip(np.sort(rng.uniform(100, 110, 50)), rng.uniform(0, 5, 50))]
+
+	try:
+		jit.enable_jit(True)
+		assert jit.warm_up()
+		ratios = [rolling_area_ratio(price, 60, 6, is_future) for is_future in [False, True]]
+		volumes = [discretize(side, depth, 0.5, None) for side, depth in [("bid", bids), ("ask", asks)]]
+	finally:
+		jit.enable_jit(False)
+
+	for is_future, ratio in zip([False, True], ratios):
+		npt.assert_allclose(ratio.values, rolling_area_ratio(price, 60, 6, is_future).values, rtol=1e-9, atol=1e-12)
+	for (side, depth), bin_volumes in zip([("bid", bids), ("ask", asks)], volumes):
+		npt.assert_allclose(bin_volumes, discretize(side, depth, 0.5, None), rtol=1e-12)
+
+	pass
+
+
+def test_lazy_imports():
+	"""Importing the service modules does not import ML frameworks (they are imported when models are trained or loaded)."""
+	import subprocess, sys
+	code = "import sys, service.analyzer; print(' '.join(m for m in ['tensorflow', 'keras', 'sklearn', 'lightgbm', 'numba', 'statsmodels'] if m in sys.modules))"
+	out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+	assert out.stdout.strip() == ""
+
+	pass